@@ -0,0 +1,281 @@
+"""Load test of the API against local stand-ins for Notion and OpenAI.
+
+Boots the app with uvicorn, pointed at the fake services of
+`benchmarks.fake_services` through `NOTION_BASE_URL` and `OPENAI_API_BASE`, and
+drives `/create_template`, `/get_templates` and `/generate_posts` with concurrent
+clients. Reports the throughput and the p50/p95/p99 latency of every endpoint.
+
+The fakes answer after `--notion-latency` and `--openai-latency` seconds and fail
+a share of the requests with a 5xx (`--error-rate`) or a 429 (`--throttle-rate`).
+`--record DIR` stores the exchanges with the fakes, injected faults included, or
+with the real APIs given `--notion-upstream` and `--openai-upstream`. `--replay
+DIR` answers with the recordings and their timing, without network access, as
+long as the other options match the recorded run. With `--baseline`, the run
+fails if an endpoint got slower or less throughput than the baseline report.
+
+The app's Notion rate limit is lifted unless `NOTION_RATE_LIMIT` is set, since it
+would otherwise bound every run to 3 requests per second and integration.
+
+Run from the backend folder with `python -m benchmarks.bench_load`, e.g.
+`python -m benchmarks.bench_load --replay benchmarks/fixtures`.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.fake_services import (
+    Cassette,
+    FaultInjection,
+    Faults,
+    RecordReplay,
+    ServerThread,
+    fake_notion,
+    fake_openai,
+    proxy,
+)
+
+ENDPOINTS = ("create_template", "get_templates", "generate_posts")
+
+POST = (
+    "I failed {index} times before my first launch.\nEvery failure taught me one "
+    "thing about my customers.\nHere is what I would tell myself today."
+)
+
+
+def payload(endpoint: str, index: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Returns the body of the `index`-th request to an endpoint."""
+    integration = index % args.integrations
+    common = {
+        "notionKey": args.notion_key or f"secret_benchmark_{integration}",
+        "databaseId": args.database_id or f"benchmark-database-{integration}",
+    }
+    if endpoint == "get_templates":
+        return common
+
+    common.update({"openaiKey": args.openai_key or "sk-benchmark", "model": args.model})
+    if endpoint == "create_template":
+        # Distinct texts, the result cache would answer repeated ones.
+        return {**common, "text": POST.format(index=index)}
+    # Distinct topics as well, so replayed posts are stored in the same database
+    # as when they were recorded.
+    return {
+        **common,
+        "templateText": "I [did something] [number] times before [milestone].",
+        "numPosts": args.posts,
+        "topics": f"careers, startups, hiring in week {index}",
+    }
+
+
+async def drive(
+    url: str,
+    endpoint: str,
+    make_payload: Callable[[int], Dict[str, Any]],
+    requests: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    """Sends `requests` requests to an endpoint from `concurrency` clients.
+
+    Returns:
+        Dict[str, Any]: The request and error counts, the throughput and the
+            latency percentiles in milliseconds.
+    """
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    indices = iter(range(requests))
+
+    async def client(http: httpx.AsyncClient) -> None:
+        for index in indices:
+            start = time.perf_counter()
+            try:
+                response = await http.post(f"/{endpoint}", json=make_payload(index))
+                outcome = None if response.is_success else str(response.status_code)
+            except httpx.HTTPError as error:
+                outcome = type(error).__name__
+            latencies.append(time.perf_counter() - start)
+            if outcome is not None:
+                errors[outcome] = errors.get(outcome, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=300, limits=limits) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": requests / duration,
+        **{
+            f"p{quantile}": percentile(latencies, quantile) * 1000
+            for quantile in (50, 95, 99)
+        },
+    }
+
+
+def percentile(samples: List[float], quantile: float) -> float:
+    """Returns the nearest-rank percentile of sorted samples."""
+    if not samples:
+        return 0.0
+    rank = max(1, -(-len(samples) * quantile // 100))
+    return samples[int(rank) - 1]
+
+
+def regressions(
+    report: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    """Returns the endpoints that got slower or less throughput than a baseline."""
+    found = []
+    for endpoint, result in report.items():
+        expected = baseline.get(endpoint)
+        if expected is None:
+            continue
+        if result["p95"] > expected["p95"] * (1 + tolerance):
+            found.append(
+                f"{endpoint}: p95 {result['p95']:.1f} ms, "
+                f"baseline {expected['p95']:.1f} ms"
+            )
+        if result["throughput"] < expected["throughput"] * (1 - tolerance):
+            found.append(
+                f"{endpoint}: {result['throughput']:.1f} req/s, "
+                f"baseline {expected['throughput']:.1f} req/s"
+            )
+    return found
+
+
+def fake_service(
+    name: str,
+    synthetic: Any,
+    upstream: Optional[str],
+    faults: Faults,
+    args: argparse.Namespace,
+) -> Tuple[ServerThread, Optional[Cassette]]:
+    """Returns the server of a stand-in, synthetic, recorded or replayed, and its
+    cassette."""
+    if args.replay:
+        cassette = Cassette(os.path.join(args.replay, f"{name}.json"), "replay")
+        return ServerThread(RecordReplay(synthetic, cassette)), cassette
+
+    # The faults are recorded along with the responses, replays repeat them.
+    app = proxy(upstream) if upstream else FaultInjection(synthetic, faults)
+    if not args.record:
+        return ServerThread(app), None
+
+    cassette = Cassette(os.path.join(args.record, f"{name}.json"), "record")
+    return ServerThread(RecordReplay(app, cassette)), cassette
+
+
+def main() -> None:
+    """Runs the load test and prints the results per endpoint."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--integrations", type=int, default=4)
+    parser.add_argument("--posts", type=int, default=5)
+    parser.add_argument("--templates", type=int, default=100)
+    parser.add_argument("--model", default="gpt-3.5-turbo-1106")
+    parser.add_argument("--notion-latency", type=float, default=0.1)
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.25, help="share of latency")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--record", metavar="DIR")
+    parser.add_argument("--replay", metavar="DIR")
+    parser.add_argument("--notion-upstream", help="e.g. https://api.notion.com")
+    parser.add_argument("--openai-upstream", help="e.g. https://api.openai.com")
+    parser.add_argument("--notion-key", default=os.getenv("BENCHMARK_NOTION_KEY"))
+    parser.add_argument("--openai-key", default=os.getenv("BENCHMARK_OPENAI_KEY"))
+    parser.add_argument("--database-id", default=os.getenv("BENCHMARK_DATABASE_ID"))
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--baseline", help="compare with this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.record and args.replay:
+        parser.error("--record and --replay are exclusive")
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+
+    def faults(latency: float, seed: int) -> Faults:
+        return Faults(
+            latency=latency,
+            jitter=latency * args.jitter,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            seed=seed,
+        )
+
+    notion, notion_cassette = fake_service(
+        "notion",
+        fake_notion(templates=args.templates, seed=args.seed),
+        args.notion_upstream,
+        faults(args.notion_latency, args.seed),
+        args,
+    )
+    openai, openai_cassette = fake_service(
+        "openai",
+        fake_openai(seed=args.seed),
+        args.openai_upstream,
+        faults(args.openai_latency, args.seed + 1),
+        args,
+    )
+
+    with notion, openai:
+        os.environ["NOTION_BASE_URL"] = notion.url
+        os.environ["OPENAI_API_BASE"] = f"{openai.url}/v1"
+        os.environ.setdefault("NOTION_RATE_LIMIT", "1000000")
+        os.environ.setdefault("NOTION_RATE_BURST", "1000000")
+        # The app reads its configuration on import.
+        api = importlib.import_module("src.app")
+
+        report = {}
+        with ServerThread(api.app) as server:
+            for endpoint in args.endpoints.split(","):
+                report[endpoint] = asyncio.run(
+                    drive(
+                        server.url,
+                        endpoint,
+                        lambda index: payload(endpoint, index, args),
+                        args.requests,
+                        args.concurrency,
+                    )
+                )
+                result = report[endpoint]
+                print(
+                    f"{endpoint:16} {result['throughput']:8.1f} req/s   "
+                    f"p50 {result['p50']:8.1f} ms   p95 {result['p95']:8.1f} ms   "
+                    f"p99 {result['p99']:8.1f} ms   errors {result['errors']}"
+                )
+
+    for cassette in (notion_cassette, openai_cassette):
+        if cassette is not None and cassette.mode == "record":
+            cassette.save()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            found = regressions(report, json.load(file), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Measures the tokens saved by salvaging partially malformed LLM outputs.
+
+For every output in `malformed_outputs.json` the posts recovered by
+`src.output_parsing.parse_objects` are counted. Without salvaging, the whole
+generation is requested again, with it only the missing posts are.
+
+Tokens are counted with `tiktoken` when it is installed and estimated as four
+characters per token otherwise.
+
+Run from the backend folder with `python -m benchmarks.bench_output_repair`.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Callable
+
+from src import prompts
+from src.output_parsing import parse_objects
+
+CORPUS = Path(__file__).with_name("malformed_outputs.json")
+TEMPLATE = "I [significant decision].\nIt was the [notable achievement]."
+TOPICS = "AI, startups, careers"
+
+
+def token_counter() -> Callable[[str], int]:
+    """Returns a function counting the tokens of a text."""
+    try:
+        import tiktoken
+    except ImportError:
+        return lambda text: max(1, len(text) // 4)
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(encoding.encode(text))
+
+
+def prompt_for(number_of_posts: int) -> str:
+    """Returns the post generation prompt for the given number of posts."""
+    return prompts.creating_posts_prompt.format(
+        TEMPLATE=TEMPLATE, NUMBER_OF_POSTS=number_of_posts, TOPICS=TOPICS
+    )
+
+
+def main() -> None:
+    """Runs the benchmark and prints the tokens per retry strategy."""
+    logging.disable(logging.WARNING)
+    count_tokens = token_counter()
+    cases = json.loads(CORPUS.read_text())
+    total_full = total_repair = 0
+
+    print(f"{'case':45} {'posts':>7} {'full retry':>11} {'repair':>8}")
+    for case in cases:
+        requested = case["requested"]
+        recovered = len(parse_objects(case["output"]))
+        missing = requested - recovered
+        tokens_per_post = count_tokens(case["output"]) / requested
+
+        full_retry = count_tokens(prompt_for(requested)) + tokens_per_post * requested
+        repair = (
+            count_tokens(prompt_for(missing)) + tokens_per_post * missing
+            if missing > 0
+            else 0
+        )
+        total_full += full_retry
+        total_repair += repair
+
+        print(
+            f"{case['name']:45} {recovered:>3}/{requested:<3} "
+            f"{full_retry:>11.0f} {repair:>8.0f}"
+        )
+
+    saved = 1 - total_repair / total_full
+    print(f"{'total':53} {total_full:>11.0f} {total_repair:>8.0f} ({saved:.0%} saved)")
+
+
+if __name__ == "__main__":
+    main()
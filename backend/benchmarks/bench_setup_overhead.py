@@ -0,0 +1,84 @@
+"""Measures the per-request setup overhead of the API handlers.
+
+Compares building a fresh Notion client, prompt template and LLM chain for every
+request with leasing them from the application's resource pools.
+
+Run from the backend folder with `python -m benchmarks.bench_setup_overhead`.
+"""
+import argparse
+import asyncio
+import time
+from typing import Callable, Coroutine
+
+from notion_client import AsyncClient
+
+from src import prompts
+from src.llm import LLM
+from src.pool import ResourcePool, hash_secret
+
+NOTION_KEY = "secret_benchmark"
+OPENAI_KEY = "sk-benchmark"
+MODEL = "gpt-3.5-turbo"
+
+
+async def fresh_setup() -> None:
+    """Builds every resource from scratch, like the handlers used to."""
+    notion = AsyncClient(auth=NOTION_KEY)
+    llm = LLM(
+        openai_api_key=OPENAI_KEY,
+        temperature=0,
+        model_name=MODEL,
+        prompt_template=prompts.creating_posts_prompt,
+    )
+    await llm.aclose()
+    await notion.aclose()
+
+
+def pooled_setup() -> Callable[[], Coroutine]:
+    """Returns a setup coroutine function leasing resources from warm pools."""
+    notion_clients: ResourcePool[AsyncClient] = ResourcePool(
+        close=lambda client: client.aclose()
+    )
+    llms: ResourcePool[LLM] = ResourcePool(close=lambda llm: llm.aclose())
+
+    async def setup() -> None:
+        async with notion_clients.acquire(
+            hash_secret(NOTION_KEY), lambda: AsyncClient(auth=NOTION_KEY)
+        ), llms.acquire(
+            (hash_secret(OPENAI_KEY), MODEL, 0, "creating_posts"),
+            lambda: LLM(
+                openai_api_key=OPENAI_KEY,
+                temperature=0,
+                model_name=MODEL,
+                prompt_template=prompts.creating_posts_prompt,
+            ),
+        ):
+            pass
+
+    return setup
+
+
+async def measure(setup: Callable[[], Coroutine], iterations: int) -> float:
+    """Returns the mean setup time in microseconds."""
+    await setup()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await setup()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main() -> None:
+    """Runs the benchmark and prints the mean setup time per request."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    fresh = asyncio.run(measure(fresh_setup, args.iterations))
+    pooled = asyncio.run(measure(pooled_setup(), args.iterations))
+
+    print(f"fresh setup : {fresh:10.1f} us/request")
+    print(f"pooled setup: {pooled:10.1f} us/request ({fresh / pooled:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Measures the cold start of the app with every LLM backend.
+
+Every run is a fresh interpreter that imports `src.app` and builds the LLM of a
+request, selected with `LLM_BACKEND`. Reports the median time to import the app,
+the time until the LLM is ready and the peak resident memory of the process.
+
+Run from the backend folder with `python -m benchmarks.bench_startup`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+from src.llm import LLM_BACKENDS
+
+CHILD = """
+import json, resource, time
+start = time.perf_counter()
+import src.app as app
+imported = time.perf_counter()
+llm = app.LLM(
+    openai_api_key="sk-benchmark",
+    model_name="gpt-3.5-turbo",
+    prompt_template=app.PROMPT_TEMPLATES["creating_posts"],
+    backend=app.LLM_BACKEND,
+    base_url=app.OPENAI_API_BASE,
+)
+llm.template.format(TEMPLATE="[template]", NUMBER_OF_POSTS=5, TOPICS="AI")
+ready = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "ready": ready - start,
+    "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def run(backend: str) -> Dict[str, float]:
+    """Starts the app in a fresh interpreter and returns its measurements."""
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        env={**os.environ, "LLM_BACKEND": backend},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main() -> None:
+    """Runs the benchmark and prints the medians per backend."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for backend in LLM_BACKENDS:
+        runs: List[Dict[str, float]] = [run(backend) for _ in range(args.runs)]
+        median = {
+            key: statistics.median(result[key] for result in runs)
+            for key in ("import", "ready", "rss")
+        }
+        print(
+            f"{backend:10} import {median['import'] * 1000:7.0f} ms   "
+            f"ready {median['ready'] * 1000:7.0f} ms   "
+            f"peak RSS {median['rss']:6.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
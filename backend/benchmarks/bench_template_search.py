@@ -0,0 +1,129 @@
+"""Measures `src.template_search.TemplateIndex` on a large template library.
+
+Builds an index over synthetic templates, whose words follow a Zipf distribution
+like natural text does, and reports the build time, the cost of adding templates
+incrementally and the latency of short queries and of pasted posts. A brute
+force scan scoring every template is measured as the baseline.
+
+Run from the backend folder with `python -m benchmarks.bench_template_search`.
+"""
+import argparse
+import math
+import random
+import statistics
+import time
+from collections import Counter
+from typing import Callable, Dict, List
+
+from src.template_search import TemplateIndex, tokenize
+
+VOCABULARY_SIZE = 20000
+
+
+def make_templates(count: int, seed: int = 0) -> List[Dict[str, str]]:
+    """Returns synthetic templates with Zipf distributed words."""
+    generator = random.Random(seed)
+    vocabulary = [f"word{index}" for index in range(VOCABULARY_SIZE)]
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY_SIZE)]
+
+    def text(words: int) -> str:
+        return " ".join(generator.choices(vocabulary, weights, k=words))
+
+    return [
+        {
+            "pageId": f"page_{index}",
+            "title": text(5),
+            "content": text(generator.randint(80, 250)),
+            "lastEditedTime": "2023-12-01T00:00:00.000Z",
+        }
+        for index in range(count)
+    ]
+
+
+def brute_force(templates: List[Dict[str, str]]) -> Callable[[str, int], List[str]]:
+    """Returns a search function scoring every template on every query."""
+    vectors = [
+        Counter(tokenize(template["title"] + " " + template["content"]))
+        for template in templates
+    ]
+
+    def search(text: str, k: int) -> List[str]:
+        query = Counter(tokenize(text))
+        scores = []
+        for template, vector in zip(templates, vectors):
+            dot = sum(count * vector.get(term, 0) for term, count in query.items())
+            norm = math.sqrt(sum(count * count for count in vector.values())) or 1
+            scores.append((dot / norm, template["pageId"]))
+        return [page_id for _, page_id in sorted(scores, reverse=True)[:k]]
+
+    return search
+
+
+def percentiles(samples: List[float]) -> str:
+    """Formats the p50 and p95 of latencies given in seconds."""
+    quantiles = statistics.quantiles(samples, n=20)
+    return f"p50 {quantiles[9] * 1000:8.2f} ms   p95 {quantiles[18] * 1000:8.2f} ms"
+
+
+def measure(search: Callable[[str, int], object], queries: List[str]) -> List[float]:
+    """Returns the latency of every query."""
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query, 5)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main() -> None:
+    """Runs the benchmark and prints the timings."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--templates", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--baseline-queries", type=int, default=10)
+    args = parser.parse_args()
+
+    templates = make_templates(args.templates)
+    generator = random.Random(1)
+    short_queries = [
+        " ".join(tokenize(generator.choice(templates)["content"])[:3])
+        for _ in range(args.queries)
+    ]
+    posts = [generator.choice(templates)["content"] for _ in range(args.queries)]
+
+    index = TemplateIndex()
+    start = time.perf_counter()
+    index.sync(templates)
+    build = time.perf_counter() - start
+    print(f"build index ({len(index)} templates)  {build * 1000:10.1f} ms")
+
+    start = time.perf_counter()
+    index.sync(templates)
+    print(
+        f"sync without changes          {(time.perf_counter() - start) * 1000:10.1f} ms"
+    )
+
+    added = make_templates(100, seed=2)
+    for template in added:
+        template["pageId"] += "_new"
+    start = time.perf_counter()
+    for template in added:
+        index.add(
+            template["pageId"],
+            template["title"],
+            template["content"],
+            template["lastEditedTime"],
+        )
+    elapsed = time.perf_counter() - start
+    print(f"add one template              {elapsed / len(added) * 1000:10.3f} ms")
+
+    print(f"short query    index   {percentiles(measure(index.search, short_queries))}")
+    print(f"pasted post    index   {percentiles(measure(index.search, posts))}")
+
+    baseline = brute_force(templates)
+    sample = posts[: args.baseline_queries]
+    print(f"pasted post    scan    {percentiles(measure(baseline, sample))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,697 @@
+"""Local stand-ins for the Notion and OpenAI APIs used by the load benchmark.
+
+`fake_notion` and `fake_openai` are ASGI apps implementing the endpoints the
+backend calls with synthetic data, `proxy` forwards to the real APIs instead.
+Any of them can be wrapped with `FaultInjection`, which adds latency, server
+errors and 429 responses, and with `RecordReplay`, which records the exchanges
+to a JSON cassette or replays them (including their timing) without network
+access. `ServerThread` serves an app on a local port in a background thread.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from fastapi import Body, FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.types import ASGIApp
+
+# Headers worth replaying, the rest is connection specific.
+RECORDED_HEADERS = ("content-type", "retry-after")
+
+WORDS = (
+    "growth team career lesson failure success hiring founder product customer "
+    "market launch story mistake habit leader remote salary startup journey"
+).split()
+
+
+class Faults:
+    """This class describes the misbehavior injected by `FaultInjection`.
+
+    Parameters:
+    - latency (float, optional): The mean delay of a response in seconds.
+        Defaults to 0.
+    - jitter (float, optional): The delay varies uniformly by up to this many
+        seconds. Defaults to 0.
+    - error_rate (float, optional): The share of requests failing with a 5xx.
+        Defaults to 0.
+    - throttle_rate (float, optional): The share of requests answered with a 429.
+        Defaults to 0.
+    - retry_after (float, optional): The `Retry-After` of the 429 responses in
+        seconds. Defaults to 0.5.
+    - seed (int, optional): Seeds the random faults. Defaults to None.
+
+    Example:
+    ```python
+    faults = Faults(latency=0.2, jitter=0.05, throttle_rate=0.05, seed=0)
+    ```
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 0.5,
+        seed: Optional[int] = None,
+    ) -> None:
+        """Initialize the faults.
+
+        Parameters:
+        - latency (float, optional): The mean delay of a response in seconds.
+            Defaults to 0.
+        - jitter (float, optional): The delay varies uniformly by up to this many
+            seconds. Defaults to 0.
+        - error_rate (float, optional): The share of requests failing with a 5xx.
+            Defaults to 0.
+        - throttle_rate (float, optional): The share of requests answered with a
+            429. Defaults to 0.
+        - retry_after (float, optional): The `Retry-After` of the 429 responses in
+            seconds. Defaults to 0.5.
+        - seed (int, optional): Seeds the random faults. Defaults to None.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+    def delay(self) -> float:
+        """Returns the delay of the next response in seconds."""
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def status(self) -> Optional[int]:
+        """Returns the status of an injected failure, or None to pass the request."""
+        draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+
+class FaultInjection:
+    """This ASGI middleware delays the responses of an app and fails some of them.
+
+    Parameters:
+    - app (ASGIApp): The fake service.
+    - faults (Faults): The injected misbehavior.
+
+    Example:
+    ```python
+    app = FaultInjection(fake_notion(), Faults(latency=0.2, throttle_rate=0.05))
+    ```
+    """
+
+    def __init__(self, app: ASGIApp, faults: Faults) -> None:
+        """Initialize the middleware.
+
+        Parameters:
+        - app (ASGIApp): The fake service.
+        - faults (Faults): The injected misbehavior.
+        """
+        self.app = app
+        self.faults = faults
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        """Handles a request after the injected delay, or fails it.
+
+        Args:
+            scope (Dict[str, Any]): The ASGI connection scope.
+            receive (Any): The ASGI receive channel.
+            send (Any): The ASGI send channel.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        await asyncio.sleep(self.faults.delay())
+
+        status = self.faults.status()
+        if status is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {}
+        if status == 429:
+            headers["Retry-After"] = str(self.faults.retry_after)
+        # Notion and OpenAI both accept this shape well enough for their clients.
+        response = JSONResponse(
+            {
+                "object": "error",
+                "status": status,
+                "code": "rate_limited" if status == 429 else "service_unavailable",
+                "message": "Injected by the benchmark",
+                "error": {"message": "Injected by the benchmark", "type": "server"},
+            },
+            status_code=status,
+            headers=headers,
+        )
+        await response(scope, receive, send)
+
+
+class Cassette:
+    """This class stores recorded HTTP exchanges in a JSON file.
+
+    Exchanges are keyed by method, path and request body, so replaying does not
+    depend on the order of concurrent requests. Chat completions are keyed by
+    their model and prompt only, with whitespace collapsed, so replays survive
+    changes to the sampling options or the layout of a prompt. Repeated requests
+    replay their recordings in turn.
+
+    Parameters:
+    - path (str): The JSON file.
+    - mode (str, optional): "record" or "replay". Defaults to "replay".
+
+    Methods:
+    - key(method: str, path: str, body: bytes) -> str: Returns the key of a
+        request.
+    - next(key: str) -> Optional[Dict[str, Any]]: Returns the next recording of a
+        request.
+    - add(key: str, exchange: Dict[str, Any]) -> None: Records an exchange.
+    - save() -> None: Writes the recordings to the file.
+
+    Example:
+    ```python
+    cassette = Cassette("benchmarks/fixtures/notion.json", mode="record")
+    app = RecordReplay(proxy("https://api.notion.com"), cassette)
+    ```
+    """
+
+    def __init__(self, path: str, mode: str = "replay") -> None:
+        """Initialize the cassette.
+
+        Parameters:
+        - path (str): The JSON file.
+        - mode (str, optional): "record" or "replay". Defaults to "replay".
+        """
+        if mode not in ("record", "replay"):
+            raise ValueError("mode must be 'record' or 'replay'")
+
+        self.path = path
+        self.mode = mode
+        self._exchanges: Dict[str, List[Dict[str, Any]]] = {}
+        self._replayed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        if mode == "replay":
+            with open(self.path, encoding="utf-8") as file:
+                self._exchanges = json.load(file)
+
+    @staticmethod
+    def key(method: str, path: str, body: bytes) -> str:
+        """Returns the key of a request.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path including the query string.
+            body (bytes): The request body, JSON bodies are normalized.
+
+        Returns:
+            str: The key.
+        """
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and "messages" in data:
+            data = {
+                "model": data.get("model"),
+                "messages": [
+                    " ".join(str(message.get("content", "")).split())
+                    for message in data["messages"]
+                ],
+            }
+        if data is not None:
+            body = json.dumps(data, sort_keys=True).encode("utf-8")
+        return f"{method} {path} {hashlib.sha256(body).hexdigest()[:16]}"
+
+    def next(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the next recording of a request.
+
+        Args:
+            key (str): The request key.
+
+        Returns:
+            Optional[Dict[str, Any]]: The exchange, or None if it was not recorded.
+        """
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                return None
+            turn = self._replayed.get(key, 0)
+            self._replayed[key] = turn + 1
+            return exchanges[turn % len(exchanges)]
+
+    def add(self, key: str, exchange: Dict[str, Any]) -> None:
+        """Records an exchange.
+
+        Args:
+            key (str): The request key.
+            exchange (Dict[str, Any]): The `status`, `headers` and timed `chunks`
+                of the response.
+        """
+        with self._lock:
+            self._exchanges.setdefault(key, []).append(exchange)
+
+    def save(self) -> None:
+        """Writes the recordings to the file."""
+        with self._lock, open(self.path, "w", encoding="utf-8") as file:
+            json.dump(self._exchanges, file, indent=1, sort_keys=True)
+
+
+class RecordReplay:
+    """This ASGI middleware records the responses of an app to a cassette, or
+    replays them instead.
+
+    Parameters:
+    - app (ASGIApp): The fake service or proxy, unused when replaying.
+    - cassette (Cassette): The recordings.
+
+    Example:
+    ```python
+    app = RecordReplay(fake_openai(), Cassette("openai.json", mode="replay"))
+    ```
+    """
+
+    def __init__(self, app: ASGIApp, cassette: Cassette) -> None:
+        """Initialize the middleware.
+
+        Parameters:
+        - app (ASGIApp): The fake service or proxy, unused when replaying.
+        - cassette (Cassette): The recordings.
+        """
+        self.app = app
+        self.cassette = cassette
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        """Replays the recorded response of a request, or records it.
+
+        Args:
+            scope (Dict[str, Any]): The ASGI connection scope.
+            receive (Any): The ASGI receive channel.
+            send (Any): The ASGI send channel.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        path = scope["path"]
+        if scope.get("query_string"):
+            path += f"?{scope['query_string'].decode('latin-1')}"
+        key = self.cassette.key(scope["method"], path, body)
+
+        if self.cassette.mode == "replay":
+            await self._replay(key, scope, receive, send)
+        else:
+            await self._record(key, body, scope, receive, send)
+
+    async def _replay(
+        self, key: str, scope: Dict[str, Any], receive: Any, send: Any
+    ) -> None:
+        exchange = self.cassette.next(key)
+        if exchange is None:
+            response: Response = JSONResponse(
+                {"object": "error", "status": 501, "message": f"Not recorded: {key}"},
+                status_code=501,
+            )
+        else:
+            response = StreamingResponse(
+                _timed_chunks(exchange["chunks"]),
+                status_code=exchange["status"],
+                headers=exchange["headers"],
+            )
+        await response(scope, receive, send)
+
+    async def _record(
+        self, key: str, body: bytes, scope: Dict[str, Any], receive: Any, send: Any
+    ) -> None:
+        exchange: Dict[str, Any] = {"status": 500, "headers": {}, "chunks": []}
+        start = time.perf_counter()
+        body_sent = False
+
+        async def receive_body() -> Dict[str, Any]:
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send_and_record(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                exchange["status"] = message["status"]
+                exchange["headers"] = {
+                    name.decode("latin-1"): value.decode("latin-1")
+                    for name, value in message.get("headers", [])
+                    if name.decode("latin-1").lower() in RECORDED_HEADERS
+                }
+            elif message["type"] == "http.response.body" and message.get("body"):
+                exchange["chunks"].append(
+                    [
+                        round(time.perf_counter() - start, 4),
+                        message["body"].decode("utf-8"),
+                    ]
+                )
+            await send(message)
+
+        await self.app(scope, receive_body, send_and_record)
+        self.cassette.add(key, exchange)
+
+
+async def _timed_chunks(chunks: List[Tuple[float, str]]) -> AsyncIterator[str]:
+    start = time.perf_counter()
+    for offset, text in chunks:
+        await asyncio.sleep(max(0.0, offset - (time.perf_counter() - start)))
+        yield text
+
+
+def proxy(upstream: str) -> FastAPI:
+    """Returns an app forwarding every request to a real API, for recording.
+
+    Args:
+        upstream (str): The base URL, e.g. "https://api.notion.com".
+
+    Returns:
+        FastAPI: The proxy.
+    """
+    app = FastAPI()
+    client = httpx.AsyncClient(base_url=upstream, timeout=120)
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def forward(path: str, request: Request) -> Response:
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name not in ("host", "content-length", "accept-encoding")
+        }
+        upstream_request = client.build_request(
+            request.method,
+            f"/{path}",
+            params=request.query_params,
+            headers=headers,
+            content=await request.body(),
+        )
+        response = await client.send(upstream_request, stream=True)
+
+        async def body():
+            async for chunk in response.aiter_text():
+                yield chunk
+            await response.aclose()
+
+        return StreamingResponse(
+            body(),
+            status_code=response.status_code,
+            headers={
+                name: value
+                for name, value in response.headers.items()
+                if name in RECORDED_HEADERS
+            },
+        )
+
+    return app
+
+
+def fake_notion(templates: int = 100, seed: int = 0) -> FastAPI:
+    """Returns an app implementing the Notion endpoints used by the backend.
+
+    Databases that were not created through the app are filled with `templates`
+    synthetic templates when they are first used.
+
+    Args:
+        templates (int, optional): The number of templates of a database.
+            Defaults to 100.
+        seed (int, optional): Seeds the synthetic templates. Defaults to 0.
+
+    Returns:
+        FastAPI: The fake Notion API.
+    """
+    app = FastAPI()
+    databases: Dict[str, List[Dict[str, Any]]] = {}
+    contents: Dict[str, str] = {}
+    generator = random.Random(seed)
+    epoch = datetime(2023, 12, 1, tzinfo=timezone.utc)
+
+    def timestamp() -> str:
+        now = epoch + timedelta(seconds=sum(map(len, databases.values())))
+        return now.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def new_page(database_id: str, title: str, content: str, status: str) -> Dict:
+        page = {
+            "object": "page",
+            "id": str(uuid.UUID(int=generator.getrandbits(128))),
+            "created_time": timestamp(),
+            "last_edited_time": timestamp(),
+            "parent": {"type": "database_id", "database_id": database_id},
+            "properties": {
+                "Title": {"id": "title", "type": "title", "title": _rich_text(title)},
+                "Status": {
+                    "id": "status",
+                    "type": "select",
+                    "select": {"name": status},
+                },
+            },
+        }
+        databases[database_id].append(page)
+        contents[page["id"]] = content
+        return page
+
+    def database(database_id: str) -> List[Dict[str, Any]]:
+        if database_id not in databases:
+            databases[database_id] = []
+            for _ in range(templates):
+                new_page(
+                    database_id,
+                    _text(generator, 4),
+                    _text(generator, generator.randint(40, 120)),
+                    "Template",
+                )
+        return databases[database_id]
+
+    @app.post("/v1/databases/{database_id}/query")
+    async def query(database_id: str, body: Dict[str, Any] = Body(default={})):
+        pages = database(database_id)
+        query_filter = body.get("filter") or {}
+        if "select" in query_filter:
+            status = query_filter["select"]["equals"]
+            pages = [page for page in pages if _status(page) == status]
+        elif "last_edited_time" in query_filter:
+            since = query_filter["last_edited_time"]["on_or_after"]
+            pages = [page for page in pages if page["last_edited_time"] >= since]
+
+        start = int(body.get("start_cursor") or 0)
+        end = start + min(int(body.get("page_size") or 100), 100)
+        return {
+            "object": "list",
+            "results": pages[start:end],
+            "has_more": end < len(pages),
+            "next_cursor": str(end) if end < len(pages) else None,
+        }
+
+    @app.get("/v1/blocks/{block_id}/children")
+    async def children(block_id: str):
+        if block_id not in contents:
+            return JSONResponse(
+                {"object": "error", "status": 404, "code": "object_not_found"},
+                status_code=404,
+            )
+        block = {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {"rich_text": _rich_text(contents[block_id])},
+        }
+        return {
+            "object": "list",
+            "results": [block],
+            "has_more": False,
+            "next_cursor": None,
+        }
+
+    @app.post("/v1/pages")
+    async def create_page(body: Dict[str, Any] = Body(...)):
+        database_id = body["parent"]["database_id"]
+        properties = body["properties"]
+        title = (properties.get("Title") or properties["title"])["title"]
+        content = body["children"][0]["paragraph"]["rich_text"]
+        database(database_id)
+        return new_page(
+            database_id,
+            title[0]["text"]["content"],
+            content[0]["text"]["content"],
+            properties["Status"]["select"]["name"],
+        )
+
+    @app.post("/v1/databases")
+    async def create_database(body: Dict[str, Any] = Body(...)):
+        database_id = str(uuid.UUID(int=generator.getrandbits(128)))
+        databases[database_id] = []
+        return {"object": "database", "id": database_id, "title": body.get("title")}
+
+    return app
+
+
+def fake_openai(seed: int = 0) -> FastAPI:
+    """Returns an app implementing OpenAI's chat completions for the backend's
+    prompts, answering with as many templates or posts as they ask for.
+
+    Args:
+        seed (int, optional): Seeds the generated text. Defaults to 0.
+
+    Returns:
+        FastAPI: The fake OpenAI API.
+    """
+    app = FastAPI()
+    generator = random.Random(seed)
+
+    @app.post("/v1/chat/completions")
+    async def completions(body: Dict[str, Any] = Body(...)):
+        prompt = body["messages"][-1]["content"]
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        content = _completion(generator, prompt, json_mode)
+        model = body.get("model", "gpt-3.5-turbo")
+        completion_id = f"chatcmpl-{generator.getrandbits(64):x}"
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": len(prompt.split()),
+                    "completion_tokens": len(content.split()),
+                    "total_tokens": len(prompt.split()) + len(content.split()),
+                },
+            }
+
+        async def events():
+            for token in re.findall(r"\S+\s*", content):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                    ],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class ServerThread:
+    """This class serves an ASGI app on a local port in a background thread, so
+    the fake services do not compete with the measured app for its event loop.
+
+    Parameters:
+    - app (Any): The ASGI app.
+    - port (int, optional): The port, 0 picks a free one. Defaults to 0.
+
+    Attributes:
+    - url (str): The base URL once the server is started.
+
+    Example:
+    ```python
+    with ServerThread(fake_notion()) as notion:
+        client = AsyncClient(auth="secret", base_url=notion.url)
+    ```
+    """
+
+    def __init__(self, app: Any, port: int = 0) -> None:
+        """Initialize the server thread.
+
+        Parameters:
+        - app (Any): The ASGI app.
+        - port (int, optional): The port, 0 picks a free one. Defaults to 0.
+        """
+        config = uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"
+        )
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = ""
+
+    def __enter__(self) -> "ServerThread":
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("The server failed to start")
+            time.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def _completion(generator: random.Random, prompt: str, json_mode: bool) -> str:
+    posts = re.search(r"generate\s+(\d+)\s+different posts", prompt)
+    batch = prompt.split("These are the LinkedIn posts:", 1)
+
+    if posts is not None:
+        records = [_record(generator) for _ in range(int(posts.group(1)))]
+        return json.dumps({"posts": records} if json_mode else records)
+
+    if len(batch) == 2:
+        indices = re.findall(r"^\[(\d+)\] '''", batch[1], re.MULTILINE)
+        records = [
+            {"index": int(index), **_record(generator, brackets=True)}
+            for index in indices
+        ]
+        return json.dumps({"templates": records} if json_mode else records)
+
+    return json.dumps(_record(generator, brackets=True))
+
+
+def _record(generator: random.Random, brackets: bool = False) -> Dict[str, str]:
+    post = _text(generator, generator.randint(40, 120))
+    if brackets:
+        post = re.sub(r"\b(\w+ \w+)\b", lambda match: f"[{match.group(1)}]", post, 3)
+    return {"title": _text(generator, 4).capitalize(), "post": post}
+
+
+def _text(generator: random.Random, words: int) -> str:
+    return " ".join(generator.choice(WORDS) for _ in range(words))
+
+
+def _rich_text(content: str) -> List[Dict[str, Any]]:
+    return [
+        {
+            "type": "text",
+            "text": {"content": content, "link": None},
+            "plain_text": content,
+        }
+    ]
+
+
+def _status(page: Dict[str, Any]) -> Optional[str]:
+    return (page["properties"]["Status"].get("select") or {}).get("name")
@@ -0,0 +1,247 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Counter, Dict, List, Tuple
+
+from src.metrics import ADMISSION_QUEUED, ADMISSION_REJECTIONS, ADMISSION_WAIT
+
+# Beyond this many tenants, those without queued or credited work are forgotten.
+IDLE_TENANTS_KEPT = 1024
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted.
+
+    Attributes:
+    - status (int): 429 if the tenant queued too much work itself, 503 if the
+        server is saturated.
+    - retry_after (int): The seconds after which a retry is likely admitted.
+    """
+
+    def __init__(self, message: str, status: int, retry_after: int) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """This class bounds the concurrent requests of an endpoint and queues the
+    others with weighted fair queuing across tenants.
+
+    Every admitted request is charged its cost divided by the tenant's weight in
+    virtual time, and queued requests are admitted in the order of their virtual
+    finish times. A tenant queuing many large requests therefore waits behind its
+    own work, while the requests of other tenants keep being admitted at their
+    share. A request waits at most `timeout` seconds. When the queue or the
+    tenant's part of it is full, or the deadline passes, `Overloaded` is raised
+    with a `retry_after` estimated from the recent service times.
+
+    Parameters:
+    - name (str): The endpoint, used as metric label.
+    - capacity (int): The maximum number of concurrent requests.
+    - max_queue (int, optional): The maximum number of waiting requests.
+        Defaults to 64.
+    - max_queue_per_tenant (int, optional): The maximum number of waiting requests
+        of a single tenant. Defaults to 8.
+    - timeout (float, optional): The seconds a request waits at most.
+        Defaults to 30.
+
+    Background jobs are queued the same way, but wait without a deadline and are
+    not rejected when the queue is full, the job queue bounds them instead.
+
+    Methods:
+    - acquire(tenant: str, cost: float = 1, weight: float = 1,
+        background: bool = False) -> Callable[[], None]: Waits for a slot and
+        returns its release function.
+    - admit(tenant: str, cost: float = 1, weight: float = 1,
+        background: bool = False) -> AsyncIterator[None]: Context manager holding
+        a slot while the block runs.
+
+    Example:
+    ```python
+    scheduler = FairScheduler("generate_posts", capacity=16)
+    async with scheduler.admit(hash_secret(notion_key), cost=num_llm_calls):
+        posts = await generate(data)
+    ```
+    """
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int,
+        max_queue: int = 64,
+        max_queue_per_tenant: int = 8,
+        timeout: float = 30,
+    ) -> None:
+        """Initialize the scheduler.
+
+        Parameters:
+        - name (str): The endpoint, used as metric label.
+        - capacity (int): The maximum number of concurrent requests.
+        - max_queue (int, optional): The maximum number of waiting requests.
+            Defaults to 64.
+        - max_queue_per_tenant (int, optional): The maximum number of waiting
+            requests of a single tenant. Defaults to 8.
+        - timeout (float, optional): The seconds a request waits at most.
+            Defaults to 30.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+
+        self.name = name
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.timeout = timeout
+        self.running = 0
+        self._virtual_time = 0.0
+        self._finish: Dict[str, float] = {}
+        self._queue: List[Tuple[float, int, float, str, "asyncio.Future[None]"]] = []
+        self._queued: Counter[str] = Counter()
+        self._sequence = itertools.count()
+        # An exponentially weighted average, seeded with a typical LLM call.
+        self._service_time = 5.0
+
+    @property
+    def queued(self) -> int:
+        """The number of waiting requests."""
+        return sum(self._queued.values())
+
+    async def acquire(
+        self, tenant: str, cost: float = 1, weight: float = 1, background: bool = False
+    ) -> Callable[[], None]:
+        """Waits for a slot and returns the function releasing it.
+
+        Args:
+            tenant (str): The tenant, e.g. the hashed Notion key.
+            cost (float, optional): The work of the request, e.g. its LLM calls.
+                Defaults to 1.
+            weight (float, optional): The share of the tenant. Defaults to 1.
+            background (bool, optional): Whether the request is a background job,
+                which waits until admitted. Defaults to False.
+
+        Raises:
+            Overloaded: If the queue is full or the request waited too long.
+
+        Returns:
+            Callable[[], None]: Releases the slot, calling it again does nothing.
+        """
+        start, finish = self._tags(tenant, cost, weight)
+
+        if self.running < self.capacity and not self.queued:
+            self._charge(tenant, start, finish)
+            self.running += 1
+            return self._releaser()
+
+        if not background and self.queued >= self.max_queue:
+            raise self._reject("queue_full", 503)
+        if not background and self._queued[tenant] >= self.max_queue_per_tenant:
+            raise self._reject("tenant_queue_full", 429)
+
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._queue, (finish, next(self._sequence), start, tenant, future)
+        )
+        self._finish[tenant] = finish
+        self._queued[tenant] += 1
+        ADMISSION_QUEUED.set(self.queued, endpoint=self.name)
+
+        waited = time.monotonic()
+        try:
+            await asyncio.wait_for(future, None if background else self.timeout)
+        except asyncio.TimeoutError:
+            self._dequeue(tenant)
+            raise self._reject("timeout", 503) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted while being cancelled, the slot goes to the next one.
+                self._release()
+            else:
+                self._dequeue(tenant)
+            raise
+        finally:
+            ADMISSION_WAIT.observe(time.monotonic() - waited, endpoint=self.name)
+
+        return self._releaser()
+
+    @asynccontextmanager
+    async def admit(
+        self, tenant: str, cost: float = 1, weight: float = 1, background: bool = False
+    ) -> AsyncIterator[None]:
+        """Holds a slot while the block runs.
+
+        Args:
+            tenant (str): The tenant, e.g. the hashed Notion key.
+            cost (float, optional): The work of the request, e.g. its LLM calls.
+                Defaults to 1.
+            weight (float, optional): The share of the tenant. Defaults to 1.
+            background (bool, optional): Whether the request is a background job,
+                which waits until admitted. Defaults to False.
+
+        Raises:
+            Overloaded: If the queue is full or the request waited too long.
+        """
+        release = await self.acquire(tenant, cost, weight, background)
+        try:
+            yield
+        finally:
+            release()
+
+    def _tags(self, tenant: str, cost: float, weight: float) -> Tuple[float, float]:
+        start = max(self._virtual_time, self._finish.get(tenant, 0.0))
+        return start, start + cost / weight
+
+    def _charge(self, tenant: str, start: float, finish: float) -> None:
+        self._finish[tenant] = finish
+        self._virtual_time = max(self._virtual_time, start)
+        if len(self._finish) > IDLE_TENANTS_KEPT:
+            self._finish = {
+                tenant: finish
+                for tenant, finish in self._finish.items()
+                if finish > self._virtual_time or self._queued[tenant]
+            }
+
+    def _releaser(self) -> Callable[[], None]:
+        started = time.monotonic()
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            duration = time.monotonic() - started
+            self._service_time += 0.2 * (duration - self._service_time)
+            self._release()
+
+        return release
+
+    def _release(self) -> None:
+        self.running -= 1
+        while self._queue and self.running < self.capacity:
+            _, _, start, tenant, future = heapq.heappop(self._queue)
+            if future.cancelled():
+                continue
+            self._dequeue(tenant)
+            self._virtual_time = max(self._virtual_time, start)
+            self.running += 1
+            future.set_result(None)
+        ADMISSION_QUEUED.set(self.queued, endpoint=self.name)
+
+    def _dequeue(self, tenant: str) -> None:
+        self._queued[tenant] -= 1
+        if not self._queued[tenant]:
+            del self._queued[tenant]
+        ADMISSION_QUEUED.set(self.queued, endpoint=self.name)
+
+    def _reject(self, reason: str, status: int) -> Overloaded:
+        ADMISSION_REJECTIONS.inc(endpoint=self.name, reason=reason)
+        retry_after = math.ceil(self._service_time * (self.queued + 1) / self.capacity)
+        return Overloaded(
+            f"{self.name} is overloaded ({reason.replace('_', ' ')})",
+            status,
+            max(1, retry_after),
+        )
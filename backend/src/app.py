@@ -1,22 +1,196 @@
+import asyncio
+import json
+import math
 import os
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+    Union,
+)
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from langchain import PromptTemplate
-from notion_client import Client
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from notion_client import AsyncClient
+from starlette.background import BackgroundTask
 
 from src import prompts
-from src.data_models import GeneratePosts, GetTemplates, TemplateCreate
-from src.llm import LLM
-from src.notion_database import NotionDatabase
+from src.admission import FairScheduler, Overloaded
+from src.cache import LRUCache, ResultCache
+from src.data_models import (
+    GeneratePosts,
+    GetTemplates,
+    SearchTemplates,
+    TemplateCreate,
+    TemplatesCreate,
+)
+from src.disconnect import ClientDisconnected, cancel_on_disconnect
+from src.idempotency import IdempotencyConflict, IdempotencyStore
+from src.jobs import JobManager, ProgressCallback
+from src.llm import LLM, supports_json_mode
+from src.metrics import CLIENT_DISCONNECTS, MetricsMiddleware, registry
+from src.notion_database import (
+    InvalidCursor,
+    NotionDatabase,
+    PageQueue,
+    mirror_offset,
+)
+from src.pool import ResourcePool, hash_secret
+from src.profiling import SlowRequestProfiler
+from src.rate_limiter import RateLimiter
+from src.similarity_cache import SimilarityCache
+from src.single_flight import SingleFlight
+from src.template_mirror import TemplateMirror
+from src.tracing import FileSpanExporter, OTLPSpanExporter, TracingMiddleware, tracer
+from src.write_behind import WriteBehindQueue
 
 load_dotenv()
 
 FRONTEND_ENDPOINT = os.getenv("FRONTEND_ENDPOINT")
+NOTION_BASE_URL = os.getenv("NOTION_BASE_URL", "https://api.notion.com")
+NOTION_MAX_CONCURRENCY = int(os.getenv("NOTION_MAX_CONCURRENCY", "3"))
+POSTS_PER_LLM_CALL = int(os.getenv("POSTS_PER_LLM_CALL", "5"))
+TEMPLATES_PER_LLM_CALL = int(os.getenv("TEMPLATES_PER_LLM_CALL", "5"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "4096"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH")
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 60 * 60)))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH")
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "256"))
+JOB_TENANT_QUEUE_SIZE = int(os.getenv("JOB_TENANT_QUEUE_SIZE", "8"))
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "64"))
+CLIENT_POOL_TTL = float(os.getenv("CLIENT_POOL_TTL", "900"))
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_RATE_BURST = float(os.getenv("NOTION_RATE_BURST", "3"))
+NOTION_RATE_LIMIT_PATH = os.getenv("NOTION_RATE_LIMIT_PATH")
+WRITE_BEHIND_PATH = os.getenv("WRITE_BEHIND_PATH")
+TEMPLATE_MIRROR_PATH = os.getenv("TEMPLATE_MIRROR_PATH")
+TEMPLATE_MIRROR_STALENESS = float(os.getenv("TEMPLATE_MIRROR_STALENESS", "30"))
+TEMPLATE_INDEX_CACHE_SIZE = int(os.getenv("TEMPLATE_INDEX_CACHE_SIZE", "256"))
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+TRACE_PATH = os.getenv("TRACE_PATH")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+PROFILE_THRESHOLD = os.getenv("PROFILE_THRESHOLD")
+PROFILE_PATH = os.getenv("PROFILE_PATH", "profiles")
+POST_CACHE_SIZE = int(os.getenv("POST_CACHE_SIZE", "0"))
+POST_CACHE_THRESHOLD = float(os.getenv("POST_CACHE_THRESHOLD", "0.9"))
+LLM_HEDGE_QUANTILE = os.getenv("LLM_HEDGE_QUANTILE")
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL")
+# Concurrent requests per endpoint, e.g. "generate_posts=8,create_template=16".
+ADMISSION_LIMITS = {"create_template": 32, "create_templates": 8, "generate_posts": 16}
+ADMISSION_LIMITS.update(
+    (endpoint, int(limit))
+    for endpoint, limit in (
+        item.split("=") for item in os.getenv("ADMISSION_LIMITS", "").split(",") if item
+    )
+)
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_TENANT_QUEUE_SIZE = int(os.getenv("ADMISSION_TENANT_QUEUE_SIZE", "8"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Whether generated posts are still written to Notion after the client left.
+PERSIST_ON_DISCONNECT = os.getenv("PERSIST_ON_DISCONNECT", "false").lower() == "true"
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "1024"))
+IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 60 * 60)))
 
-app = FastAPI(debug=False)
+PROMPT_TEMPLATES = {
+    "templatizing": prompts.templatizing_prompt,
+    "creating_posts": prompts.creating_posts_prompt,
+    "batch_templatizing": prompts.batch_templatizing_prompt,
+    "templatizing_json": prompts.templatizing_prompt + prompts.json_templatizing_format,
+    "creating_posts_json": prompts.creating_posts_prompt
+    + prompts.json_creating_posts_format,
+    "batch_templatizing_json": prompts.batch_templatizing_prompt
+    + prompts.json_batch_templatizing_format,
+}
+
+template_cache = LRUCache(maxsize=TEMPLATE_CACHE_SIZE)
+result_cache = ResultCache(
+    maxsize=RESULT_CACHE_SIZE, path=RESULT_CACHE_PATH, ttl=RESULT_CACHE_TTL
+)
+notion_clients: ResourcePool[AsyncClient] = ResourcePool(
+    maxsize=CLIENT_POOL_SIZE, ttl=CLIENT_POOL_TTL, close=lambda client: client.aclose()
+)
+llms: ResourcePool[LLM] = ResourcePool(
+    maxsize=CLIENT_POOL_SIZE, ttl=CLIENT_POOL_TTL, close=lambda llm: llm.aclose()
+)
+template_indexes = LRUCache(maxsize=TEMPLATE_INDEX_CACHE_SIZE)
+post_cache = (
+    SimilarityCache(maxsize=POST_CACHE_SIZE, threshold=POST_CACHE_THRESHOLD)
+    if POST_CACHE_SIZE
+    else None
+)
+template_mirror = TemplateMirror(
+    path=TEMPLATE_MIRROR_PATH, max_staleness=TEMPLATE_MIRROR_STALENESS
+)
+notion_rate_limiter = RateLimiter(
+    rate=NOTION_RATE_LIMIT, burst=NOTION_RATE_BURST, path=NOTION_RATE_LIMIT_PATH
+)
+single_flight = SingleFlight()
+admission = {
+    endpoint: FairScheduler(
+        endpoint,
+        capacity=limit,
+        max_queue=ADMISSION_QUEUE_SIZE,
+        max_queue_per_tenant=ADMISSION_TENANT_QUEUE_SIZE,
+        timeout=ADMISSION_QUEUE_TIMEOUT,
+    )
+    for endpoint, limit in ADMISSION_LIMITS.items()
+}
+idempotency = IdempotencyStore(
+    ResultCache(
+        maxsize=IDEMPOTENCY_CACHE_SIZE, path=IDEMPOTENCY_PATH, ttl=IDEMPOTENCY_TTL
+    )
+)
+if TRACE_OTLP_ENDPOINT:
+    tracer.configure(OTLPSpanExporter(TRACE_OTLP_ENDPOINT), TRACE_SAMPLE_RATE)
+elif TRACE_PATH:
+    tracer.configure(FileSpanExporter(TRACE_PATH), TRACE_SAMPLE_RATE)
+profiler = (
+    SlowRequestProfiler(float(PROFILE_THRESHOLD), PROFILE_PATH)
+    if PROFILE_THRESHOLD
+    else None
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    await write_behind.start()
+    await jobs.start()
+    yield
+    await jobs.stop()
+    await write_behind.stop()
+    await notion_clients.aclose()
+    await llms.aclose()
+    result_cache.close()
+    idempotency.results.close()
+    notion_rate_limiter.close()
+    template_mirror.close()
+    tracer.close()
+    if profiler is not None:
+        profiler.close()
+
+
+app = FastAPI(debug=False, lifespan=lifespan)
 
 origins = ["http://localhost:3000", "localhost:3000", FRONTEND_ENDPOINT]
 
@@ -28,22 +202,149 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware, profiler=profiler)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Any, error: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        status_code=error.status,
+        content={"detail": str(error)},
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+@app.exception_handler(InvalidCursor)
+async def invalid_cursor(request: Any, error: InvalidCursor) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"detail": str(error)})
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Any, error: ClientDisconnected) -> Response:
+    # Never delivered, the status only shows up in the logs and metrics.
+    return Response(status_code=499)
+
+
+def _pooled_notion(notion_key: str) -> AsyncContextManager[AsyncClient]:
+    return notion_clients.acquire(
+        hash_secret(notion_key),
+        lambda: AsyncClient(auth=notion_key, base_url=NOTION_BASE_URL),
+    )
+
+
+def _pooled_llm(
+    openai_key: str,
+    model: str,
+    prompt_name: str,
+    temperature: float = 0,
+    json_mode: bool = False,
+) -> AsyncContextManager[LLM]:
+    if json_mode:
+        prompt_name = f"{prompt_name}_json"
+
+    return llms.acquire(
+        (hash_secret(openai_key), model, temperature, prompt_name),
+        lambda: LLM(
+            openai_api_key=openai_key,
+            temperature=temperature,
+            model_name=model,
+            prompt_template=PROMPT_TEMPLATES[prompt_name],
+            json_mode=json_mode,
+            backend=LLM_BACKEND,
+            base_url=OPENAI_API_BASE,
+            hedge_quantile=float(LLM_HEDGE_QUANTILE) if LLM_HEDGE_QUANTILE else None,
+            hedge_min_delay=LLM_HEDGE_MIN_DELAY,
+            fallback_model=LLM_FALLBACK_MODEL,
+        ),
+    )
 
 
 @app.post("/create_template")
-async def create_template(data: TemplateCreate):
-    notion = Client(auth=data.notionKey)
-    prompt_template = PromptTemplate.from_template(template=prompts.templatizing_prompt)
-
-    llm = LLM(
-        openai_api_key=data.openaiKey,
-        temperature=0,
-        model_name=data.model,
-        prompt_template=prompt_template,
+async def create_template(
+    data: TemplateCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
+):
+    _check_write_behind(data.writeBehind)
+
+    async def run() -> Any:
+        if data.background:
+            return await _submit_job("create_template", data)
+
+        async with _admit("create_template", data.notionKey):
+            return await _create_template(data)
+
+    return await _idempotent(
+        "create_template", request, data.notionKey, idempotency_key, data, run
     )
-    notion_db = NotionDatabase(notion, llm)
 
-    response = notion_db.create_template(data)
+
+async def _create_template(data: TemplateCreate) -> Dict[str, str]:
+    async with _pooled_notion(data.notionKey) as notion, _pooled_llm(
+        data.openaiKey,
+        data.model,
+        "templatizing",
+        json_mode=supports_json_mode(data.model),
+    ) as llm:
+        notion_db = NotionDatabase(
+            notion,
+            llm,
+            result_cache=result_cache,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            template_mirror=template_mirror,
+            write_behind=_page_queue(data.notionKey) if data.writeBehind else None,
+            single_flight=single_flight,
+        )
+
+        response = await notion_db.create_template(data)
+
+    return response
+
+
+@app.post("/create_templates")
+async def create_templates(
+    data: TemplatesCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
+):
+    return await _idempotent(
+        "create_templates",
+        request,
+        data.notionKey,
+        idempotency_key,
+        data,
+        lambda: _run_create_templates(data),
+    )
+
+
+async def _run_create_templates(data: TemplatesCreate) -> Dict[str, Any]:
+    llm_calls = math.ceil(len(data.texts) / TEMPLATES_PER_LLM_CALL)
+    async with _admit("create_templates", data.notionKey, llm_calls):
+        return await _create_templates(data)
+
+
+async def _create_templates(data: TemplatesCreate) -> Dict[str, Any]:
+    async with _pooled_notion(data.notionKey) as notion, _pooled_llm(
+        data.openaiKey,
+        data.model,
+        "batch_templatizing",
+        json_mode=supports_json_mode(data.model),
+    ) as llm:
+        notion_db = NotionDatabase(
+            notion,
+            llm,
+            NOTION_MAX_CONCURRENCY,
+            result_cache=result_cache,
+            max_llm_concurrency=LLM_MAX_CONCURRENCY,
+            templates_per_llm_call=TEMPLATES_PER_LLM_CALL,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            template_mirror=template_mirror,
+        )
+
+        response = await notion_db.create_templates(data)
 
     return response
 
@@ -52,11 +353,59 @@ async def create_template(data: TemplateCreate):
     "/get_templates",
 )
 async def get_templates(data: GetTemplates):
-    notion = Client(auth=data.notionKey)
+    # Checked before streaming, errors of a started stream cannot change its status.
+    mirror_offset(data.cursor)
+    if data.stream:
+        return StreamingResponse(
+            _stream_templates(data), media_type="application/x-ndjson"
+        )
 
-    notion_db = NotionDatabase(notion)
+    async with _pooled_notion(data.notionKey) as notion:
+        notion_db = NotionDatabase(
+            notion,
+            max_concurrency=NOTION_MAX_CONCURRENCY,
+            template_cache=template_cache,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            template_mirror=template_mirror,
+            single_flight=single_flight,
+        )
 
-    response = notion_db.get_templates(data)
+        response = await notion_db.get_templates(data)
+
+    return response
+
+
+async def _stream_templates(data: GetTemplates) -> AsyncIterator[str]:
+    async with _pooled_notion(data.notionKey) as notion:
+        notion_db = NotionDatabase(
+            notion,
+            max_concurrency=NOTION_MAX_CONCURRENCY,
+            template_cache=template_cache,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            template_mirror=template_mirror,
+        )
+
+        async for template in notion_db.stream_templates(data):
+            yield json.dumps(template) + "\n"
+
+
+@app.post("/search_templates")
+async def search_templates(data: SearchTemplates):
+    async with _pooled_notion(data.notionKey) as notion:
+        notion_db = NotionDatabase(
+            notion,
+            max_concurrency=NOTION_MAX_CONCURRENCY,
+            template_cache=template_cache,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            template_mirror=template_mirror,
+            template_indexes=template_indexes,
+            single_flight=single_flight,
+        )
+
+        response = await notion_db.search_templates(data)
 
     return response
 
@@ -64,23 +413,241 @@ async def get_templates(data: GetTemplates):
 @app.post(
     "/generate_posts",
 )
-async def generate_posts(data: GeneratePosts):
-    notion = Client(auth=data.notionKey)
-    prompt_template = PromptTemplate.from_template(
-        template=prompts.creating_posts_prompt
-    )
+async def generate_posts(
+    data: GeneratePosts,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
+):
+    _check_write_behind(data.writeBehind)
+    llm_calls = math.ceil(data.numPosts / POSTS_PER_LLM_CALL)
+    if data.stream:
+        release = await _acquire("generate_posts", data.notionKey, llm_calls)
+        # Streamed responses are not stored, retries run again. The slot is held
+        # until the stream ends, also if the client leaves before it started.
+        return StreamingResponse(
+            _stream_posts(data, release),
+            media_type="application/x-ndjson",
+            background=BackgroundTask(release),
+        )
+
+    async def run() -> Any:
+        if data.background:
+            return await _submit_job("generate_posts", data)
+
+        async with _admit("generate_posts", data.notionKey, llm_calls):
+            return await _generate_posts(data)
 
-    llm = LLM(
-        openai_api_key=data.openaiKey,
-        temperature=0,
-        model_name=data.model,
-        prompt_template=prompt_template,
+    return await _idempotent(
+        "generate_posts", request, data.notionKey, idempotency_key, data, run
     )
-    notion_db = NotionDatabase(notion, llm)
-    response = notion_db.generate_posts(data)
+
+
+async def _generate_posts(
+    data: GeneratePosts, on_progress: Optional[ProgressCallback] = None
+) -> Any:
+    async with _pooled_notion(data.notionKey) as notion, _pooled_llm(
+        data.openaiKey,
+        data.model,
+        "creating_posts",
+        json_mode=supports_json_mode(data.model),
+    ) as llm:
+        notion_db = NotionDatabase(
+            notion,
+            llm,
+            NOTION_MAX_CONCURRENCY,
+            posts_per_llm_call=POSTS_PER_LLM_CALL,
+            max_llm_concurrency=LLM_MAX_CONCURRENCY,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            write_behind=_page_queue(data.notionKey) if data.writeBehind else None,
+            post_cache=post_cache,
+            persist_on_cancel=PERSIST_ON_DISCONNECT,
+        )
+        response = await notion_db.generate_posts(data, on_progress)
 
     return response
 
 
+async def _stream_posts(
+    data: GeneratePosts, release: Callable[[], None]
+) -> AsyncIterator[str]:
+    try:
+        async for line in _stream_generated_posts(data):
+            yield line
+    except asyncio.CancelledError:
+        # Starlette cancels the stream when the client disconnects.
+        CLIENT_DISCONNECTS.inc(endpoint="generate_posts")
+        raise
+    finally:
+        release()
+
+
+async def _stream_generated_posts(data: GeneratePosts) -> AsyncIterator[str]:
+    # No JSON mode: its wrapper object would hold back every post until the end.
+    async with _pooled_notion(data.notionKey) as notion, _pooled_llm(
+        data.openaiKey, data.model, "creating_posts"
+    ) as llm:
+        notion_db = NotionDatabase(
+            notion,
+            llm,
+            NOTION_MAX_CONCURRENCY,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(data.notionKey),
+            persist_on_cancel=PERSIST_ON_DISCONNECT,
+        )
+
+        async for post in notion_db.stream_posts(data):
+            yield json.dumps(post) + "\n"
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def _admit(
+    endpoint: str, notion_key: str, cost: float = 1, background: bool = False
+) -> AsyncContextManager[None]:
+    # Tenants are integrations, as for the Notion rate limit.
+    return admission[endpoint].admit(
+        hash_secret(notion_key), cost, background=background
+    )
+
+
+async def _acquire(
+    endpoint: str, notion_key: str, cost: float = 1
+) -> Callable[[], None]:
+    return await admission[endpoint].acquire(hash_secret(notion_key), cost)
+
+
+async def _idempotent(
+    endpoint: str,
+    request: Request,
+    notion_key: str,
+    idempotency_key: Optional[str],
+    data: Any,
+    run: Callable[[], Awaitable[Any]],
+) -> Any:
+    if idempotency_key is None:
+        return await cancel_on_disconnect(endpoint, request.receive, run)
+    if not 0 < len(idempotency_key) <= 255:
+        raise HTTPException(
+            status_code=400, detail="Idempotency-Key must have 1 to 255 characters"
+        )
+
+    # Scoped by the integration, so clients cannot read each other's responses.
+    key = ResultCache.make_key(endpoint, hash_secret(notion_key), idempotency_key)
+    fingerprint = ResultCache.make_key(
+        json.dumps(jsonable_encoder(data), sort_keys=True)
+    )
+
+    async def execute() -> Dict[str, Any]:
+        response = await run()
+        if isinstance(response, JSONResponse):
+            return {
+                "status": response.status_code,
+                "content": json.loads(response.body),
+            }
+        return {"status": 200, "content": jsonable_encoder(response)}
+
+    # Keeps running after a disconnect, so the client's retry gets the response.
+    try:
+        stored, replayed = await idempotency.run(key, fingerprint, execute)
+    except IdempotencyConflict as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+
+    return JSONResponse(
+        stored["content"],
+        status_code=stored["status"],
+        headers={"Idempotent-Replayed": "true"} if replayed else None,
+    )
+
+
+async def _submit_job(
+    kind: str, data: Union[GeneratePosts, TemplateCreate]
+) -> JSONResponse:
+    job_id = await jobs.submit(
+        kind, jsonable_encoder(data), tenant=hash_secret(data.notionKey)
+    )
+
+    return JSONResponse(status_code=202, content={"jobId": job_id, "status": "queued"})
+
+
+async def _create_template_job(
+    payload: Dict[str, Any], on_progress: ProgressCallback
+) -> Dict[str, str]:
+    data = TemplateCreate(**payload)
+    async with _admit("create_template", data.notionKey, background=True):
+        return await _create_template(data)
+
+
+async def _generate_posts_job(
+    payload: Dict[str, Any], on_progress: ProgressCallback
+) -> Any:
+    data = GeneratePosts(**payload)
+    llm_calls = math.ceil(data.numPosts / POSTS_PER_LLM_CALL)
+    async with _admit("generate_posts", data.notionKey, llm_calls, background=True):
+        return await _generate_posts(data, on_progress)
+
+
+def _check_write_behind(requested: bool) -> None:
+    # Queued pages are only answered as written if they survive a restart.
+    if requested and not write_behind.durable:
+        raise HTTPException(
+            status_code=400, detail="writeBehind requires WRITE_BEHIND_PATH to be set"
+        )
+
+
+def _page_queue(notion_key: str) -> PageQueue:
+    async def enqueue(database_id: str, record: Dict[str, str], status: str) -> str:
+        return await write_behind.enqueue(
+            database_id,
+            {
+                "notionKey": notion_key,
+                "databaseId": database_id,
+                "record": record,
+                "status": status,
+            },
+        )
+
+    return enqueue
+
+
+async def _write_page(entry: Dict[str, Any]) -> None:
+    async with _pooled_notion(entry["notionKey"]) as notion:
+        notion_db = NotionDatabase(
+            notion,
+            rate_limiter=notion_rate_limiter,
+            rate_limit_key=hash_secret(entry["notionKey"]),
+            template_mirror=template_mirror,
+        )
+        await notion_db.create_page(
+            entry["record"], entry["databaseId"], entry["status"]
+        )
+
+
+write_behind = WriteBehindQueue(_write_page, path=WRITE_BEHIND_PATH)
+
+jobs = JobManager(
+    {"create_template": _create_template_job, "generate_posts": _generate_posts_job},
+    workers=JOB_WORKERS,
+    path=JOBS_DB_PATH,
+    max_pending=JOB_QUEUE_SIZE,
+    max_pending_per_tenant=JOB_TENANT_QUEUE_SIZE,
+)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """This class implements a bounded in-memory least recently used cache.
+
+    Parameters:
+    - maxsize (int, optional): The maximum number of entries kept in the cache.
+        Defaults to 1024.
+
+    Methods:
+    - get(key: Hashable, default: Any = None) -> Any: Returns the cached value and
+        marks it as recently used.
+    - set(key: Hashable, value: Any) -> None: Stores a value and evicts the least
+        recently used entry when the cache is full.
+    - clear() -> None: Removes all entries.
+
+    Example:
+    ```python
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.get("a")  # 1
+    ```
+    """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        """Initialize the LRU cache.
+
+        Parameters:
+        - maxsize (int, optional): The maximum number of entries kept in the cache.
+            Defaults to 1024.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        """Returns the number of cached entries."""
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Returns whether the key is cached without touching its recency."""
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """Returns the cached value and marks it as recently used.
+
+        Args:
+            key (Hashable): The cache key.
+            default (Any, optional): The value returned on a miss. Defaults to None.
+
+        Returns:
+            Any: The cached value or the default.
+        """
+        if key not in self._entries:
+            return default
+
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Stores a value and evicts the least recently used entry when full.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The value to cache.
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes all entries."""
+        self._entries.clear()
+
+
+class ResultCache:
+    """This class caches JSON serializable results of expensive calls, e.g. LLM
+    completions, under content addressed keys.
+
+    Lookups go to a bounded in-memory LRU tier first and fall back to an optional
+    SQLite tier, which survives restarts and is shared by worker processes. Every
+    write to the SQLite tier deletes its expired rows and then its oldest rows
+    beyond `maxsize`. Values are stored as JSON, so callers always get a fresh
+    copy they may mutate.
+
+    Parameters:
+    - maxsize (int, optional): The number of entries kept in memory and in the
+        SQLite tier. Defaults to 1024.
+    - path (str, optional): The SQLite database file of the persistent tier.
+        Defaults to None, which disables the persistent tier.
+    - ttl (float, optional): The number of seconds an entry stays valid.
+        Defaults to 7 days.
+    - clock (Callable[[], float], optional): The time source. Defaults to
+        `time.time`.
+
+    Attributes:
+    - hits (int): The number of lookups answered from the cache.
+    - misses (int): The number of lookups that found nothing.
+
+    Methods:
+    - make_key(*parts: str) -> str: Builds a content addressed key.
+    - get(key: str) -> Any: Returns the cached value or None.
+    - set(key: str, value: Any) -> None: Stores a value in every tier.
+    - close() -> None: Closes the persistent tier.
+
+    Example:
+    ```python
+    cache = ResultCache(path="results.sqlite3")
+    key = ResultCache.make_key("gpt-4", prompt_version, text)
+    if (template := cache.get(key)) is None:
+        template = await generate(text)
+        cache.set(key, template)
+    ```
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        path: Optional[str] = None,
+        ttl: float = 7 * 24 * 60 * 60,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """Initialize the result cache.
+
+        Parameters:
+        - maxsize (int, optional): The number of entries kept in memory and in
+            the SQLite tier. Defaults to 1024.
+        - path (str, optional): The SQLite database file of the persistent tier.
+            Defaults to None, which disables the persistent tier.
+        - ttl (float, optional): The number of seconds an entry stays valid.
+            Defaults to 7 days.
+        - clock (Callable[[], float], optional): The time source. Defaults to
+            `time.time`.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._memory = LRUCache(maxsize=maxsize)
+        self._connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)"
+            )
+            self._purge()
+            self._connection.commit()
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Builds a content addressed key from the given parts.
+
+        Args:
+            *parts (str): The values identifying the result.
+
+        Returns:
+            str: The hex encoded SHA-256 digest of the parts.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            encoded = part.encode("utf-8")
+            digest.update(len(encoded).to_bytes(8, "big"))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Any:
+        """Returns the cached value or None.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Any: A copy of the cached value, or None on a miss.
+        """
+        now = self._clock()
+        entry = self._memory.get(key)
+
+        if entry is None and self._connection is not None:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                entry = row
+                self._memory.set(key, entry)
+
+        if entry is None or now - entry[1] >= self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(entry[0])
+
+    def set(self, key: str, value: Any) -> None:
+        """Stores a value in every tier.
+
+        Args:
+            key (str): The cache key.
+            value (Any): The JSON serializable value.
+        """
+        entry = (json.dumps(value), self._clock())
+        self._memory.set(key, entry)
+
+        if self._connection is not None:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, created_at) "
+                "VALUES (?, ?, ?)",
+                (key, *entry),
+            )
+            self._purge()
+            self._connection.commit()
+
+    def close(self) -> None:
+        """Closes the persistent tier."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _purge(self) -> None:
+        self._connection.execute(
+            "DELETE FROM results WHERE created_at <= ?", (self._clock() - self.ttl,)
+        )
+        self._connection.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results "
+            "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
@@ -1,6 +1,6 @@
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class TemplateCreate(BaseModel):
@@ -10,6 +10,20 @@ class TemplateCreate(BaseModel):
     model: str
     databaseId: Optional[str] = None
     pageId: Optional[str] = None
+    bypassCache: bool = False
+    background: bool = False
+    writeBehind: bool = False
+
+
+class TemplatesCreate(BaseModel):
+    notionKey: str
+    openaiKey: str
+    # Bounds the LLM calls a single request fans out to.
+    texts: List[str] = Field(min_length=1, max_length=100)
+    model: str
+    databaseId: Optional[str] = None
+    pageId: Optional[str] = None
+    bypassCache: bool = False
 
 
 class GeneratePosts(BaseModel):
@@ -17,11 +31,26 @@ class GeneratePosts(BaseModel):
     openaiKey: str
     databaseId: str
     templateText: str
-    numPosts: int
+    # Bounds the LLM calls a single request fans out to.
+    numPosts: int = Field(ge=1, le=100)
     model: str
     topics: str
+    bypassCache: bool = False
+    stream: bool = False
+    background: bool = False
+    writeBehind: bool = False
 
 
 class GetTemplates(BaseModel):
     notionKey: str
     databaseId: str
+    pageSize: Optional[int] = Field(default=None, ge=1, le=100)
+    cursor: Optional[str] = None
+    stream: bool = False
+
+
+class SearchTemplates(BaseModel):
+    notionKey: str
+    databaseId: str
+    query: str
+    topK: int = Field(default=5, ge=1, le=50)
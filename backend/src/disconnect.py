@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+from src.metrics import CLIENT_DISCONNECTS
+
+T = TypeVar("T")
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client of a request disconnected before its response."""
+
+
+async def cancel_on_disconnect(
+    endpoint: str,
+    receive: Callable[[], Awaitable[Dict[str, Any]]],
+    work: Callable[[], Awaitable[T]],
+) -> T:
+    """Runs the work of a request and cancels it once the client disconnects.
+
+    Starlette only notices a disconnect when it sends the response, so without
+    this the LLM and Notion calls of an abandoned request run to the end. The
+    request body must have been read, afterwards the ASGI server only sends
+    `http.disconnect` on the receive channel.
+
+    Args:
+        endpoint (str): The endpoint, used as metric label.
+        receive (Callable[[], Awaitable[Dict[str, Any]]]): The ASGI receive
+            channel of the request.
+        work (Callable[[], Awaitable[T]]): Starts the work.
+
+    Raises:
+        ClientDisconnected: If the client disconnected before the work finished.
+
+    Returns:
+        T: The result of the work.
+    """
+    task = asyncio.ensure_future(work())
+    listener = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait((task, listener), return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+    finally:
+        listener.cancel()
+        if not task.done():
+            task.cancel()
+            # Lets the work unwind, e.g. release its admission slot, first.
+            await asyncio.wait((task,))
+            # Retrieved here, so an error raised while unwinding is not logged.
+            task.cancelled() or task.exception()
+
+    CLIENT_DISCONNECTS.inc(endpoint=endpoint)
+    raise ClientDisconnected(f"The client of {endpoint} disconnected")
+
+
+async def _wait_for_disconnect(
+    receive: Callable[[], Awaitable[Dict[str, Any]]],
+) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
@@ -0,0 +1,131 @@
+import asyncio
+import collections
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """This class keeps the latest latencies per key, e.g. per model and prompt,
+    and returns their quantiles.
+
+    Parameters:
+    - window (int, optional): The number of latencies kept per key.
+        Defaults to 200.
+    - min_samples (int, optional): The number of latencies needed before a
+        quantile is returned. Defaults to 20.
+
+    Methods:
+    - observe(key: Hashable, seconds: float) -> None: Records a latency.
+    - quantile(key: Hashable, quantile: float) -> Optional[float]: Returns a
+        quantile of the recorded latencies.
+
+    Example:
+    ```python
+    latencies = LatencyTracker()
+    latencies.observe("gpt-4", 8.2)
+    latencies.quantile("gpt-4", 0.95)
+    ```
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20) -> None:
+        """Initialize the latency tracker.
+
+        Parameters:
+        - window (int, optional): The number of latencies kept per key.
+            Defaults to 200.
+        - min_samples (int, optional): The number of latencies needed before a
+            quantile is returned. Defaults to 20.
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: Dict[Hashable, Deque[float]] = {}
+
+    def observe(self, key: Hashable, seconds: float) -> None:
+        """Records a latency, replacing the oldest one of a full window.
+
+        Args:
+            key (Hashable): The key, e.g. the model name.
+            seconds (float): The latency in seconds.
+        """
+        latencies = self._latencies.get(key)
+        if latencies is None:
+            latencies = self._latencies[key] = collections.deque(maxlen=self.window)
+        latencies.append(seconds)
+
+    def quantile(self, key: Hashable, quantile: float) -> Optional[float]:
+        """Returns a quantile of the recorded latencies of a key.
+
+        Args:
+            key (Hashable): The key, e.g. the model name.
+            quantile (float): The quantile between 0 and 1, e.g. 0.95.
+
+        Returns:
+            Optional[float]: The nearest-rank quantile in seconds, None if fewer
+                than `min_samples` latencies were recorded.
+        """
+        latencies = self._latencies.get(key)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+
+        ordered = sorted(latencies)
+        rank = max(1, -(-len(ordered) * quantile // 1))
+        return ordered[min(len(ordered), int(rank)) - 1]
+
+
+async def hedge(
+    primary: Callable[[], Awaitable[T]],
+    backup: Callable[[], Awaitable[T]],
+    delay: Optional[float],
+) -> Tuple[T, bool]:
+    """Runs a call and, if it did not finish within a delay, a backup call, and
+    returns the first successful result.
+
+    The slower call is cancelled. A call failing does not fail the other one, the
+    primary call's error is raised once both failed.
+
+    Args:
+        primary (Callable[[], Awaitable[T]]): Starts the primary call.
+        backup (Callable[[], Awaitable[T]]): Starts the backup call.
+        delay (Optional[float]): The seconds the primary call gets on its own,
+            None never starts the backup call.
+
+    Returns:
+        Tuple[T, bool]: The result and whether it is the backup call's.
+    """
+    if delay is None:
+        return await primary(), False
+
+    first = asyncio.ensure_future(primary())
+    tasks: List["asyncio.Future[Any]"] = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if first in done:
+            return first.result(), False
+
+        tasks.append(asyncio.ensure_future(backup()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            # The primary call wins a tie.
+            for task in tasks:
+                if task in done and task.exception() is None:
+                    return task.result(), task is not first
+        raise first.exception()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,100 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from src.cache import ResultCache
+from src.metrics import IDEMPOTENT_REQUESTS
+
+
+class IdempotencyConflict(ValueError):
+    """Raised when an idempotency key is reused for a different request."""
+
+
+class IdempotencyStore:
+    """This class runs every request carrying an idempotency key at most once and
+    remembers its response.
+
+    A retry arriving while the original request still runs waits for it, a later
+    retry gets the stored response. The original request runs in its own task, so
+    it finishes and stores its response even when its client disconnected. Failed
+    requests are not stored, their retries run again. Running requests are only
+    known to the process executing them, the stored responses are shared through
+    the persistent tier of the result cache.
+
+    Parameters:
+    - results (ResultCache): Stores the responses, bounded in size and age.
+
+    Methods:
+    - run(key: str, fingerprint: str, function: Callable[[], Awaitable[Any]])
+        -> Tuple[Any, bool]: Returns the response of the request, running it
+        unless it ran before, and whether it was replayed.
+
+    Example:
+    ```python
+    store = IdempotencyStore(ResultCache(maxsize=1024, ttl=24 * 60 * 60))
+    response, replayed = await store.run(key, fingerprint, lambda: generate(data))
+    ```
+    """
+
+    def __init__(self, results: ResultCache) -> None:
+        """Initialize the idempotency store.
+
+        Parameters:
+        - results (ResultCache): Stores the responses, bounded in size and age.
+        """
+        self.results = results
+        self._running: Dict[str, Tuple[str, "asyncio.Future[Any]"]] = {}
+
+    async def run(
+        self, key: str, fingerprint: str, function: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """Returns the response of the request, running it unless it ran or runs
+        already.
+
+        Args:
+            key (str): Identifies the request across retries, scoped by the caller.
+            fingerprint (str): Identifies the payload of the request.
+            function (Callable[[], Awaitable[Any]]): Runs the request and returns
+                its JSON serializable response.
+
+        Raises:
+            IdempotencyConflict: If the key was used for a different payload.
+
+        Returns:
+            Tuple[Any, bool]: The response and whether it was replayed instead of
+                running the request.
+        """
+        running = self._running.get(key)
+        if running is None:
+            stored = self.results.get(key)
+            if stored is not None:
+                self._check(stored["fingerprint"], fingerprint)
+                IDEMPOTENT_REQUESTS.inc(outcome="replayed")
+                return stored["response"], True
+
+            task = asyncio.ensure_future(self._execute(key, fingerprint, function))
+            self._running[key] = (fingerprint, task)
+            # Retrieved here, so failures nobody waits for any more are not logged.
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            IDEMPOTENT_REQUESTS.inc(outcome="executed")
+            return await asyncio.shield(task), False
+
+        self._check(running[0], fingerprint)
+        IDEMPOTENT_REQUESTS.inc(outcome="joined")
+        return await asyncio.shield(running[1]), True
+
+    async def _execute(
+        self, key: str, fingerprint: str, function: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        try:
+            response = await function()
+            self.results.set(key, {"fingerprint": fingerprint, "response": response})
+            return response
+        finally:
+            del self._running[key]
+
+    @staticmethod
+    def _check(stored: str, fingerprint: str) -> None:
+        if stored != fingerprint:
+            raise IdempotencyConflict(
+                "The idempotency key was already used for a different request"
+            )
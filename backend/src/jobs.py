@@ -0,0 +1,278 @@
+import asyncio
+import json
+import logging
+import math
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from src.admission import Overloaded
+from src.metrics import ADMISSION_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+ProgressCallback = Callable[..., None]
+JobHandler = Callable[[Dict[str, Any], ProgressCallback], Awaitable[Any]]
+
+PENDING_STATUSES = ("queued", "running")
+
+
+class JobManager:
+    """This class runs long generations as background jobs on an in-process
+    worker pool.
+
+    Every job has a kind selecting its handler, a JSON serializable payload and
+    reports progress while it runs. With a `path`, jobs are also kept in SQLite and
+    unfinished jobs are queued again on start, so they survive restarts. The
+    payload is stored as well, so the database file has to be protected like the
+    API keys it contains. The unfinished jobs are bounded, in total and per tenant,
+    and further submissions are rejected with `Overloaded`.
+
+    Parameters:
+    - handlers (Dict[str, JobHandler]): The coroutine function of every job kind,
+        called with the payload and a progress callback.
+    - workers (int, optional): The number of concurrently running jobs.
+        Defaults to 4.
+    - path (str, optional): The SQLite database file. Defaults to None, which keeps
+        jobs in memory only.
+    - max_finished_jobs (int, optional): The number of finished jobs kept for
+        polling. Defaults to 1000.
+    - max_pending (int, optional): The maximum number of unfinished jobs.
+        Defaults to 256.
+    - max_pending_per_tenant (int, optional): The maximum number of unfinished
+        jobs of a single tenant. Defaults to 8.
+
+    Methods:
+    - start() -> None: Starts the workers and queues the unfinished jobs again.
+    - stop() -> None: Stops the workers.
+    - submit(kind: str, payload: Dict[str, Any], tenant: str = "") -> str: Queues
+        a job and returns its id.
+    - get(job_id: str) -> Optional[Dict[str, Any]]: Returns the public state of a
+        job.
+
+    Example:
+    ```python
+    async def generate(payload, report):
+        report(postsGenerated=5)
+        return ["post"]
+
+    jobs = JobManager({"generate_posts": generate})
+    job_id = await jobs.submit("generate_posts", {"topics": "AI"})
+    jobs.get(job_id)["status"]  # "queued"
+    ```
+    """
+
+    def __init__(
+        self,
+        handlers: Dict[str, JobHandler],
+        workers: int = 4,
+        path: Optional[str] = None,
+        max_finished_jobs: int = 1000,
+        max_pending: int = 256,
+        max_pending_per_tenant: int = 8,
+    ) -> None:
+        """Initialize the job manager.
+
+        Parameters:
+        - handlers (Dict[str, JobHandler]): The coroutine function of every job
+            kind, called with the payload and a progress callback.
+        - workers (int, optional): The number of concurrently running jobs.
+            Defaults to 4.
+        - path (str, optional): The SQLite database file. Defaults to None, which
+            keeps jobs in memory only.
+        - max_finished_jobs (int, optional): The number of finished jobs kept for
+            polling. Defaults to 1000.
+        - max_pending (int, optional): The maximum number of unfinished jobs.
+            Defaults to 256.
+        - max_pending_per_tenant (int, optional): The maximum number of
+            unfinished jobs of a single tenant. Defaults to 8.
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        self.handlers = handlers
+        self.workers = workers
+        self.max_finished_jobs = max_finished_jobs
+        self.max_pending = max_pending
+        self.max_pending_per_tenant = max_pending_per_tenant
+        # An exponentially weighted average, seeded with a typical generation.
+        self._job_time = 30.0
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs "
+                "(id TEXT PRIMARY KEY, created_at REAL NOT NULL, job TEXT NOT NULL)"
+            )
+            self._connection.commit()
+
+    async def start(self) -> None:
+        """Starts the workers and queues the unfinished jobs again."""
+        if self._tasks:
+            return
+
+        queue: asyncio.Queue = asyncio.Queue()
+        self._queue = queue
+        self._tasks = [
+            asyncio.ensure_future(self._work(queue)) for _ in range(self.workers)
+        ]
+
+        if not self._jobs:
+            for job in self._load_jobs():
+                self._jobs[job["id"]] = job
+
+        for job in self._jobs.values():
+            if job["status"] in PENDING_STATUSES:
+                self._update(job, status="queued")
+                queue.put_nowait(job["id"])
+
+    async def stop(self) -> None:
+        """Stops the workers, running jobs are queued again on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def submit(self, kind: str, payload: Dict[str, Any], tenant: str = "") -> str:
+        """Queues a job and returns its id.
+
+        Args:
+            kind (str): The job kind, a key of `handlers`.
+            payload (Dict[str, Any]): The JSON serializable input of the handler.
+            tenant (str, optional): The tenant, e.g. the hashed Notion key.
+                Defaults to "".
+
+        Raises:
+            Overloaded: If too many jobs, or jobs of the tenant, are unfinished.
+
+        Returns:
+            str: The job id.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        pending = [
+            job for job in self._jobs.values() if job["status"] in PENDING_STATUSES
+        ]
+        if len(pending) >= self.max_pending:
+            raise self._reject(kind, "job_queue_full", 503, len(pending))
+        if (
+            sum(job.get("tenant") == tenant for job in pending)
+            >= self.max_pending_per_tenant
+        ):
+            raise self._reject(kind, "tenant_job_queue_full", 429, len(pending))
+
+        await self.start()
+        queue = self._queue
+
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "tenant": tenant,
+            "status": "queued",
+            "payload": payload,
+            "progress": {},
+            "result": None,
+            "error": None,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        self._jobs[job["id"]] = job
+        self._save(job)
+        self._evict_finished_jobs()
+
+        if queue is not None:
+            queue.put_nowait(job["id"])
+
+        return job["id"]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the public state of a job, without its payload.
+
+        Args:
+            job_id (str): The job id.
+
+        Returns:
+            Optional[Dict[str, Any]]: The job state, or None for unknown jobs.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        return {
+            key: value for key, value in job.items() if key not in ("payload", "tenant")
+        }
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while True:
+            job = self._jobs.get(await queue.get())
+            if job is None:
+                continue
+
+            def report(**progress: Any) -> None:
+                self._update(job, progress={**job["progress"], **progress})
+
+            self._update(job, status="running")
+            started = time.monotonic()
+            try:
+                result = await self.handlers[job["kind"]](job["payload"], report)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.exception("Job %s failed", job["id"])
+                self._update(job, status="failed", error=str(error))
+            else:
+                self._update(job, status="succeeded", result=result)
+            self._job_time += 0.2 * (time.monotonic() - started - self._job_time)
+
+    def _reject(self, kind: str, reason: str, status: int, pending: int) -> Overloaded:
+        ADMISSION_REJECTIONS.inc(endpoint=kind, reason=reason)
+        retry_after = math.ceil(self._job_time * (pending + 1) / self.workers)
+        return Overloaded(
+            f"Too many {kind} jobs ({reason.replace('_', ' ')})",
+            status,
+            max(1, retry_after),
+        )
+
+    def _update(self, job: Dict[str, Any], **changes: Any) -> None:
+        job.update(changes, updatedAt=time.time())
+        self._save(job)
+
+    def _evict_finished_jobs(self) -> None:
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job["status"] not in PENDING_STATUSES
+        ]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self._connection.commit()
+
+    def _save(self, job: Dict[str, Any]) -> None:
+        if self._connection is None:
+            return
+
+        self._connection.execute(
+            "INSERT OR REPLACE INTO jobs (id, created_at, job) VALUES (?, ?, ?)",
+            (job["id"], job["createdAt"], json.dumps(job)),
+        )
+        self._connection.commit()
+
+    def _load_jobs(self) -> List[Dict[str, Any]]:
+        if self._connection is None:
+            return []
+
+        rows = self._connection.execute(
+            "SELECT job FROM jobs ORDER BY created_at"
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
@@ -1,77 +1,405 @@
-from typing import Any, Dict
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
 
-from langchain import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
+import httpx
+
+from src.hedging import LatencyTracker, hedge
+from src.metrics import (
+    LLM_CANCELLED_CALLS,
+    LLM_HEDGE_DELAY,
+    LLM_HEDGES,
+    LLM_IN_FLIGHT,
+    LLM_LATENCY,
+    LLM_TOKENS,
+)
+from src.rate_limiter import backoff_delay, retry_after
+from src.tracing import Span, tracer
+
+# Models accepting `response_format={"type": "json_object"}`.
+JSON_MODE_MODELS = (
+    "gpt-3.5-turbo-1106",
+    "gpt-3.5-turbo-0125",
+    "gpt-4-1106-preview",
+    "gpt-4-0125-preview",
+    "gpt-4-turbo",
+    "gpt-4o",
+)
+
+LLM_BACKENDS = ("openai", "langchain")
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# The statuses the OpenAI SDK retries as well.
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+
+Usage = Dict[str, int]
+
+# Shared by every LLM, so pooled instances learn the latencies together.
+llm_latencies = LatencyTracker()
+
+
+def supports_json_mode(model_name: str) -> bool:
+    """Returns whether the model supports OpenAI's JSON mode.
+
+    Args:
+        model_name (str): The name of the language model.
+
+    Returns:
+        bool: True if the model can be forced to answer with a JSON object.
+    """
+    return model_name.startswith(JSON_MODE_MODELS)
+
+
+class OpenAIError(Exception):
+    """Raised when the OpenAI-compatible API answers with an error.
+
+    Attributes:
+    - status (int): The HTTP status, 0 if the request did not get a response.
+    - headers (httpx.Headers): The response headers.
+    """
+
+    def __init__(
+        self, message: str, status: int = 0, headers: Optional[httpx.Headers] = None
+    ) -> None:
+        super().__init__(message)
+        self.status = status
+        self.headers = headers if headers is not None else httpx.Headers()
+
+
+class _OpenAIChat:
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        temperature: float,
+        json_mode: bool,
+        base_url: str,
+        timeout: float,
+        max_retries: int,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.body: Dict[str, Any] = {"model": model_name, "temperature": temperature}
+        if json_mode:
+            self.body["response_format"] = {"type": "json_object"}
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def complete(self, prompt: str) -> Tuple[str, Usage]:
+        if self._client is None:
+            self._client = httpx.Client(
+                base_url=self.base_url, headers=self.headers, timeout=self.timeout
+            )
+
+        attempt = 0
+        while True:
+            try:
+                with _transport_errors():
+                    response = self._client.post(
+                        "/chat/completions", json=self._body(prompt)
+                    )
+                return self._parse(_raise_for_status(response))
+            except OpenAIError as error:
+                if not self._retry(error, attempt):
+                    raise
+                time.sleep(backoff_delay(attempt, retry_after(error)))
+            attempt += 1
+
+    async def acomplete(self, prompt: str) -> Tuple[str, Usage]:
+        client = self._async()
+
+        attempt = 0
+        while True:
+            try:
+                with _transport_errors():
+                    response = await client.post(
+                        "/chat/completions", json=self._body(prompt)
+                    )
+                return self._parse(_raise_for_status(response))
+            except OpenAIError as error:
+                if not self._retry(error, attempt):
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, retry_after(error)))
+            attempt += 1
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        client = self._async()
+        request = client.build_request(
+            "POST", "/chat/completions", json=self._body(prompt, stream=True)
+        )
+
+        # Only the request is retried, a broken stream cannot be resumed.
+        attempt = 0
+        while True:
+            try:
+                with _transport_errors():
+                    response = await client.send(request, stream=True)
+                    if response.is_error:
+                        await response.aread()
+                _raise_for_status(response)
+                break
+            except OpenAIError as error:
+                if not self._retry(error, attempt):
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, retry_after(error)))
+            attempt += 1
+
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+        finally:
+            await response.aclose()
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def _async(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                base_url=self.base_url, headers=self.headers, timeout=self.timeout
+            )
+        return self._async_client
+
+    def _body(self, prompt: str, stream: bool = False) -> Dict[str, Any]:
+        body = {**self.body, "messages": [{"role": "user", "content": prompt}]}
+        if stream:
+            body["stream"] = True
+        return body
+
+    def _retry(self, error: OpenAIError, attempt: int) -> bool:
+        retryable = error.status == 0 or error.status in RETRYABLE_STATUSES
+        return retryable and attempt < self.max_retries
+
+    @staticmethod
+    def _parse(response: httpx.Response) -> Tuple[str, Usage]:
+        completion = response.json()
+        return (
+            completion["choices"][0]["message"]["content"] or "",
+            completion.get("usage") or {},
+        )
+
+
+class _LangChainChat:
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        temperature: float,
+        json_mode: bool,
+        base_url: str,
+        timeout: float,
+        max_retries: int,
+    ) -> None:
+        # Imported here, LangChain takes about a second to import.
+        from langchain.chat_models import ChatOpenAI
+        from langchain.schema import HumanMessage
+
+        options: Dict[str, Any] = {}
+        if json_mode:
+            options["model_kwargs"] = {"response_format": {"type": "json_object"}}
+
+        self._message = HumanMessage
+        self.llm = ChatOpenAI(
+            openai_api_key=api_key,
+            openai_api_base=base_url,
+            temperature=temperature,
+            model_name=model_name,
+            request_timeout=timeout,
+            max_retries=max_retries,
+            **options,
+        )
+
+    def complete(self, prompt: str) -> Tuple[str, Usage]:
+        return self._parse(self.llm.generate([[self._message(content=prompt)]]))
+
+    async def acomplete(self, prompt: str) -> Tuple[str, Usage]:
+        return self._parse(await self.llm.agenerate([[self._message(content=prompt)]]))
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        async for chunk in self.llm.astream(prompt):
+            yield chunk.content
+
+    async def aclose(self) -> None:
+        pass
+
+    @staticmethod
+    def _parse(result: Any) -> Tuple[str, Usage]:
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        return result.generations[0][0].text, usage
 
 
-# TODO: Change sync to async call for LLM
 class LLM:
     """This class manages the interaction with a language model using OpenAI's
     Chat API.
 
+    The default `openai` backend sends the formatted prompt to the
+    OpenAI-compatible API with `httpx`. The `langchain` backend goes through
+    LangChain's `ChatOpenAI` instead, LangChain is only imported when it is
+    selected.
+
     Parameters:
     - openai_api_key (str): The API key for accessing the OpenAI API.
     - model_name (str): The name of the language model.
-    - prompt_template (PromptTemplate): A template for constructing prompts.
+    - prompt_template (Any): The prompt, a `str.format` template such as the ones
+      of `src.prompts`, or an object with such a `template`, e.g. a LangChain
+      `PromptTemplate`.
     - temperature (float, optional): Controls the randomness of the model's output.
       Higher values (e.g., 0.8) make the output more random. Defaults to 0.0.
+    - json_mode (bool, optional): Forces the model to answer with a JSON object, the
+      prompt has to ask for JSON. Defaults to False.
+    - backend (str, optional): "openai" or "langchain". Defaults to "openai".
+    - base_url (str, optional): The root URL of the API. Defaults to OpenAI's.
+    - timeout (float, optional): The timeout of a request in seconds.
+      Defaults to 600.
+    - max_retries (int, optional): How often throttled or failed requests are
+      retried. Defaults to 2.
+    - hedge_quantile (float, optional): Hedges `acall`: a call still running
+      after this quantile of the recent latencies of the model and prompt, e.g.
+      0.95, is sent again and the first answer wins. Defaults to None, which
+      disables hedging.
+    - hedge_min_delay (float, optional): The minimum seconds before hedging a call.
+      Defaults to 1.
+    - fallback_model (str, optional): The model answering the hedged requests,
+      e.g. a faster one. Defaults to None, which hedges with the same model.
+    - latencies (LatencyTracker, optional): The latencies the hedging delay is
+      derived from. Defaults to the tracker shared by every LLM.
 
     Attributes:
-    - llm (ChatOpenAI): An instance of ChatOpenAI for interacting with the
-    OpenAI Chat API.
-    - prompt_template (PromptTemplate): The provided template for constructing
-    prompts.
-    - llm_chain (LLMChain): An instance of LLMChain for managing the language
-    model chain.
+    - model_name (str): The name of the language model.
+    - template (str): The prompt template.
+    - prompt_version (str): A digest of the prompt template, used to key cached
+    results so they are invalidated when the prompt changes.
+    - backend (str): The name of the backend.
+    - fallback_model (str): The model answering the hedged requests.
 
     Methods:
     - __call__(placeholder_mapping: Dict[str, Any]) -> str:
-      Generates text using the language model chain based on the
-      provided placeholder mapping.
+      Generates text using the language model based on the provided placeholder
+      mapping.
+    - acall(placeholder_mapping: Dict[str, Any]) -> str:
+      Asynchronous counterpart of `__call__` that does not block the event loop.
+    - astream(placeholder_mapping: Dict[str, Any]) -> AsyncIterator[str]:
+      Yields the generated text chunk by chunk while the model produces it.
+    - aclose() -> None: Closes the HTTP connections.
 
     Example:
     ```python
     openai_key = "your_openai_api_key"
     model_name = "your_model_name"
-    prompt_template = PromptTemplate.from_template("Your prompt template {}")
+    prompt_template = "Your prompt template {placeholder}"
 
     llm = LLM(openai_api_key=openai_key, model_name=model_name, prompt_template=prompt_template)
     generated_text = llm({"placeholder": "value"})
+    generated_text = await llm.acall({"placeholder": "value"})
     ```
 
     Note:
-    The `__call__` method is the primary interface for generating
-    text using the language model chain.
+    The `acall` method is the primary interface for generating text inside
+    the FastAPI handlers, `__call__` is kept for synchronous callers. Only `acall`
+    is hedged, and the cancelled request of a hedged call may still be billed.
     """
 
     def __init__(
         self,
         openai_api_key: str,
         model_name: str,
-        prompt_template: PromptTemplate,
+        prompt_template: Any,
         temperature: float = 0.0,
+        json_mode: bool = False,
+        backend: str = "openai",
+        base_url: str = OPENAI_API_BASE,
+        timeout: float = 600.0,
+        max_retries: int = 2,
+        hedge_quantile: Optional[float] = None,
+        hedge_min_delay: float = 1.0,
+        fallback_model: Optional[str] = None,
+        latencies: Optional[LatencyTracker] = None,
     ) -> None:
         """Initialize the LLM instance.
 
         Parameters:
         - openai_api_key (str): The API key for accessing the OpenAI API.
         - model_name (str): The name of the language model.
-        - prompt_template (PromptTemplate): A template for constructing prompts.
+        - prompt_template (Any): The prompt, a `str.format` template or an object
+          with such a `template`, e.g. a LangChain `PromptTemplate`.
         - temperature (float, optional): Controls the randomness of the model's output.
           Higher values (e.g., 0.8) make the output more random. Defaults to 0.0.
+        - json_mode (bool, optional): Forces the model to answer with a JSON object,
+          the prompt has to ask for JSON. Defaults to False.
+        - backend (str, optional): "openai" or "langchain". Defaults to "openai".
+        - base_url (str, optional): The root URL of the API. Defaults to OpenAI's.
+        - timeout (float, optional): The timeout of a request in seconds.
+          Defaults to 600.
+        - max_retries (int, optional): How often throttled or failed requests are
+          retried. Defaults to 2.
+        - hedge_quantile (float, optional): The quantile of the recent latencies
+          after which a running `acall` is sent again. Defaults to None, which
+          disables hedging.
+        - hedge_min_delay (float, optional): The minimum seconds before hedging a
+          call. Defaults to 1.
+        - fallback_model (str, optional): The model answering the hedged requests.
+          Defaults to None, which hedges with the same model.
+        - latencies (LatencyTracker, optional): The latencies the hedging delay is
+          derived from. Defaults to the tracker shared by every LLM.
         """
+        backends = {"openai": _OpenAIChat, "langchain": _LangChainChat}
+        if backend not in backends:
+            raise ValueError(
+                f"Unknown LLM backend {backend!r}, use one of {LLM_BACKENDS}"
+            )
+        if hedge_quantile is not None and not 0 < hedge_quantile < 1:
+            raise ValueError("hedge_quantile must be between 0 and 1")
 
-        self.llm = ChatOpenAI(
-            openai_api_key=openai_api_key,
-            temperature=temperature,
-            model_name=model_name,
-        )
+        self.model_name = model_name
+        self.backend = backend
         self.prompt_template = prompt_template
-        self.llm_chain = LLMChain(llm=self.llm, prompt=self.prompt_template)
+        self.template: str = getattr(prompt_template, "template", prompt_template)
+        self.prompt_version = hashlib.sha256(self.template.encode("utf-8")).hexdigest()
+        self.chat = backends[backend](
+            openai_api_key,
+            model_name,
+            temperature,
+            json_mode,
+            base_url,
+            timeout,
+            max_retries,
+        )
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.latencies = latencies if latencies is not None else llm_latencies
+        self.fallback_model = fallback_model or model_name
+        self.fallback_chat = self.chat
+        if self.fallback_model != model_name:
+            self.fallback_chat = backends[backend](
+                openai_api_key,
+                self.fallback_model,
+                temperature,
+                json_mode and supports_json_mode(self.fallback_model),
+                base_url,
+                timeout,
+                max_retries,
+            )
 
     def __call__(self, placeholder_mapping: Dict[str, Any]) -> str:
-        """Generate text using the language model chain based on the provided
+        """Generate text using the language model based on the provided
         placeholder mapping.
 
         Parameters:
@@ -81,4 +409,179 @@ class LLM:
         Returns:
         - str: The generated text.
         """
-        return self.llm_chain(placeholder_mapping)["text"]
+        prompt = self.template.format(**placeholder_mapping)
+        with tracer.span("llm.call", kind="client", **self._span_attributes()) as span:
+            text, usage = self.chat.complete(prompt)
+            self._record_usage(usage, span)
+        return text
+
+    async def acall(self, placeholder_mapping: Dict[str, Any]) -> str:
+        """Asynchronously generate text using the language model based on the
+        provided placeholder mapping.
+
+        Parameters:
+        - placeholder_mapping (Dict[str, Any]): A mapping of placeholders to their
+        corresponding values.
+
+        Returns:
+        - str: The generated text.
+        """
+        prompt = self.template.format(**placeholder_mapping)
+        with LLM_IN_FLIGHT.track_inprogress(model=self.model_name), LLM_LATENCY.time(
+            model=self.model_name, mode="call"
+        ), tracer.span("llm.call", kind="client", **self._span_attributes()) as span:
+            try:
+                if self.hedge_quantile is None:
+                    text, usage = await self.chat.acomplete(prompt)
+                    self._record_usage(usage, span)
+                else:
+                    text, usage = await self._hedged_complete(prompt, span)
+            except asyncio.CancelledError:
+                # E.g. the client disconnected, the completion is not waited for.
+                LLM_CANCELLED_CALLS.inc(model=self.model_name, mode="call")
+                raise
+        return text
+
+    async def astream(self, placeholder_mapping: Dict[str, Any]) -> AsyncIterator[str]:
+        """Stream the generated text chunk by chunk while the model produces it.
+
+        Parameters:
+        - placeholder_mapping (Dict[str, Any]): A mapping of placeholders to their
+        corresponding values.
+
+        Yields:
+        - str: The next chunk of the generated text.
+        """
+        prompt = self.template.format(**placeholder_mapping)
+        chunks = 0
+        # Not made the current span, the consumer runs between the chunks.
+        span = tracer.start_span("llm.stream", kind="client", **self._span_attributes())
+        error = None
+        with LLM_IN_FLIGHT.track_inprogress(model=self.model_name), LLM_LATENCY.time(
+            model=self.model_name, mode="stream"
+        ):
+            try:
+                async for chunk in self.chat.astream(prompt):
+                    chunks += 1
+                    yield chunk
+            except BaseException as raised:
+                error = raised
+                if isinstance(raised, (asyncio.CancelledError, GeneratorExit)):
+                    LLM_CANCELLED_CALLS.inc(model=self.model_name, mode="stream")
+                raise
+            finally:
+                span.set_attribute("llm.chunks", chunks)
+                tracer.end_span(span, error)
+        # Streamed completions carry no usage, OpenAI sends one token per chunk.
+        LLM_TOKENS.inc(chunks, model=self.model_name, kind="completion")
+
+    async def aclose(self) -> None:
+        """Closes the HTTP connections of the backend."""
+        await self.chat.aclose()
+        if self.fallback_chat is not self.chat:
+            await self.fallback_chat.aclose()
+
+    async def _hedged_complete(self, prompt: str, span: Span) -> Tuple[str, Usage]:
+        delay = self.latencies.quantile(
+            (self.model_name, self.prompt_version), self.hedge_quantile
+        )
+        if delay is not None:
+            delay = max(delay, self.hedge_min_delay)
+            LLM_HEDGE_DELAY.set(delay, model=self.model_name)
+        hedged = False
+        decided = asyncio.Event()
+
+        def backup() -> Any:
+            nonlocal hedged
+            hedged = True
+            span.set_attribute("llm.hedge.delay", delay)
+            return self._timed_complete(
+                self.fallback_chat, self.fallback_model, prompt, decided
+            )
+
+        try:
+            (text, usage), backup_won = await hedge(
+                lambda: self._timed_complete(
+                    self.chat, self.model_name, prompt, decided
+                ),
+                backup,
+                delay,
+            )
+        except Exception:
+            if hedged:
+                self._count_hedge("failed")
+            raise
+
+        if hedged:
+            self._count_hedge("backup" if backup_won else "primary")
+            span.set_attribute(
+                "llm.hedge.winner", "backup" if backup_won else "primary"
+            )
+        model = self.fallback_model if backup_won else self.model_name
+        self._record_usage(usage, span, model)
+        return text, usage
+
+    async def _timed_complete(
+        self, chat: Any, model: str, prompt: str, decided: asyncio.Event
+    ) -> Tuple[str, Usage]:
+        start = time.perf_counter()
+        try:
+            result = await chat.acomplete(prompt)
+        except asyncio.CancelledError:
+            # Losing the race is a lower bound, dropping it would hide the tail
+            # that made us hedge. A disconnect says nothing about the latency.
+            if decided.is_set():
+                self.latencies.observe(
+                    (model, self.prompt_version), time.perf_counter() - start
+                )
+            raise
+        decided.set()
+        self.latencies.observe(
+            (model, self.prompt_version), time.perf_counter() - start
+        )
+        return result
+
+    def _count_hedge(self, winner: str) -> None:
+        LLM_HEDGES.inc(
+            model=self.model_name, backup_model=self.fallback_model, winner=winner
+        )
+
+    def _span_attributes(self) -> Dict[str, Any]:
+        return {
+            "llm.model": self.model_name,
+            "llm.backend": self.backend,
+            "llm.prompt_version": self.prompt_version[:12],
+        }
+
+    def _record_usage(
+        self, usage: Usage, span: Optional[Span] = None, model: Optional[str] = None
+    ) -> None:
+        for kind in ("prompt", "completion"):
+            tokens = usage.get(f"{kind}_tokens")
+            if tokens:
+                LLM_TOKENS.inc(tokens, model=model or self.model_name, kind=kind)
+                if span is not None:
+                    span.set_attribute(f"llm.{kind}_tokens", tokens)
+
+
+@contextmanager
+def _transport_errors() -> Iterator[None]:
+    try:
+        yield
+    except httpx.TransportError as error:
+        raise OpenAIError(f"OpenAI API request failed: {error!r}") from error
+
+
+def _raise_for_status(response: httpx.Response) -> httpx.Response:
+    if response.is_success:
+        return response
+
+    try:
+        message = response.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = response.text
+    raise OpenAIError(
+        f"OpenAI API request failed with status {response.status_code}: {message}",
+        status=response.status_code,
+        headers=response.headers,
+    )
@@ -0,0 +1,568 @@
+import abc
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PARSE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+LabelValues = Tuple[str, ...]
+ASGIApp = Callable[[Dict[str, Any], Any, Any], Awaitable[None]]
+
+
+class _Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: LabelValues, extra: str = "") -> str:
+        pairs = [
+            f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """This class counts events, e.g. the tokens used by LLM calls.
+
+    Methods:
+    - inc(amount: float = 1, **labels: str) -> None: Increases the counter.
+    - value(**labels: str) -> float: Returns the current count.
+    """
+
+    kind = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        """Initialize the counter.
+
+        Parameters:
+        - name (str): The metric name.
+        - documentation (str): The help text of the metric.
+        - labelnames (Sequence[str], optional): The label names. Defaults to ().
+        """
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increases the counter.
+
+        Args:
+            amount (float, optional): The non-negative increment. Defaults to 1.
+            **labels (str): The label values.
+        """
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Returns the current count.
+
+        Args:
+            **labels (str): The label values.
+
+        Returns:
+            float: The count, 0 if the counter was never increased.
+        """
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{self._format_labels(key)} {_number(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    """This class tracks a value that goes up and down, e.g. in-flight calls.
+
+    Methods:
+    - inc(amount: float = 1, **labels: str) -> None: Increases the gauge.
+    - dec(amount: float = 1, **labels: str) -> None: Decreases the gauge.
+    - set(value: float, **labels: str) -> None: Sets the gauge.
+    - track_inprogress(**labels: str) -> Iterator[None]: Context manager counting
+        the blocks currently running.
+    - value(**labels: str) -> float: Returns the current value.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        """Initialize the gauge.
+
+        Parameters:
+        - name (str): The metric name.
+        - documentation (str): The help text of the metric.
+        - labelnames (Sequence[str], optional): The label names. Defaults to ().
+        """
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increases the gauge.
+
+        Args:
+            amount (float, optional): The increment. Defaults to 1.
+            **labels (str): The label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Decreases the gauge.
+
+        Args:
+            amount (float, optional): The decrement. Defaults to 1.
+            **labels (str): The label values.
+        """
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        """Sets the gauge.
+
+        Args:
+            value (float): The new value.
+            **labels (str): The label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels: str) -> Iterator[None]:
+        """Counts the blocks currently running under the given labels.
+
+        Args:
+            **labels (str): The label values.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def value(self, **labels: str) -> float:
+        """Returns the current value.
+
+        Args:
+            **labels (str): The label values.
+
+        Returns:
+            float: The value, 0 if the gauge was never set.
+        """
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{self._format_labels(key)} {_number(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """This class records the distribution of observed values, e.g. latencies.
+
+    Methods:
+    - observe(value: float, **labels: str) -> None: Records a value.
+    - time(**labels: str) -> Iterator[None]: Context manager recording the
+        duration of the block in seconds.
+    - count(**labels: str) -> int: Returns the number of recorded values.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialize the histogram.
+
+        Parameters:
+        - name (str): The metric name.
+        - documentation (str): The help text of the metric.
+        - labelnames (Sequence[str], optional): The label names. Defaults to ().
+        - buckets (Sequence[float], optional): The upper bounds of the buckets,
+            `+Inf` is added automatically. Defaults to `DEFAULT_BUCKETS`.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Records a value.
+
+        Args:
+            value (float): The observed value.
+            **labels (str): The label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Records the duration of the block in seconds, also when it raises.
+
+        Args:
+            **labels (str): The label values.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """Returns the number of recorded values.
+
+        Args:
+            **labels (str): The label values.
+
+        Returns:
+            int: The number of observations.
+        """
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="' + ("+Inf" if math.isinf(bound) else _number(bound)) + '"'
+                samples.append(
+                    f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}"
+                )
+            labels = self._format_labels(key)
+            samples.append(f"{self.name}_sum{labels} {_number(self._sums[key])}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+class MetricsRegistry:
+    """This class collects metrics and renders them in the Prometheus text
+    exposition format.
+
+    Methods:
+    - counter(name: str, documentation: str, labelnames: Sequence[str] = ())
+        -> Counter: Registers a counter.
+    - gauge(name: str, documentation: str, labelnames: Sequence[str] = ())
+        -> Gauge: Registers a gauge.
+    - histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram: Registers a
+        histogram.
+    - render() -> str: Renders every registered metric.
+
+    Example:
+    ```python
+    registry = MetricsRegistry()
+    latency = registry.histogram("notion_call_duration_seconds", "...", ["method"])
+    with latency.time(method="pages.create"):
+        await notion.pages.create(...)
+    registry.render()
+    ```
+    """
+
+    def __init__(self) -> None:
+        """Initialize the registry."""
+        self._metrics: Dict[str, _Metric] = {}
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Counter:
+        """Registers a counter.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labelnames (Sequence[str], optional): The label names. Defaults to ().
+
+        Returns:
+            Counter: The registered counter.
+        """
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Gauge:
+        """Registers a gauge.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labelnames (Sequence[str], optional): The label names. Defaults to ().
+
+        Returns:
+            Gauge: The registered gauge.
+        """
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Registers a histogram.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labelnames (Sequence[str], optional): The label names. Defaults to ().
+            buckets (Sequence[float], optional): The upper bounds of the buckets.
+                Defaults to `DEFAULT_BUCKETS`.
+
+        Returns:
+            Histogram: The registered histogram.
+        """
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Renders every registered metric in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        return "".join(metric.render() + "\n" for metric in self._metrics.values())
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+
+        self._metrics[metric.name] = metric
+        return metric
+
+
+class MetricsMiddleware:
+    """This ASGI middleware records the latency, status and concurrency of the
+    HTTP requests.
+
+    Requests are labeled with the route template, e.g. `/jobs/{job_id}`, so path
+    parameters do not create new series.
+
+    Parameters:
+    - app (ASGIApp): The wrapped application.
+
+    Example:
+    ```python
+    app.add_middleware(MetricsMiddleware)
+    ```
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Initialize the middleware.
+
+        Parameters:
+        - app (ASGIApp): The wrapped application.
+        """
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        """Handles a request and records its metrics.
+
+        Args:
+            scope (Dict[str, Any]): The ASGI connection scope.
+            receive (Any): The ASGI receive channel.
+            send (Any): The ASGI send channel.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        start = time.perf_counter()
+        with REQUESTS_IN_FLIGHT.track_inprogress():
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                REQUEST_LATENCY.observe(
+                    time.perf_counter() - start,
+                    method=scope["method"],
+                    endpoint=getattr(route, "path", "unmatched"),
+                    status=status,
+                )
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+registry = MetricsRegistry()
+
+REQUEST_LATENCY = registry.histogram(
+    "http_request_duration_seconds",
+    "Latency of the HTTP requests, including streamed response bodies.",
+    ["method", "endpoint", "status"],
+)
+REQUESTS_IN_FLIGHT = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being handled."
+)
+LLM_LATENCY = registry.histogram(
+    "llm_call_duration_seconds", "Latency of the LLM calls.", ["model", "mode"]
+)
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Tokens used by the LLM calls.", ["model", "kind"]
+)
+LLM_IN_FLIGHT = registry.gauge(
+    "llm_calls_in_flight", "LLM calls currently running.", ["model"]
+)
+NOTION_LATENCY = registry.histogram(
+    "notion_call_duration_seconds",
+    "Latency of the Notion API calls.",
+    ["method", "status"],
+)
+NOTION_IN_FLIGHT = registry.gauge(
+    "notion_calls_in_flight", "Notion API calls currently running.", ["method"]
+)
+NOTION_RETRIES = registry.counter(
+    "notion_retries_total",
+    "Notion API calls sent again after throttling or a transient failure.",
+    ["method", "status"],
+)
+NOTION_RATE_LIMIT_WAIT = registry.histogram(
+    "notion_rate_limit_wait_seconds",
+    "Time Notion API calls waited for the rate limiter.",
+    ["method"],
+)
+PARSE_LATENCY = registry.histogram(
+    "llm_output_parse_duration_seconds",
+    "Time spent parsing LLM outputs into records.",
+    buckets=PARSE_BUCKETS,
+)
+WRITE_BEHIND_PENDING = registry.gauge(
+    "write_behind_pending", "Writes waiting in the write-behind log."
+)
+WRITE_BEHIND_WRITES = registry.counter(
+    "write_behind_writes_total",
+    "Write-behind attempts by outcome (written, retried or failed).",
+    ["outcome"],
+)
+SINGLE_FLIGHT_CALLS = registry.counter(
+    "single_flight_calls_total",
+    "Coalesced operations by role (leader ran the call, follower joined it).",
+    ["operation", "role"],
+)
+TRACE_SPANS_DROPPED = registry.counter(
+    "trace_spans_dropped_total",
+    "Finished spans dropped because the export queue was full or exporting failed.",
+)
+PROFILES_CAPTURED = registry.counter(
+    "slow_request_profiles_total", "Profiles written for slow requests."
+)
+IDEMPOTENT_REQUESTS = registry.counter(
+    "idempotent_requests_total",
+    "Requests with an idempotency key by outcome (executed, joined a running "
+    "execution or replayed a stored response).",
+    ["outcome"],
+)
+LLM_HEDGES = registry.counter(
+    "llm_hedged_calls_total",
+    "LLM calls sent again after the hedging delay, by the call that answered first "
+    "(primary, backup or failed when both failed).",
+    ["model", "backup_model", "winner"],
+)
+LLM_HEDGE_DELAY = registry.gauge(
+    "llm_hedge_delay_seconds",
+    "The latest delay after which LLM calls are hedged.",
+    ["model"],
+)
+SIMILARITY_CACHE_LOOKUPS = registry.counter(
+    "similarity_cache_lookups_total",
+    "Lookups of the near-duplicate post cache by outcome (hit or miss).",
+    ["outcome"],
+)
+SIMILARITY_CACHE_SIMILARITY = registry.histogram(
+    "similarity_cache_hit_similarity",
+    "Cosine similarity between the topics of a hit and the cached ones.",
+    buckets=(0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0),
+)
+ADMISSION_QUEUED = registry.gauge(
+    "admission_queued_requests",
+    "Requests waiting for admission.",
+    ["endpoint"],
+)
+ADMISSION_WAIT = registry.histogram(
+    "admission_wait_seconds",
+    "Time queued requests waited for admission.",
+    ["endpoint"],
+)
+ADMISSION_REJECTIONS = registry.counter(
+    "admission_rejections_total",
+    "Requests rejected by admission control, by reason.",
+    ["endpoint", "reason"],
+)
+CLIENT_DISCONNECTS = registry.counter(
+    "client_disconnects_total",
+    "Requests whose work was cancelled because the client disconnected.",
+    ["endpoint"],
+)
+LLM_CANCELLED_CALLS = registry.counter(
+    "llm_cancelled_calls_total",
+    "LLM calls cancelled before the completion finished.",
+    ["model", "mode"],
+)
+NOTION_WRITES_CANCELLED = registry.counter(
+    "notion_writes_cancelled_total",
+    "Pages of generated posts not written because their request was cancelled.",
+)
@@ -1,55 +1,277 @@
-import ast
-from typing import Dict, List, Optional
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
 
-from notion_client import Client
+from notion_client import AsyncClient
 
-from src.data_models import GeneratePosts, GetTemplates, TemplateCreate
+from src.cache import LRUCache, ResultCache
+from src.data_models import (
+    GeneratePosts,
+    GetTemplates,
+    SearchTemplates,
+    TemplateCreate,
+    TemplatesCreate,
+)
+from src.jobs import ProgressCallback
 from src.llm import LLM
+from src.metrics import (
+    NOTION_IN_FLIGHT,
+    NOTION_LATENCY,
+    NOTION_RATE_LIMIT_WAIT,
+    NOTION_RETRIES,
+    NOTION_WRITES_CANCELLED,
+)
+from src.output_parsing import (
+    IncrementalObjectParser,
+    is_record,
+    parse_object,
+    parse_objects,
+)
+from src.pool import hash_secret
+from src.rate_limiter import RateLimiter, backoff_delay, is_retryable, retry_after
+from src.similarity_cache import SimilarityCache
+from src.single_flight import SingleFlight
+from src.template_mirror import TemplateMirror
+from src.template_search import TemplateIndex
+from src.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Repeating these after an ambiguous failure could create duplicates.
+NON_IDEMPOTENT_METHODS = ("pages.create", "databases.create")
+
+# Queues a page (database id, record, status) and returns the id of the write.
+PageQueue = Callable[[str, Dict[str, str], str], Awaitable[str]]
+
+# Prefixes the cursors of pages served from the template mirror, other cursors
+# are Notion's and are sent to Notion.
+MIRROR_CURSOR_PREFIX = "mirror:"
+
+# Writes outliving their cancelled request, referenced until they finished.
+_detached_writes: Set["asyncio.Future[Any]"] = set()
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor is malformed."""
+
+
+def mirror_offset(cursor: Optional[str]) -> Optional[int]:
+    """Returns the offset into the template mirror a cursor points to.
+
+    Args:
+        cursor (Optional[str]): The cursor of a `get_templates` request.
+
+    Raises:
+        InvalidCursor: If the cursor is a malformed mirror cursor.
+
+    Returns:
+        Optional[int]: The offset, None if there is no cursor or it is a Notion
+            cursor.
+    """
+    if cursor is None or not cursor.startswith(MIRROR_CURSOR_PREFIX):
+        return None
+
+    offset = cursor[len(MIRROR_CURSOR_PREFIX) :]
+    if not re.fullmatch(r"[0-9]+", offset):
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+    return int(offset)
 
 
 class NotionDatabase:
     """This class manages the interaction with the Notion Database.
 
     Parameters:
-    - notion (Client): The Notion client.
+    - notion (AsyncClient): The asynchronous Notion client.
     - llm (LLM): The LLM instance.
+    - max_concurrency (int, optional): The maximum number of concurrent Notion
+        requests issued for page creation and block fetches. Defaults to 3.
+    - template_cache (LRUCache, optional): A cache of template bodies keyed by page
+        id and `last_edited_time`, shared across instances to skip unchanged
+        templates. Defaults to a private cache.
+    - result_cache (ResultCache, optional): A cache of generated templates keyed by
+        model, prompt version and normalized post text. Defaults to None, which
+        disables caching.
+    - max_repair_attempts (int, optional): How often posts missing from a partially
+        malformed LLM output are requested again. Defaults to 1.
+    - posts_per_llm_call (int, optional): Larger requests are split into several
+        concurrent LLM calls of at most this many posts. Defaults to 5.
+    - max_llm_concurrency (int, optional): The maximum number of concurrent LLM
+        calls of a split request. Defaults to 4.
+    - templates_per_llm_call (int, optional): The number of posts templatized by a
+        single LLM call of `create_templates`. Defaults to 5.
+    - rate_limiter (RateLimiter, optional): A limiter shared by every request of
+        the integration. Defaults to None, which disables throttling.
+    - rate_limit_key (str, optional): The bucket of the integration in the rate
+        limiter. Defaults to "notion".
+    - max_retries (int, optional): How often a throttled or transiently failed
+        Notion call is sent again, honoring `Retry-After`. Defaults to 3.
+    - write_behind (PageQueue, optional): Queues the pages of `create_template` and
+        `generate_posts` instead of writing them before returning. Defaults to None.
+    - template_mirror (TemplateMirror, optional): A local copy of the templates
+        serving `get_templates`, scoped by `rate_limit_key` so integrations only
+        see the databases they synced themselves. Defaults to None.
+    - template_indexes (LRUCache, optional): A cache of the search indexes of the
+        mirrored databases. Defaults to a private cache.
+    - single_flight (SingleFlight, optional): Merges concurrent identical template
+        reads, mirror syncs and template generations of every instance into one
+        call. Defaults to None, which runs every call on its own.
+    - post_cache (SimilarityCache, optional): A cache of generated posts keyed by
+        integration, model, prompt version, template and number of posts, which
+        also answers requests whose topics are only reworded. Defaults to None,
+        which disables caching.
+    - persist_on_cancel (bool, optional): Whether the posts of a cancelled
+        `generate_posts` or `stream_posts`, e.g. after the client disconnected,
+        are still written once generated. Defaults to False, which cancels their
+        writes too.
 
     Methods:
     - get_templates(data: GetTemplates) -> Dict[int, List[Dict[str, str]]]:
-        Returns the available templates in the database.
+        Returns the available templates in the database, or a single page of them
+        when `pageSize` is set.
+    - stream_templates(data: GetTemplates) -> AsyncIterator[Dict[str, str]]: Yields
+        the available templates one Notion result page at a time.
     - create_template(data: TemplateCreate) -> Dict[str, str]: Creates a new template
         and insert it into the database.
-    - generate_posts(data: GeneratePosts) -> List[Dict[str, str]]: Generates posts
-        from a template and insert them into the database.
+    - create_templates(data: TemplatesCreate) -> Dict[str, Any]: Creates templates
+        from many posts, several posts per LLM call, and inserts them into the
+        database.
+    - generate_posts(data: GeneratePosts, on_progress: ProgressCallback = None)
+        -> List[Dict[str, Any]]: Generates posts from a template and insert them
+        into the database. Every post carries a `stored` flag telling whether its
+        Notion page was created.
+    - stream_posts(data: GeneratePosts) -> AsyncIterator[Dict[str, Any]]: Yields
+        every post as soon as the LLM produced it and its Notion page was created.
+    - search_templates(data: SearchTemplates) -> Dict[str, Any]: Returns the
+        mirrored templates most similar to a query or a post.
+    - create_page(record: Dict[str, str], database_id: str, status: str)
+        -> Dict[str, Any]: Creates the Notion page of a template or post.
 
     Example:
     ```python
     openai_key = "your_openai_api_key"
     model_name = "your_model_name"
     notion_key = "your_notion_key"
-    prompt_template = PromptTemplate.from_template("Your prompt template {}")
+    prompt_template = "Your prompt template {placeholder}"
 
     llm = LLM(openai_api_key=openai_key, model_name=model_name, prompt_template=prompt_template)
-    generated_text = llm({"placeholder": "value"})
 
-    notion = Client(auth=notion_key)
+    notion = AsyncClient(auth=notion_key)
 
     notion_database = NotionDatabase(notion, llm)
-    templates = notion_database.get_templates()
+    templates = await notion_database.get_templates(data)
     ```
     """
 
-    def __init__(self, notion: Client, llm: LLM = None) -> None:
+    def __init__(
+        self,
+        notion: AsyncClient,
+        llm: LLM = None,
+        max_concurrency: int = 3,
+        template_cache: Optional[LRUCache] = None,
+        result_cache: Optional[ResultCache] = None,
+        max_repair_attempts: int = 1,
+        posts_per_llm_call: int = 5,
+        max_llm_concurrency: int = 4,
+        templates_per_llm_call: int = 5,
+        rate_limiter: Optional[RateLimiter] = None,
+        rate_limit_key: str = "notion",
+        max_retries: int = 3,
+        write_behind: Optional[PageQueue] = None,
+        template_mirror: Optional[TemplateMirror] = None,
+        template_indexes: Optional[LRUCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        post_cache: Optional[SimilarityCache] = None,
+        persist_on_cancel: bool = False,
+    ) -> None:
         """Initialize the Notion Database instance.
 
         Parameters:
-         - notion (Client): The Notion client.
+        - notion (AsyncClient): The asynchronous Notion client.
         - llm (LLM): The LLM instance.
+        - max_concurrency (int, optional): The maximum number of concurrent Notion
+            requests issued for page creation and block fetches. Defaults to 3.
+        - template_cache (LRUCache, optional): A cache of template bodies keyed by
+            page id and `last_edited_time`. Defaults to a private cache.
+        - result_cache (ResultCache, optional): A cache of generated templates.
+            Defaults to None, which disables caching.
+        - max_repair_attempts (int, optional): How often posts missing from a
+            partially malformed LLM output are requested again. Defaults to 1.
+        - posts_per_llm_call (int, optional): Larger requests are split into
+            several concurrent LLM calls of at most this many posts. Defaults to 5.
+        - max_llm_concurrency (int, optional): The maximum number of concurrent LLM
+            calls of a split request. Defaults to 4.
+        - templates_per_llm_call (int, optional): The number of posts templatized
+            by a single LLM call of `create_templates`. Defaults to 5.
+        - rate_limiter (RateLimiter, optional): A limiter shared by every request
+            of the integration. Defaults to None, which disables throttling.
+        - rate_limit_key (str, optional): The bucket of the integration in the
+            rate limiter. Defaults to "notion".
+        - max_retries (int, optional): How often a throttled or transiently failed
+            Notion call is sent again. Defaults to 3.
+        - write_behind (PageQueue, optional): Queues the pages of `create_template`
+            and `generate_posts` instead of writing them before returning.
+            Defaults to None.
+        - template_mirror (TemplateMirror, optional): A local copy of the
+            templates serving `get_templates`, scoped by `rate_limit_key`.
+            Defaults to None.
+        - template_indexes (LRUCache, optional): A cache of the search indexes of
+            the mirrored databases. Defaults to a private cache.
+        - single_flight (SingleFlight, optional): Merges concurrent identical
+            template reads, mirror syncs and template generations into one call.
+            Defaults to None.
+        - post_cache (SimilarityCache, optional): A cache of generated posts that
+            also answers requests with similar topics. Defaults to None, which
+            disables caching.
+        - persist_on_cancel (bool, optional): Whether the generated posts of a
+            cancelled request are still written. Defaults to False.
         """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if posts_per_llm_call < 1:
+            raise ValueError("posts_per_llm_call must be at least 1")
+        if max_llm_concurrency < 1:
+            raise ValueError("max_llm_concurrency must be at least 1")
+        if templates_per_llm_call < 1:
+            raise ValueError("templates_per_llm_call must be at least 1")
+
         self.notion = notion
         self.llm = llm
+        self.max_concurrency = max_concurrency
+        self.template_cache = (
+            template_cache if template_cache is not None else LRUCache()
+        )
+        self.result_cache = result_cache
+        self.max_repair_attempts = max_repair_attempts
+        self.posts_per_llm_call = posts_per_llm_call
+        self.max_llm_concurrency = max_llm_concurrency
+        self.templates_per_llm_call = templates_per_llm_call
+        self.rate_limiter = rate_limiter
+        self.rate_limit_key = rate_limit_key
+        self.max_retries = max_retries
+        self.write_behind = write_behind
+        self.template_mirror = template_mirror
+        self.template_indexes = (
+            template_indexes if template_indexes is not None else LRUCache(maxsize=16)
+        )
+        self.single_flight = single_flight
+        self.post_cache = post_cache
+        self.persist_on_cancel = persist_on_cancel
 
-    def get_templates(self, data: GetTemplates) -> Dict[int, List[Dict[str, str]]]:
+    async def get_templates(
+        self, data: GetTemplates
+    ) -> Dict[int, List[Dict[str, str]]]:
         """Returns the available templates in the database.
 
         Args:
@@ -57,17 +279,130 @@ class NotionDatabase:
 
         Returns:
             Dict[int, List[Dict[str, str]]]: The available templates in the database.
+                Paginated responses also carry the `nextCursor` of the next page.
         """
         if not data.databaseId:
             return {"count": 0, "data": []}
 
-        available_templates = self._query_available_templates(data.databaseId)
+        if self.single_flight is None:
+            return await self._get_templates(data)
+
+        # Keyed by the integration, so only callers sharing a key share results.
+        key = (self.rate_limit_key, data.databaseId, data.pageSize, data.cursor)
+        response = await self.single_flight.do(
+            ("get_templates", key), lambda: self._get_templates(data), "get_templates"
+        )
+        return dict(response)
+
+    async def _get_templates(self, data: GetTemplates) -> Dict[str, Any]:
+        # Notion cursors keep paging through Notion, so the cursors of both the
+        # mirror and Notion stay valid whichever path serves the next page.
+        offset = mirror_offset(data.cursor)
+        if offset is not None or (self.template_mirror is not None and not data.cursor):
+            return await self._get_mirrored_templates(data, offset or 0, data.pageSize)
+
+        if data.pageSize:
+            response = await self._call(
+                "databases.query",
+                **self._templates_query(data.databaseId, data.pageSize, data.cursor),
+            )
+            formatted_templates = await self._format_templates(response["results"])
+
+            return {
+                "count": len(formatted_templates),
+                "data": formatted_templates,
+                "nextCursor": response["next_cursor"] if response["has_more"] else None,
+            }
+
+        available_templates = await self._query_available_templates(
+            data.databaseId, data.cursor
+        )
 
-        formatted_templates = self._format_templates(available_templates)
+        formatted_templates = await self._format_templates(available_templates)
 
         return {"count": len(formatted_templates), "data": formatted_templates}
 
-    def create_template(self, data: TemplateCreate) -> Dict[str, str]:
+    async def stream_templates(
+        self, data: GetTemplates
+    ) -> AsyncIterator[Dict[str, str]]:
+        """Yields the available templates one Notion result page at a time.
+
+        Only a single result page is held in memory, so the first templates can be
+        sent to the client before the whole database has been read.
+
+        Args:
+            data (GetTemplates): The data model for getting templates.
+
+        Yields:
+            Dict[str, str]: The next available template.
+        """
+        if not data.databaseId:
+            return
+
+        start = mirror_offset(data.cursor)
+        if start is not None:
+            response = await self._get_mirrored_templates(data, start, None)
+            for template in response["data"]:
+                yield template
+            return
+
+        offset = 0
+        async for templates in self._iter_available_templates(
+            data.databaseId, data.pageSize, data.cursor
+        ):
+            for template in await self._format_templates(templates, offset):
+                yield template
+            offset += len(templates)
+
+    async def search_templates(self, data: SearchTemplates) -> Dict[str, Any]:
+        """Returns the mirrored templates most similar to a query or a post.
+
+        Pasting a post finds an existing template for it, which is cheaper than
+        templatizing a near-duplicate. The search index of a database is kept
+        in memory and only re-indexes the templates that changed in the mirror.
+
+        Args:
+            data (SearchTemplates): The data model for searching templates.
+
+        Returns:
+            Dict[str, Any]: The best matches with their `pageId` and `score`.
+        """
+        if self.template_mirror is None:
+            raise ValueError("Searching templates requires a template mirror")
+
+        key = self._mirror_key(data.databaseId)
+        if not self.template_mirror.is_fresh(key):
+            await self._sync_mirror(data.databaseId)
+
+        revision = self.template_mirror.revision(key)
+        cached = self.template_indexes.get(key)
+        if cached is None or cached[0] != revision:
+            index = cached[1] if cached is not None else TemplateIndex()
+            templates = {
+                template["pageId"]: template
+                for template in self.template_mirror.templates(key)
+            }
+            index.sync(list(templates.values()))
+            cached = (revision, index, templates)
+            self.template_indexes.set(key, cached)
+        _, index, templates = cached
+
+        matches = index.search(data.query, data.topK)
+
+        return {
+            "count": len(matches),
+            "data": [
+                {
+                    "pageId": page_id,
+                    "title": templates[page_id]["title"],
+                    "content": templates[page_id]["content"],
+                    "score": round(score, 4),
+                }
+                for page_id, score in matches
+            ],
+        }
+
+    async def create_template(self, data: TemplateCreate) -> Dict[str, str]:
         """Creates a new template and insert it into the database.
 
         Args:
@@ -76,74 +411,507 @@ class NotionDatabase:
         Returns:
             Dict[str, str]: The created template.
         """
-        database_id = self._create_database(data)
-        template = self._generate_template(data)
+        database_id = await self._create_database(data)
+        template = await self._generate_template(data)
+
+        response = template
+
+        if self.write_behind is not None:
+            response["writeId"] = await self.write_behind(
+                data.databaseId or database_id, dict(template), "Template"
+            )
+        else:
+            await self._store_template_in_notion(
+                template, database_id if not data.databaseId else data.databaseId
+            )
+
+        if not data.databaseId:
+            response["databaseId"] = database_id
+
+        return response
+
+    async def create_templates(self, data: TemplatesCreate) -> Dict[str, Any]:
+        """Creates templates from many posts and inserts them into the database.
+
+        Several posts share one LLM call, so the long templatizing instructions
+        are only sent once per batch, and the batches run concurrently. A post
+        whose template is missing from the output, or whose batch failed, is
+        reported with an `error` instead of failing the whole request.
+
+        Args:
+            data (TemplatesCreate): The data model for creating templates.
+
+        Returns:
+            Dict[str, Any]: The created templates in the order of the posts.
+        """
+        database_id = data.databaseId or await self._create_database(data)
+        templates = await self._generate_templates(data)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
 
-        self._store_template_in_notion(
-            template, database_id if not data.databaseId else data.databaseId
+        async def store(template: Dict[str, str]) -> bool:
+            try:
+                async with semaphore:
+                    await self._store_template_in_notion(template, database_id)
+            except Exception as error:
+                logger.warning(
+                    "Storing template %r failed: %s", template["title"], error
+                )
+                return False
+            return True
+
+        stored = await asyncio.gather(
+            *(store(template) for template in templates if template is not None)
         )
+        stored_iterator = iter(stored)
 
-        response = template
+        results: List[Dict[str, Any]] = []
+        for index, template in enumerate(templates):
+            if template is None:
+                results.append({"index": index, "error": "No template was generated"})
+            else:
+                results.append(
+                    {"index": index, **template, "stored": next(stored_iterator)}
+                )
+
+        response: Dict[str, Any] = {"count": len(results), "data": results}
 
         if not data.databaseId:
             response["databaseId"] = database_id
 
         return response
 
-    def generate_posts(self, data: GeneratePosts) -> List[Dict[str, str]]:
+    async def generate_posts(
+        self, data: GeneratePosts, on_progress: Optional[ProgressCallback] = None
+    ) -> List[Dict[str, Any]]:
         """Generates posts from a template and insert them into the database.
 
+        A failing Notion write does not abort the others, the generated posts
+        are always returned and flagged with whether they were stored. With
+        `write_behind`, the posts are queued and carry the `writeId` instead.
+
         Args:
             data (GeneratePosts): The data model for generating posts.
+            on_progress (ProgressCallback, optional): Called with the keyword
+                arguments `postsGenerated` and `postsWritten` whenever they change.
+                Defaults to None.
 
         Returns:
-            List[Dict[str, str]]: The generated posts.
+            List[Dict[str, Any]]: The generated posts.
+        """
+        posts = await self._generate_posts(data)
+
+        if self.write_behind is not None:
+            if on_progress is not None:
+                on_progress(postsGenerated=len(posts), postsWritten=0)
+            return [
+                {
+                    **post,
+                    "stored": False,
+                    "writeId": await self.write_behind(
+                        data.databaseId, post, "Working"
+                    ),
+                }
+                for post in posts
+            ]
+
+        written = 0
+
+        def on_stored() -> None:
+            nonlocal written
+            written += 1
+            if on_progress is not None:
+                on_progress(postsGenerated=len(posts), postsWritten=written)
+
+        if on_progress is not None:
+            on_progress(postsGenerated=len(posts), postsWritten=written)
+
+        storing = asyncio.ensure_future(
+            self._store_generated_posts(posts, data.databaseId, on_stored)
+        )
+        try:
+            results = await (
+                asyncio.shield(storing) if self.persist_on_cancel else storing
+            )
+        except asyncio.CancelledError:
+            self._abandon({storing}, len(posts) - written)
+            raise
+
+        return [
+            {**post, "stored": result["error"] is None}
+            for post, result in zip(posts, results)
+        ]
+
+    async def stream_posts(self, data: GeneratePosts) -> AsyncIterator[Dict[str, Any]]:
+        """Yields every post as soon as the LLM produced it and it was stored.
+
+        The completion is parsed while it is streamed, so the Notion page of a post
+        is created while the LLM is still writing the following posts.
+
+        Args:
+            data (GeneratePosts): The data model for generating posts.
+
+        Yields:
+            Dict[str, Any]: The next generated post, flagged with `stored`.
         """
-        posts = self._generate_posts(data)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        parser = IncrementalObjectParser()
+        pending: Set[asyncio.Task] = set()
+        generated = 0
+
+        async def store(post: Dict[str, str]) -> Dict[str, Any]:
+            result = await self._store_post(post, data.databaseId, semaphore)
+            return {**post, "stored": result["error"] is None}
+
+        def schedule(posts: List[Dict[str, Any]]) -> None:
+            nonlocal generated
+            for post in filter(is_record, posts):
+                generated += 1
+                pending.add(asyncio.ensure_future(store(post)))
 
-        self._store_generated_posts(posts, data.databaseId)
+        try:
+            async for chunk in self.llm.astream(self._posts_placeholders(data)):
+                schedule(parser.feed(chunk))
+
+                finished = {task for task in pending if task.done()}
+                pending.difference_update(finished)
+                for task in finished:
+                    yield task.result()
+
+            schedule(parser.close())
+            schedule(await self._request_missing_posts(data, data.numPosts - generated))
+
+            for next_finished in asyncio.as_completed(pending):
+                yield await next_finished
+        except (asyncio.CancelledError, GeneratorExit):
+            unfinished = {task for task in pending if not task.done()}
+            self._abandon(unfinished, len(unfinished))
+            raise
+
+    async def create_page(
+        self, record: Dict[str, str], database_id: str, status: str
+    ) -> Dict[str, Any]:
+        """Creates the Notion page of a template or post.
+
+        Args:
+            record (Dict[str, str]): The `title` and `post` of the page.
+            database_id (str): The id of the database.
+            status (str): The `Status` option, e.g. "Template" or "Working".
+
+        Returns:
+            Dict[str, Any]: The created page.
+        """
+        parent = {"database_id": database_id}
+        properties = {
+            "title": {
+                "title": [{"type": "text", "text": {"content": record["title"]}}]
+            },
+            "Status": {"select": {"name": status}},
+        }
+        children = [
+            {
+                "object": "block",
+                "type": "paragraph",
+                "paragraph": {
+                    "rich_text": [{"type": "text", "text": {"content": record["post"]}}]
+                },
+            }
+        ]
+
+        page = await self._call(
+            "pages.create", parent=parent, properties=properties, children=children
+        )
+
+        if self.template_mirror is not None and status == "Template":
+            self.template_mirror.add(
+                self._mirror_key(database_id),
+                {
+                    "pageId": page["id"],
+                    "title": record["title"],
+                    "content": record["post"],
+                    "createdTime": page.get("created_time", ""),
+                    "lastEditedTime": page.get("last_edited_time", ""),
+                },
+            )
+
+        return page
+
+    async def _generate_posts(self, data: GeneratePosts) -> List[Dict[str, str]]:
+        cache_key = None
+        if self.post_cache is not None:
+            # Scoped by the integration, other users' posts are never served.
+            cache_key = (
+                self.rate_limit_key,
+                self.llm.model_name,
+                self.llm.prompt_version,
+                _normalize_post(data.templateText),
+                data.numPosts,
+            )
+            if not data.bypassCache:
+                posts = self.post_cache.get(cache_key, data.topics)
+                if posts is not None:
+                    return posts
+
+        posts = await self._run_post_generation(data)
+
+        if cache_key is not None:
+            self.post_cache.set(cache_key, data.topics, posts)
+
+        return posts
+
+    async def _run_post_generation(self, data: GeneratePosts) -> List[Dict[str, str]]:
+        semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+
+        async def generate_shard(placeholders: Dict[str, Any]) -> List[Dict[str, str]]:
+            async with semaphore:
+                return parse_objects(await self.llm.acall(placeholders))
+
+        shards = await asyncio.gather(
+            *(generate_shard(placeholders) for placeholders in self._shard(data)),
+            return_exceptions=True,
+        )
+        failures = [shard for shard in shards if isinstance(shard, Exception)]
+        if len(failures) == len(shards):
+            raise failures[0]
+        for failure in failures:
+            # The posts of the failed shards are requested again as missing ones.
+            logger.warning("Generating a shard of posts failed: %s", failure)
+
+        posts = _deduplicate_posts(
+            [post for shard in shards if isinstance(shard, list) for post in shard]
+        )
+        posts += await self._request_missing_posts(data, data.numPosts - len(posts))
+
+        if not posts:
+            raise ValueError("The LLM output did not contain any valid post")
+
+        return posts
+
+    async def _request_missing_posts(
+        self, data: GeneratePosts, missing: int
+    ) -> List[Dict[str, str]]:
+        posts: List[Dict[str, str]] = []
+
+        for _ in range(self.max_repair_attempts):
+            if len(posts) >= missing:
+                break
+
+            logger.info("Requesting %d posts missing from the LLM output", missing)
+            placeholders = {
+                **self._posts_placeholders(data),
+                "NUMBER_OF_POSTS": missing - len(posts),
+            }
+            posts += parse_objects(await self.llm.acall(placeholders))[
+                : missing - len(posts)
+            ]
 
         return posts
 
-    def _generate_posts(self, data: GeneratePosts) -> List[Dict[str, str]]:
-        posts = ast.literal_eval(
-            self.llm(
+    def _shard(self, data: GeneratePosts) -> List[Dict[str, Any]]:
+        placeholders = self._posts_placeholders(data)
+        shard_count = -(-data.numPosts // self.posts_per_llm_call)
+        if shard_count <= 1:
+            return [placeholders]
+
+        topics = [topic.strip() for topic in data.topics.split(",") if topic.strip()]
+        shards = []
+        for index in range(shard_count):
+            if len(topics) >= shard_count:
+                shard_topics = ", ".join(topics[index::shard_count])
+            elif topics:
+                shard_topics = topics[index % len(topics)]
+            else:
+                shard_topics = data.topics
+            shards.append(
                 {
-                    "TEMPLATE": data.templateText,
-                    "NUMBER_OF_POSTS": data.numPosts,
-                    "TOPICS": data.topics,
+                    **placeholders,
+                    "NUMBER_OF_POSTS": len(range(index, data.numPosts, shard_count)),
+                    "TOPICS": shard_topics,
                 }
             )
+
+        return shards
+
+    @staticmethod
+    def _posts_placeholders(data: GeneratePosts) -> Dict[str, Any]:
+        return {
+            "TEMPLATE": data.templateText,
+            "NUMBER_OF_POSTS": data.numPosts,
+            "TOPICS": data.topics,
+        }
+
+    async def _get_mirrored_templates(
+        self, data: GetTemplates, start: int, page_size: Optional[int]
+    ) -> Dict[str, Any]:
+        if self.template_mirror is None:
+            raise InvalidCursor(
+                f"Invalid cursor {data.cursor!r}, the template mirror is disabled"
+            )
+
+        key = self._mirror_key(data.databaseId)
+        if not self.template_mirror.is_fresh(key):
+            await self._sync_mirror(data.databaseId)
+
+        templates = self.template_mirror.templates(key)
+        end = start + page_size if page_size else len(templates)
+        formatted_templates = [
+            {"id": id, "title": template["title"], "content": template["content"]}
+            for id, template in enumerate(templates[start:end], start)
+        ]
+
+        response: Dict[str, Any] = {
+            "count": len(formatted_templates),
+            "data": formatted_templates,
+        }
+        if page_size:
+            response["nextCursor"] = (
+                f"{MIRROR_CURSOR_PREFIX}{end}" if end < len(templates) else None
+            )
+
+        return response
+
+    async def _sync_mirror(self, database_id: str) -> None:
+        if self.single_flight is None:
+            return await self._run_mirror_sync(database_id)
+
+        await self.single_flight.do(
+            ("sync_mirror", self._mirror_key(database_id)),
+            lambda: self._run_mirror_sync(database_id),
+            "sync_mirror",
         )
 
-        return posts
+    async def _run_mirror_sync(self, database_id: str) -> None:
+        key = self._mirror_key(database_id)
+        edited_since = self.template_mirror.sync_since(key)
+        pages = [
+            page
+            async for batch in self._iter_available_templates(
+                database_id, edited_since=edited_since
+            )
+            for page in batch
+        ]
 
-    def _query_available_templates(self, database_id: str) -> List[Dict]:
-        return self.notion.databases.query(
-            **{
-                "database_id": database_id,
-                "filter": {
-                    "property": "Status",
-                    "select": {
-                        "equals": "Template",
-                    },
+        if edited_since is None:
+            templates, removed = pages, []
+        else:
+            templates = [page for page in pages if _is_template(page)]
+            removed = [page["id"] for page in pages if not _is_template(page)]
+        formatted_templates = await self._format_templates(templates)
+
+        self.template_mirror.apply(
+            key,
+            [
+                {
+                    "pageId": page["id"],
+                    "title": template["title"],
+                    "content": template["content"],
+                    "createdTime": page.get("created_time", ""),
+                    "lastEditedTime": page.get("last_edited_time", ""),
+                }
+                for page, template in zip(templates, formatted_templates)
+            ],
+            removed,
+            max((page.get("last_edited_time", "") for page in pages), default=""),
+            full=edited_since is None,
+        )
+
+    def _mirror_key(self, database_id: str) -> str:
+        return f"{self.rate_limit_key}/{database_id}"
+
+    async def _query_available_templates(
+        self, database_id: str, start_cursor: Optional[str] = None
+    ) -> List[Dict]:
+        return [
+            template
+            async for templates in self._iter_available_templates(
+                database_id, start_cursor=start_cursor
+            )
+            for template in templates
+        ]
+
+    async def _iter_available_templates(
+        self,
+        database_id: str,
+        page_size: Optional[int] = None,
+        start_cursor: Optional[str] = None,
+        edited_since: Optional[str] = None,
+    ) -> AsyncIterator[List[Dict]]:
+        while True:
+            response = await self._call(
+                "databases.query",
+                **self._templates_query(
+                    database_id, page_size, start_cursor, edited_since
+                ),
+            )
+            yield response["results"]
+
+            if not response.get("has_more"):
+                break
+            start_cursor = response["next_cursor"]
+
+    @staticmethod
+    def _templates_query(
+        database_id: str,
+        page_size: Optional[int] = None,
+        start_cursor: Optional[str] = None,
+        edited_since: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        query: Dict[str, Any] = {
+            "database_id": database_id,
+            "filter": {
+                "property": "Status",
+                "select": {
+                    "equals": "Template",
                 },
+            },
+        }
+        if edited_since:
+            # Pages that stopped being templates have to show up as well.
+            query["filter"] = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {"on_or_after": edited_since},
             }
-        )["results"]
+        if page_size:
+            query["page_size"] = page_size
+        if start_cursor:
+            query["start_cursor"] = start_cursor
+
+        return query
+
+    async def _format_templates(
+        self, templates: List[Dict], start: int = 0
+    ) -> List[Dict[str, str]]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch_content(template: Dict) -> str:
+            cache_key = (template["id"], template.get("last_edited_time"))
+            content = self.template_cache.get(cache_key)
+
+            if content is None:
+                async with semaphore:
+                    blocks = await self._call(
+                        "blocks.children.list", block_id=template["id"]
+                    )
+                content = blocks["results"][0]["paragraph"]["rich_text"][0]["text"][
+                    "content"
+                ]
+                self.template_cache.set(cache_key, content)
+
+            return content
+
+        contents = await asyncio.gather(
+            *(fetch_content(template) for template in templates)
+        )
 
-    def _format_templates(self, templates: List[Dict]) -> List[Dict[str, str]]:
         return [
             {
                 "id": id,
                 "title": template["properties"]["Title"]["title"][0]["text"]["content"],
-                "content": self.notion.blocks.children.list(template["id"])["results"][
-                    0
-                ]["paragraph"]["rich_text"][0]["text"]["content"],
+                "content": content,
             }
-            for id, template in enumerate(templates)
+            for id, (template, content) in enumerate(zip(templates, contents), start)
         ]
 
-    def _create_database(self, data: Dict) -> Optional[str]:
+    async def _create_database(self, data: Dict) -> Optional[str]:
         database_id = None
         if not data.databaseId:
             properties = {
@@ -170,69 +938,245 @@ class NotionDatabase:
             icon = {"type": "emoji", "emoji": "🤖"}
             parent = {"type": "page_id", "page_id": data.pageId}
 
-            database_id = self.notion.databases.create(
+            database = await self._call(
+                "databases.create",
                 parent=parent,
                 title=title,
                 properties=properties,
                 icon=icon,
                 is_inline=True,
-            )["id"]
+            )
+            database_id = database["id"]
 
         return database_id
 
-    def _generate_template(self, data: TemplateCreate) -> Dict[str, str]:
-        template_text = self.llm({"LINKEDIN_POST": data.text})
-        return ast.literal_eval(template_text)
+    async def _generate_template(self, data: TemplateCreate) -> Dict[str, str]:
+        if self.single_flight is None:
+            return await self._templatize(data)
 
-    def _store_template_in_notion(
-        self, template: Dict[str, str], database_id: str
-    ) -> None:
-        parent = {"database_id": database_id}
-        properties = {
-            "title": {
-                "title": [{"type": "text", "text": {"content": template["title"]}}]
-            },
-            "Status": {"select": {"name": "Template"}},
-        }
-        children = [
-            {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": [
-                        {"type": "text", "text": {"content": template["post"]}}
-                    ]
-                },
-            }
+        # Scoped by the OpenAI key and the integration, so callers never share
+        # another user's LLM call or its errors, and then as the result cache.
+        key = (
+            hash_secret(data.openaiKey),
+            self.rate_limit_key,
+            self.llm.model_name,
+            self.llm.prompt_version,
+            _normalize_post(data.text),
+            data.bypassCache,
+        )
+        template = await self.single_flight.do(
+            ("generate_template", key),
+            lambda: self._templatize(data),
+            "generate_template",
+        )
+        # The caller adds its own ids to the template.
+        return dict(template)
+
+    async def _templatize(self, data: TemplateCreate) -> Dict[str, str]:
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = ResultCache.make_key(
+                self.llm.model_name, self.llm.prompt_version, _normalize_post(data.text)
+            )
+            if not data.bypassCache:
+                template = self.result_cache.get(cache_key)
+                if template is not None:
+                    return template
+
+        template_text = await self.llm.acall({"LINKEDIN_POST": data.text})
+        template = parse_object(template_text)
+
+        if template is None:
+            raise ValueError("The LLM output did not contain a valid template")
+
+        if cache_key is not None:
+            self.result_cache.set(cache_key, template)
+
+        return template
+
+    async def _generate_templates(
+        self, data: TemplatesCreate
+    ) -> List[Optional[Dict[str, str]]]:
+        templates: List[Optional[Dict[str, str]]] = [None] * len(data.texts)
+        cache_keys = [
+            ResultCache.make_key(
+                self.llm.model_name, self.llm.prompt_version, _normalize_post(text)
+            )
+            for text in data.texts
         ]
 
-        self.notion.pages.create(
-            parent=parent, properties=properties, children=children
-        )
+        if self.result_cache is not None and not data.bypassCache:
+            for index, cache_key in enumerate(cache_keys):
+                templates[index] = self.result_cache.get(cache_key)
 
-    def _store_generated_posts(
-        self, posts: List[Dict[str, str]], database_id: str
-    ) -> None:
-        for post in posts:
-            parent = {"database_id": database_id}
-            properties = {
-                "title": {
-                    "title": [{"type": "text", "text": {"content": post["title"]}}]
-                },
-                "Status": {"select": {"name": "Working"}},
-            }
-            children = [
-                {
-                    "object": "block",
-                    "type": "paragraph",
-                    "paragraph": {
-                        "rich_text": [
-                            {"type": "text", "text": {"content": post["post"]}}
-                        ]
-                    },
-                }
+        semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+        failures: List[Exception] = []
+
+        async def generate_batch(indices: List[int]) -> Dict[int, Dict[str, str]]:
+            posts = "\n".join(
+                f"[{position}] '''{data.texts[index]}'''"
+                for position, index in enumerate(indices)
+            )
+            try:
+                async with semaphore:
+                    output = await self.llm.acall({"LINKEDIN_POSTS": posts})
+            except Exception as error:
+                # The posts of the batch stay pending and are requested again.
+                logger.warning("Templatizing a batch of posts failed: %s", error)
+                failures.append(error)
+                return {}
+            records = parse_objects(output)
+
+            batch_templates = {}
+            for order, record in enumerate(records):
+                position = record.get("index", order)
+                if isinstance(position, int) and 0 <= position < len(indices):
+                    batch_templates[indices[position]] = {
+                        "title": record["title"],
+                        "post": record["post"],
+                    }
+            return batch_templates
+
+        for _ in range(1 + self.max_repair_attempts):
+            pending = [
+                index for index, template in enumerate(templates) if not template
             ]
+            if not pending:
+                break
 
-            self.notion.pages.create(
-                parent=parent, properties=properties, children=children
+            batches = await asyncio.gather(
+                *(
+                    generate_batch(pending[start : start + self.templates_per_llm_call])
+                    for start in range(0, len(pending), self.templates_per_llm_call)
+                )
             )
+            for batch_templates in batches:
+                for index, template in batch_templates.items():
+                    templates[index] = template
+                    if self.result_cache is not None:
+                        self.result_cache.set(cache_keys[index], template)
+
+        if failures and not any(templates):
+            raise failures[0]
+
+        return templates
+
+    async def _store_template_in_notion(
+        self, template: Dict[str, str], database_id: str
+    ) -> None:
+        await self.create_page(template, database_id, "Template")
+
+    async def _store_generated_posts(
+        self,
+        posts: List[Dict[str, str]],
+        database_id: str,
+        on_stored: Optional[Callable[[], None]] = None,
+    ) -> List[Dict[str, Optional[str]]]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def store(post: Dict[str, str]) -> Dict[str, Optional[str]]:
+            result = await self._store_post(post, database_id, semaphore)
+            if result["error"] is None and on_stored is not None:
+                on_stored()
+            return result
+
+        return await asyncio.gather(*(store(post) for post in posts))
+
+    def _abandon(self, writes: Set["asyncio.Future[Any]"], pages: int) -> None:
+        if self.persist_on_cancel:
+            for write in writes:
+                _detached_writes.add(write)
+                write.add_done_callback(_detached_writes.discard)
+        else:
+            for write in writes:
+                write.cancel()
+            NOTION_WRITES_CANCELLED.inc(pages)
+
+    async def _store_post(
+        self, post: Dict[str, str], database_id: str, semaphore: asyncio.Semaphore
+    ) -> Dict[str, Optional[str]]:
+        try:
+            async with semaphore:
+                page = await self.create_page(post, database_id, "Working")
+        except Exception as error:
+            logger.warning("Storing post %r failed: %s", post.get("title"), error)
+            return {"pageId": None, "error": str(error)}
+
+        return {"pageId": page["id"], "error": None}
+
+    async def _call(self, method: str, **kwargs: Any) -> Any:
+        function: Any = self.notion
+        for name in method.split("."):
+            function = getattr(function, name)
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                waited = await self.rate_limiter.acquire(self.rate_limit_key)
+                NOTION_RATE_LIMIT_WAIT.observe(waited, method=method)
+
+            try:
+                with tracer.span(
+                    f"notion.{method}", kind="client", **{"notion.attempt": attempt}
+                ):
+                    return await self._timed_call(method, function, kwargs)
+            except Exception as error:
+                idempotent = method not in NON_IDEMPOTENT_METHODS
+                if attempt >= self.max_retries or not is_retryable(error, idempotent):
+                    raise
+                delay = backoff_delay(attempt, retry_after(error))
+                status = str(getattr(error, "status", "timeout"))
+                NOTION_RETRIES.inc(method=method, status=status)
+                logger.info("Retrying %s after %s in %.2fs", method, status, delay)
+
+                if self.rate_limiter is not None and status == "429":
+                    # Holds back every request of the integration, not just this one.
+                    await self.rate_limiter.penalize(self.rate_limit_key, delay)
+                else:
+                    await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _timed_call(
+        self, method: str, function: Callable[..., Any], kwargs: Dict[str, Any]
+    ) -> Any:
+        status = "cancelled"
+        start = time.perf_counter()
+        with NOTION_IN_FLIGHT.track_inprogress(method=method):
+            try:
+                response = await function(**kwargs)
+            except Exception as error:
+                status = str(getattr(error, "status", None) or "error")
+                raise
+            else:
+                status = "ok"
+            finally:
+                NOTION_LATENCY.observe(
+                    time.perf_counter() - start, method=method, status=status
+                )
+
+        return response
+
+
+def _is_template(page: Dict) -> bool:
+    status = page.get("properties", {}).get("Status", {}).get("select") or {}
+    return status.get("name") == "Template"
+
+
+def _deduplicate_posts(posts: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    seen = set()
+    unique_posts = []
+    for post in posts:
+        keys = {
+            ("title", " ".join(post["title"].lower().split())),
+            ("post", " ".join(post["post"].lower().split())),
+        }
+        if seen.isdisjoint(keys):
+            seen.update(keys)
+            unique_posts.append(post)
+
+    return unique_posts
+
+
+def _normalize_post(text: str) -> str:
+    lines = unicodedata.normalize("NFC", text).replace("\r\n", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
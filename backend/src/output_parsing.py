@@ -0,0 +1,283 @@
+import ast
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from src.metrics import PARSE_LATENCY
+from src.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+QUOTES = "'\""
+RECORD_KEYS = ("title", "post")
+CODE_FENCE = re.compile(r"^\s*```[a-zA-Z]*\s*\n?|\n?\s*```\s*$")
+RECORD_BOUNDARY = re.compile(r"\}\s*,?\s*(?=\{\s*['\"]title['\"])")
+# Anchored on the keys, so unescaped quotes inside the post are tolerated.
+RECORD_PATTERN = re.compile(
+    r"""^\{\s*(['"])title\1\s*:\s*(?P<title_quote>'''|\"\"\"|'|")(?P<title>.*?)"""
+    r"""(?P=title_quote)\s*,\s*(['"])post\4\s*:\s*(?P<post_quote>'''|\"\"\"|'|")"""
+    r"""(?P<post>.*)(?P=post_quote)\s*\}$""",
+    re.DOTALL,
+)
+ESCAPE = re.compile(r"\\[\\n'\"]")
+ESCAPES = {"\\n": "\n", "\\'": "'", '\\"': '"', "\\\\": "\\"}
+
+
+class IncrementalObjectParser:
+    """This class extracts the dictionaries of a list literal produced by the LLM
+    while the completion is still being streamed.
+
+    The prompts ask for `[{"title": '''...''', "post": '''...'''}, ...]`, so the
+    parser tracks brace depth outside of (single, double or triple quoted) string
+    literals and evaluates every top level object as soon as its closing brace
+    arrives. When an object is malformed, the well-formed objects nested in it
+    are salvaged.
+
+    Methods:
+    - feed(chunk: str) -> List[Dict[str, Any]]: Consumes the next chunk of the
+        completion and returns the objects completed by it.
+    - close() -> List[Dict[str, Any]]: Flushes the parser at the end of the
+        completion.
+
+    Example:
+    ```python
+    parser = IncrementalObjectParser()
+    async for chunk in llm.astream(placeholder_mapping):
+        for post in parser.feed(chunk):
+            ...
+    parser.close()
+    ```
+    """
+
+    def __init__(self) -> None:
+        """Initialize the incremental parser."""
+        self._buffer = ""
+        self._position = 0
+        self._depth = 0
+        self._start: Optional[int] = None
+        self._quote: Optional[str] = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Consumes the next chunk of the completion.
+
+        Args:
+            chunk (str): The next piece of the completion.
+
+        Returns:
+            List[Dict[str, Any]]: The objects completed by this chunk.
+        """
+        self._buffer += chunk
+        return self._scan(final=False)
+
+    def close(self) -> List[Dict[str, Any]]:
+        """Flushes the parser at the end of the completion.
+
+        Returns:
+            List[Dict[str, Any]]: The objects completed by the remaining input.
+        """
+        return self._scan(final=True)
+
+    def _scan(self, final: bool) -> List[Dict[str, Any]]:
+        objects = []
+        buffer = self._buffer
+        index = self._position
+
+        while index < len(buffer):
+            char = buffer[index]
+
+            if self._quote is not None:
+                if char == "\\":
+                    if index + 1 >= len(buffer) and not final:
+                        break
+                    index += 2
+                elif buffer.startswith(self._quote, index):
+                    index += len(self._quote)
+                    self._quote = None
+                elif (
+                    len(self._quote) == 3
+                    and char == self._quote[0]
+                    and len(buffer) - index < 3
+                    and not final
+                ):
+                    # The closing triple quote may be split across chunks.
+                    break
+                else:
+                    index += 1
+                continue
+
+            if char in QUOTES:
+                if len(buffer) - index < 3 and not final:
+                    break
+                self._quote = char * 3 if buffer.startswith(char * 3, index) else char
+                index += len(self._quote)
+                continue
+
+            if char == "{":
+                if self._depth == 0:
+                    self._start = index
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.extend(self._evaluate(buffer[self._start : index + 1]))
+                    self._start = None
+            index += 1
+
+        if self._depth == 0 and self._quote is None:
+            self._buffer = buffer[index:]
+            self._position = 0
+        else:
+            self._position = index
+
+        return objects
+
+    @staticmethod
+    def _evaluate(literal: str) -> List[Dict[str, Any]]:
+        parsed = evaluate_literal(literal)
+        if isinstance(parsed, dict):
+            return [parsed]
+
+        repaired = repair_record(literal)
+        if repaired is not None:
+            return [repaired]
+
+        # A broken wrapper object may still contain well-formed records.
+        parser = IncrementalObjectParser()
+        salvaged = parser.feed(literal[1:-1]) + parser.close()
+        if not salvaged:
+            logger.warning("Skipping malformed object in LLM output: %.80r", literal)
+        return salvaged
+
+
+def evaluate_literal(text: str) -> Any:
+    """Evaluates a Python or JSON literal produced by the LLM.
+
+    Args:
+        text (str): The literal.
+
+    Returns:
+        Any: The evaluated value, or None if the text is not a valid literal.
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+
+    try:
+        # strict=False accepts raw newlines inside strings, a common LLM mistake.
+        return json.loads(text, strict=False)
+    except ValueError:
+        return None
+
+
+def repair_record(literal: str) -> Optional[Dict[str, str]]:
+    """Recovers a `{"title": ..., "post": ...}` record that is not a valid literal,
+    e.g. because of an unescaped quote inside the post.
+
+    Args:
+        literal (str): The malformed object literal.
+
+    Returns:
+        Optional[Dict[str, str]]: The recovered record, or None.
+    """
+    match = RECORD_PATTERN.match(literal.strip())
+    if match is None:
+        return None
+
+    return {
+        key: ESCAPE.sub(lambda escape: ESCAPES[escape.group()], match[key])
+        for key in RECORD_KEYS
+    }
+
+
+def parse_object(text: str) -> Optional[Dict[str, Any]]:
+    """Parses a single `{"title": ..., "post": ...}` record from an LLM output.
+
+    Args:
+        text (str): The LLM output.
+
+    Returns:
+        Optional[Dict[str, Any]]: The first valid record, or None.
+    """
+    records = parse_objects(text)
+    return records[0] if records else None
+
+
+def parse_objects(text: str) -> List[Dict[str, Any]]:
+    """Parses the `{"title": ..., "post": ...}` records from an LLM output.
+
+    The output may be a Python or JSON list, a JSON object wrapping the list (as
+    produced in JSON mode) or a single record, optionally inside a Markdown code
+    fence. If it is not valid as a whole, every well-formed record is salvaged and
+    the malformed ones are dropped.
+
+    Args:
+        text (str): The LLM output.
+
+    Returns:
+        List[Dict[str, Any]]: The valid records in order of appearance.
+    """
+    with PARSE_LATENCY.time(), tracer.span("llm.parse", **{"text.length": len(text)}):
+        text = CODE_FENCE.sub("", text.strip())
+        parsed = evaluate_literal(text)
+
+        if parsed is None:
+            parser = IncrementalObjectParser()
+            salvaged = parser.feed(text) + parser.close()
+            # A stray quote derails the string tracking of the parser, splitting on
+            # the record boundaries recovers the records after it.
+            split = _split_records(text)
+            candidates = max(split, salvaged, key=lambda found: len(_records(found)))
+        elif isinstance(parsed, (list, tuple)):
+            candidates = list(parsed)
+        else:
+            candidates = [parsed]
+
+        return _records(candidates)
+
+
+def _records(candidates: List[Any]) -> List[Dict[str, Any]]:
+    records = []
+    for candidate in candidates:
+        if is_record(candidate):
+            records.append(candidate)
+        elif isinstance(candidate, dict):
+            # JSON mode wraps the list in an object, e.g. {"posts": [...]}.
+            for value in candidate.values():
+                if isinstance(value, list):
+                    records.extend(item for item in value if is_record(item))
+
+    return records
+
+
+def is_record(candidate: Any) -> bool:
+    """Returns whether the candidate is a `{"title": ..., "post": ...}` record.
+
+    Args:
+        candidate (Any): The parsed value.
+
+    Returns:
+        bool: True if the candidate has string `title` and `post` values.
+    """
+    return isinstance(candidate, dict) and all(
+        isinstance(candidate.get(key), str) for key in RECORD_KEYS
+    )
+
+
+def _split_records(text: str) -> List[Any]:
+    records = []
+    for piece in RECORD_BOUNDARY.split(text):
+        start = piece.find("{")
+        if start == -1:
+            continue
+        end = piece.rfind("}")
+        literal = piece[start : end + 1] if end > start else piece[start:] + "}"
+
+        parsed = evaluate_literal(literal)
+        if parsed is None:
+            parsed = repair_record(literal)
+        if parsed is not None:
+            records.append(parsed)
+
+    return records
@@ -0,0 +1,162 @@
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+
+def hash_secret(secret: str) -> str:
+    """Returns a stable digest of a secret so it can be used in keys and logs.
+
+    Args:
+        secret (str): The secret, e.g. an API key.
+
+    Returns:
+        str: The hex encoded SHA-256 digest of the secret.
+    """
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+
+class _Entry(Generic[T]):
+    def __init__(self, resource: T, created_at: float) -> None:
+        self.resource = resource
+        self.created_at = created_at
+        self.leases = 0
+        self.retired = False
+
+
+class ResourcePool(Generic[T]):
+    """This class keeps expensive per-tenant resources (API clients, LLM chains)
+    alive across requests.
+
+    Resources are keyed by the caller, are evicted least recently used first once
+    the pool holds `maxsize` entries, and are recreated after `ttl` seconds. An
+    evicted resource is only closed once the last request using it released it.
+
+    Parameters:
+    - maxsize (int, optional): The maximum number of pooled resources.
+        Defaults to 64.
+    - ttl (float, optional): The number of seconds a resource is reused before it is
+        recreated. Defaults to 900.
+    - close (Callable[[T], Awaitable[None]], optional): Coroutine function used to
+        release an evicted resource. Defaults to None.
+    - clock (Callable[[], float], optional): The time source. Defaults to
+        `time.monotonic`.
+
+    Methods:
+    - acquire(key: Hashable, create: Callable[[], T]) -> AsyncIterator[T]: Context
+        manager leasing the resource stored under `key`, creating it when missing.
+    - aclose() -> None: Closes every pooled resource.
+
+    Example:
+    ```python
+    pool = ResourcePool(maxsize=32, close=lambda client: client.aclose())
+
+    key = hash_secret(notion_key)
+    async with pool.acquire(key, lambda: AsyncClient(auth=notion_key)) as notion:
+        await notion.users.me()
+    ```
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 64,
+        ttl: float = 900.0,
+        close: Optional[Callable[[T], Awaitable[None]]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Initialize the resource pool.
+
+        Parameters:
+        - maxsize (int, optional): The maximum number of pooled resources.
+            Defaults to 64.
+        - ttl (float, optional): The number of seconds a resource is reused before
+            it is recreated. Defaults to 900.
+        - close (Callable[[T], Awaitable[None]], optional): Coroutine function used
+            to release an evicted resource. Defaults to None.
+        - clock (Callable[[], float], optional): The time source. Defaults to
+            `time.monotonic`.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._close = close
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, _Entry[T]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Returns the number of pooled resources."""
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable, create: Callable[[], T]) -> AsyncIterator[T]:
+        """Leases the resource stored under `key`, creating it when missing.
+
+        Args:
+            key (Hashable): The pool key, it should not contain raw secrets.
+            create (Callable[[], T]): Factory for a new resource.
+
+        Yields:
+            T: The pooled resource.
+        """
+        entry = await self._checkout(key, create)
+        try:
+            yield entry.resource
+        finally:
+            entry.leases -= 1
+            if entry.retired and entry.leases == 0:
+                await self._release(entry)
+
+    async def aclose(self) -> None:
+        """Closes every pooled resource."""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            await self._retire(entry)
+
+    async def _checkout(self, key: Hashable, create: Callable[[], T]) -> _Entry[T]:
+        now = self._clock()
+        entry = self._entries.get(key)
+
+        if entry is not None and now - entry.created_at >= self.ttl:
+            del self._entries[key]
+            await self._retire(entry)
+            entry = None
+
+        if entry is None:
+            entry = _Entry(create(), now)
+            self._entries[key] = entry
+
+        self._entries.move_to_end(key)
+        # Lease before awaiting anything so a concurrent eviction cannot close it.
+        entry.leases += 1
+
+        evicted: List[_Entry[T]] = []
+        while len(self._entries) > self.maxsize:
+            evicted.append(self._entries.popitem(last=False)[1])
+        for old_entry in evicted:
+            await self._retire(old_entry)
+
+        return entry
+
+    async def _retire(self, entry: _Entry[T]) -> None:
+        entry.retired = True
+        if entry.leases == 0:
+            await self._release(entry)
+
+    async def _release(self, entry: _Entry[T]) -> None:
+        if self._close is not None:
+            await self._close(entry.resource)
@@ -0,0 +1,190 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from types import CodeType, FrameType
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from src.metrics import PROFILES_CAPTURED
+
+logger = logging.getLogger(__name__)
+
+# The code objects and line numbers of a stack, outermost frame first.
+Stack = Tuple[Tuple[CodeType, int], ...]
+
+
+class SlowRequestProfiler:
+    """This class samples the stacks of the threads handling requests and keeps a
+    profile of every request slower than a threshold.
+
+    A background thread records the stack of every thread with a watched request
+    each `interval` seconds into a bounded ring buffer, and sleeps while no
+    request is watched. Once a watched request took longer than `threshold`, the
+    samples taken meanwhile are written to `<path>/<name>.folded` in the collapsed
+    stack format read by flamegraph.pl and speedscope. The event loop serves
+    concurrent requests in turns, so the profile shows the loop during the slow
+    request, including work done for other requests and time spent waiting in
+    `select` for the network.
+
+    Parameters:
+    - threshold (float): The latency in seconds above which a profile is kept.
+    - path (str): The folder the profiles are written to.
+    - interval (float, optional): The sampling interval in seconds.
+        Defaults to 0.005.
+    - max_samples (int, optional): The capacity of the ring buffer, i.e. the
+        longest profile is `max_samples * interval` seconds. Defaults to 12000.
+    - clock (Callable[[], float], optional): Returns the current time.
+        Defaults to `time.monotonic`.
+
+    Methods:
+    - watch(name: str) -> Iterator[Dict[str, Any]]: Context manager sampling the
+        current thread while the block runs, and keeping a profile if it was slow.
+    - close() -> None: Stops the sampling thread.
+
+    Example:
+    ```python
+    profiler = SlowRequestProfiler(threshold=2.0, path="profiles")
+    with profiler.watch(trace_id) as profile:
+        await handle(request)
+    profile.get("path")
+    ```
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        path: str,
+        interval: float = 0.005,
+        max_samples: int = 12000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Initialize the profiler.
+
+        Parameters:
+        - threshold (float): The latency in seconds above which a profile is kept.
+        - path (str): The folder the profiles are written to.
+        - interval (float, optional): The sampling interval in seconds.
+            Defaults to 0.005.
+        - max_samples (int, optional): The capacity of the ring buffer.
+            Defaults to 12000.
+        - clock (Callable[[], float], optional): Returns the current time.
+            Defaults to `time.monotonic`.
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+
+        self.threshold = threshold
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self._samples: Deque[Tuple[float, int, Stack]] = collections.deque(
+            maxlen=max_samples
+        )
+        self._watched: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def watch(self, name: str) -> Iterator[Dict[str, Any]]:
+        """Samples the current thread while the block runs, and writes a profile
+        if the block took longer than the threshold.
+
+        Args:
+            name (str): The file name of the profile, e.g. the trace id.
+
+        Yields:
+            Dict[str, Any]: Receives the `path` of the profile, if one was written,
+                when the block exits.
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._watched[thread_id] = self._watched.get(thread_id, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._sample_loop, name="profiler", daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+
+        profile: Dict[str, Any] = {}
+        start = self.clock()
+        try:
+            yield profile
+        finally:
+            end = self.clock()
+            with self._lock:
+                self._watched[thread_id] -= 1
+                if not self._watched[thread_id]:
+                    del self._watched[thread_id]
+                    if not self._watched:
+                        self._wake.clear()
+            if end - start >= self.threshold:
+                profile["path"] = self._write(name, thread_id, start, end)
+
+    def close(self) -> None:
+        """Stops the sampling thread."""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample_loop(self) -> None:
+        while not self._closed:
+            self._wake.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._watched)
+            now = self.clock()
+            frames = sys._current_frames()
+            for thread_id in watched:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self._samples.append((now, thread_id, _stack(frame)))
+            # Drops the references to the frames of the sampled threads.
+            del frames
+
+    def _write(
+        self, name: str, thread_id: int, start: float, end: float
+    ) -> Optional[str]:
+        counts: Dict[Stack, int] = collections.Counter(
+            stack
+            for taken, sampled_thread, stack in list(self._samples)
+            if sampled_thread == thread_id and start <= taken <= end
+        )
+        if not counts:
+            return None
+
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, f"{name}.folded")
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in counts.items():
+                file.write(";".join(_label(*frame) for frame in stack) + f" {count}\n")
+
+        PROFILES_CAPTURED.inc()
+        logger.warning(
+            "Request %s took %.2fs, wrote a profile of %d samples to %s",
+            name,
+            end - start,
+            sum(counts.values()),
+            path,
+        )
+        return path
+
+
+def _stack(frame: Optional[FrameType]) -> Stack:
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _label(code: CodeType, line: int) -> str:
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{line})".replace(";", ":")
@@ -1,4 +1,4 @@
-templatizing_prompt = """
+templatizing_instructions = """
     You are GPT-Template, a program that turns LinkedIn Posts into \
     perfectly usable templates. A template is a piece of content \
     with the right formatting & post structure, with bracket like \
@@ -39,9 +39,28 @@ templatizing_prompt = """
     Please do your best, this is \
     important to my career. I'm going to tip you \
     $200 for a perfect response.\
-    This is the LinkedIn post: '{LINKEDIN_POST}'.
     """
 
+templatizing_prompt = (
+    templatizing_instructions
+    + """This is the LinkedIn post: '{LINKEDIN_POST}'.
+    """
+)
+
+batch_templatizing_prompt = (
+    templatizing_instructions
+    + """Now you will get several LinkedIn posts instead of one, \
+    each one starting with its index in brackets like [0]. \
+    Make one template per post and output a list of \
+    dictionaries in minimized form (no spaces, ideally one line): \
+    [{{"index": 0, "title": \'\'\'Short title of template\'\'\', \
+    "post": \'\'\'The template you made\'\'\'}}, {{"index": 1, \
+    "title": \'\'\'Another short title\'\'\', "post": \
+    \'\'\'Another template you made\'\'\'}}]\
+    These are the LinkedIn posts: {LINKEDIN_POSTS}
+    """
+)
+
 creating_posts_prompt = """
     You are a viral Content creator. You will \
     take a template and a topic, and generate posts from it.\
@@ -60,3 +79,22 @@ creating_posts_prompt = """
     Please do your best, this is important to my career. \
     I'm going to tip you $200 for a perfect response.
     """
+
+json_templatizing_format = """
+    Answer with valid JSON only, using an object \
+    of the form {{"title": "Short title of template", \
+    "post": "The template you made"}} instead of the format above.
+    """
+
+json_creating_posts_format = """
+    Answer with valid JSON only, using an object \
+    of the form {{"posts": [{{"title": "Short Title of the post", \
+    "post": "The post you made"}}]}} instead of the format above.
+    """
+
+json_batch_templatizing_format = """
+    Answer with valid JSON only, using an object \
+    of the form {{"templates": [{{"index": 0, \
+    "title": "Short title of template", \
+    "post": "The template you made"}}]}} instead of the format above.
+    """
@@ -0,0 +1,246 @@
+import asyncio
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+# Reads can be repeated safely, writes only when Notion rejected them outright.
+IDEMPOTENT_STATUSES = (429, 500, 502, 503, 504)
+NON_IDEMPOTENT_STATUSES = (429,)
+
+
+class RateLimiter:
+    """This class implements a token bucket rate limiter keyed by the caller,
+    e.g. by the Notion integration token.
+
+    Every key refills `rate` tokens per second up to `burst` tokens. Callers
+    reserve a token and sleep until it becomes available, so concurrent requests
+    are spread out instead of failing. With a `path`, the buckets live in SQLite
+    and are shared by every worker process on the host. Their transactions run
+    on a thread of their own, so waiting for another process's lock does not
+    block the event loop.
+
+    Parameters:
+    - rate (float, optional): The number of tokens refilled per second.
+        Defaults to 3, Notion's average limit.
+    - burst (float, optional): The maximum number of stored tokens. Defaults to 3.
+    - path (str, optional): The SQLite database file shared between processes.
+        Defaults to None, which keeps the buckets in memory.
+    - clock (Callable[[], float], optional): The time source, it has to agree
+        between processes. Defaults to `time.time`.
+    - sleep (Callable[[float], Awaitable[None]], optional): The coroutine function
+        used to wait. Defaults to `asyncio.sleep`.
+
+    Methods:
+    - acquire(key: str) -> float: Waits for a token and returns the time waited.
+    - penalize(key: str, delay: float) -> None: Hands out no tokens for `delay`
+        seconds, e.g. after a 429 response.
+    - close() -> None: Closes the SQLite backend and its thread.
+
+    Example:
+    ```python
+    limiter = RateLimiter(rate=3, path="notion_rate_limit.sqlite3")
+    await limiter.acquire(hash_secret(notion_key))
+    await notion.pages.create(...)
+    ```
+    """
+
+    def __init__(
+        self,
+        rate: float = 3.0,
+        burst: float = 3.0,
+        path: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    ) -> None:
+        """Initialize the rate limiter.
+
+        Parameters:
+        - rate (float, optional): The number of tokens refilled per second.
+            Defaults to 3, Notion's average limit.
+        - burst (float, optional): The maximum number of stored tokens.
+            Defaults to 3.
+        - path (str, optional): The SQLite database file shared between processes.
+            Defaults to None, which keeps the buckets in memory.
+        - clock (Callable[[], float], optional): The time source, it has to agree
+            between processes. Defaults to `time.time`.
+        - sleep (Callable[[float], Awaitable[None]], optional): The coroutine
+            function used to wait. Defaults to `asyncio.sleep`.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        if path is not None:
+            # Autocommit mode, transactions are opened explicitly below.
+            self._connection = sqlite3.connect(
+                path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            # A single thread, so the connection runs one transaction at a time.
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="rate-limiter"
+            )
+
+    async def acquire(self, key: str) -> float:
+        """Reserves a token and waits until it is available.
+
+        Args:
+            key (str): The bucket key, it should not contain raw secrets.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        delay = await self._update(key, lambda tokens: tokens - 1)
+        if delay > 0:
+            await self._sleep(delay)
+        return delay
+
+    async def penalize(self, key: str, delay: float) -> None:
+        """Hands out no tokens for `delay` seconds, e.g. after a 429 response.
+
+        Args:
+            key (str): The bucket key.
+            delay (float): The number of seconds to back off.
+        """
+        await self._update(key, lambda tokens: min(tokens, -delay * self.rate))
+
+    def close(self) -> None:
+        """Closes the SQLite backend and its thread."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def _update(self, key: str, change: Callable[[float], float]) -> float:
+        now = self._clock()
+
+        if self._connection is None:
+            tokens = change(self._refill(self._buckets.get(key), now))
+            self._buckets[key] = (tokens, now)
+            return max(0.0, -tokens / self.rate)
+
+        # Waiting for the lock of another process can take up to the busy timeout.
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._update_shared, self._connection, key, change, now
+        )
+
+    def _update_shared(
+        self,
+        connection: sqlite3.Connection,
+        key: str,
+        change: Callable[[float], float],
+        now: float,
+    ) -> float:
+        # BEGIN IMMEDIATE takes the write lock, so processes update atomically.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = change(self._refill(row, now))
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) "
+                "VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+        return max(0.0, -tokens / self.rate)
+
+    def _refill(self, bucket: Optional[Tuple[float, float]], now: float) -> float:
+        if bucket is None:
+            return self.burst
+
+        tokens, updated_at = bucket
+        return min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+
+
+def is_retryable(error: Exception, idempotent: bool) -> bool:
+    """Returns whether a failed Notion call may be sent again.
+
+    Args:
+        error (Exception): The raised error.
+        idempotent (bool): Whether repeating the call cannot create duplicates.
+
+    Returns:
+        bool: True for throttled calls, and for transient failures of idempotent
+            calls.
+    """
+    if isinstance(error, RequestTimeoutError):
+        return idempotent
+    if isinstance(error, HTTPResponseError):
+        statuses = IDEMPOTENT_STATUSES if idempotent else NON_IDEMPOTENT_STATUSES
+        return error.status in statuses
+    return False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Returns the delay requested by the `Retry-After` header of a response.
+
+    Args:
+        error (Exception): The raised error.
+
+    Returns:
+        Optional[float]: The delay in seconds, or None without a valid header.
+    """
+    headers = getattr(error, "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+    attempt: int,
+    requested: Optional[float] = None,
+    base: float = 0.5,
+    cap: float = 30.0,
+) -> float:
+    """Returns the jittered delay before the next attempt.
+
+    Args:
+        attempt (int): The number of failed attempts so far, starting at 0.
+        requested (float, optional): The delay requested by the server.
+            Defaults to None.
+        base (float, optional): The delay of the first attempt. Defaults to 0.5.
+        cap (float, optional): The maximum exponential delay. Defaults to 30.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    if requested is not None:
+        # Up to 10% jitter so the waiting callers do not retry in lockstep.
+        return requested * random.uniform(1.0, 1.1)
+
+    return random.uniform(0, min(cap, base * 2**attempt))
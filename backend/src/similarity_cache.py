@@ -0,0 +1,187 @@
+import copy
+import re
+import zlib
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+from src.metrics import SIMILARITY_CACHE_LOOKUPS, SIMILARITY_CACHE_SIMILARITY
+
+WORD = re.compile(r"\w+")
+# Joining words that do not change what the posts are about.
+STOP_WORDS = frozenset(
+    ("and", "or", "the", "of", "on", "in", "for", "to", "with", "about", "an")
+)
+
+
+def hash_vector(text: str, dimensions: int = 1024) -> np.ndarray:
+    """Embeds a text as an L2 normalized vector of hashed features.
+
+    The features are the words and, with half the weight, their character
+    trigrams, so the order of the words does not matter and variants of a word
+    still count partially. Numbers are words, "week 1" and "week 2" differ. They are
+    hashed with CRC-32, which unlike `hash` is stable across processes, and a
+    second bit of the hash picks their sign to cancel out collisions.
+
+    Args:
+        text (str): The text, e.g. the topics of a request.
+        dimensions (int, optional): The length of the vector. Defaults to 1024.
+
+    Returns:
+        np.ndarray: The vector, all zeros if the text has no words.
+    """
+    features: Counter = Counter()
+    for word in WORD.findall(text.lower()):
+        if word in STOP_WORDS:
+            continue
+        features[word] += 1.0
+        padded = f"<{word}>"
+        for start in range(len(padded) - 2):
+            features["#" + padded[start : start + 3]] += 0.5
+
+    vector = np.zeros(dimensions)
+    for feature, weight in features.items():
+        digest = zlib.crc32(feature.encode("utf-8"))
+        sign = 1.0 if digest & 0x80000000 else -1.0
+        vector[digest % dimensions] += sign * weight
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SimilarityCache:
+    """This class caches results under an exact key plus a text, and answers
+    lookups whose text is similar enough to a cached one.
+
+    Entries with the same exact key form a bucket, e.g. one per template. A lookup
+    embeds its text with `hash_vector` and returns the value of the most similar
+    text of its bucket if their cosine similarity reaches the threshold. Entries
+    are evicted least recently used first. Values are copied, so callers may
+    mutate them.
+
+    Parameters:
+    - maxsize (int, optional): The maximum number of entries. Defaults to 1024.
+    - threshold (float, optional): The minimum cosine similarity of a hit.
+        Defaults to 0.9.
+    - dimensions (int, optional): The length of the text vectors.
+        Defaults to 1024.
+
+    Attributes:
+    - hits (int): The number of lookups answered from the cache.
+    - misses (int): The number of lookups that found nothing similar enough.
+
+    Methods:
+    - get(key: Hashable, text: str) -> Any: Returns the value cached for the most
+        similar text, or None.
+    - set(key: Hashable, text: str, value: Any) -> None: Caches a value.
+
+    Example:
+    ```python
+    cache = SimilarityCache(threshold=0.9)
+    cache.set(template_key, "AI, startups", posts)
+    cache.get(template_key, "startups and AI")  # posts
+    ```
+    """
+
+    def __init__(
+        self, maxsize: int = 1024, threshold: float = 0.9, dimensions: int = 1024
+    ) -> None:
+        """Initialize the similarity cache.
+
+        Parameters:
+        - maxsize (int, optional): The maximum number of entries.
+            Defaults to 1024.
+        - threshold (float, optional): The minimum cosine similarity of a hit.
+            Defaults to 0.9.
+        - dimensions (int, optional): The length of the text vectors.
+            Defaults to 1024.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be between 0 and 1")
+
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[Hashable, str], Any]" = OrderedDict()
+        self._buckets: Dict[Hashable, Dict[str, np.ndarray]] = {}
+        self._matrices: Dict[Hashable, Tuple[Tuple[str, ...], np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        """Returns the number of cached entries."""
+        return len(self._entries)
+
+    def get(self, key: Hashable, text: str) -> Any:
+        """Returns the value cached for the most similar text of the key and marks
+        it as recently used.
+
+        Args:
+            key (Hashable): The exact part of the key, e.g. the template.
+            text (str): The text compared by similarity, e.g. the topics.
+
+        Returns:
+            Any: A copy of the cached value, or None if no cached text is similar
+                enough.
+        """
+        match = self._most_similar(key, hash_vector(text, self.dimensions))
+        if match is None:
+            self.misses += 1
+            SIMILARITY_CACHE_LOOKUPS.inc(outcome="miss")
+            return None
+
+        cached_text, similarity = match
+        self.hits += 1
+        SIMILARITY_CACHE_LOOKUPS.inc(outcome="hit")
+        SIMILARITY_CACHE_SIMILARITY.observe(similarity)
+        self._entries.move_to_end((key, cached_text))
+        return copy.deepcopy(self._entries[(key, cached_text)])
+
+    def set(self, key: Hashable, text: str, value: Any) -> None:
+        """Caches a value and evicts the least recently used entries when full.
+
+        Args:
+            key (Hashable): The exact part of the key, e.g. the template.
+            text (str): The text compared by similarity, e.g. the topics.
+            value (Any): The value to cache.
+        """
+        vector = hash_vector(text, self.dimensions)
+        if not vector.any():
+            return
+
+        self._entries[(key, text)] = copy.deepcopy(value)
+        self._entries.move_to_end((key, text))
+        self._buckets.setdefault(key, {})[text] = vector
+        self._matrices.pop(key, None)
+
+        while len(self._entries) > self.maxsize:
+            (evicted_key, evicted_text), _ = self._entries.popitem(last=False)
+            bucket = self._buckets[evicted_key]
+            del bucket[evicted_text]
+            if not bucket:
+                del self._buckets[evicted_key]
+            self._matrices.pop(evicted_key, None)
+
+    def _most_similar(
+        self, key: Hashable, vector: np.ndarray
+    ) -> Optional[Tuple[str, float]]:
+        bucket = self._buckets.get(key)
+        if bucket is None or not vector.any():
+            return None
+
+        cached = self._matrices.get(key)
+        if cached is None:
+            texts = tuple(bucket)
+            cached = (texts, np.stack([bucket[text] for text in texts]))
+            self._matrices[key] = cached
+        texts, matrix = cached
+
+        # The vectors are normalized, so their dot products are the cosines.
+        similarities = matrix @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return texts[best], float(similarities[best])
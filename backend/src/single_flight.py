@@ -0,0 +1,85 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+from src.metrics import SINGLE_FLIGHT_CALLS
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """This class merges concurrent calls of the same operation into one.
+
+    The first caller of a key starts the call, callers arriving while it runs wait
+    for the same result or exception instead of repeating it. Nothing is kept once
+    the call finished, caching is left to the caller. The call runs in its own
+    task, so a waiter that is cancelled does not cancel it for the others; it is
+    only cancelled when every waiter left.
+
+    Methods:
+    - do(key: Hashable, function: Callable[[], Awaitable[T]],
+        operation: str = "call") -> T: Returns the result of the call in flight
+        for the key, or starts it.
+
+    Example:
+    ```python
+    single_flight = SingleFlight()
+    templates = await single_flight.do(
+        ("get_templates", database_id), lambda: fetch_templates(database_id)
+    )
+    ```
+    """
+
+    def __init__(self) -> None:
+        """Initialize the single-flight group."""
+        self._calls: Dict[Hashable, Tuple[asyncio.Task, Dict[str, int]]] = {}
+
+    def __len__(self) -> int:
+        """Returns the number of calls in flight."""
+        return len(self._calls)
+
+    async def do(
+        self,
+        key: Hashable,
+        function: Callable[[], Awaitable[T]],
+        operation: str = "call",
+    ) -> T:
+        """Returns the result of the call in flight for the key, or starts it.
+
+        Args:
+            key (Hashable): Identifies identical calls, it should not contain raw
+                secrets.
+            function (Callable[[], Awaitable[T]]): Starts the call.
+            operation (str, optional): The metric label of the call.
+                Defaults to "call".
+
+        Returns:
+            T: The result of the call, shared by every waiter.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(function())
+            call = (task, {"waiters": 0})
+            self._calls[key] = call
+            task.add_done_callback(lambda _: self._forget(key, task))
+            SINGLE_FLIGHT_CALLS.inc(operation=operation, role="leader")
+        else:
+            SINGLE_FLIGHT_CALLS.inc(operation=operation, role="follower")
+
+        task, state = call
+        state["waiters"] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            state["waiters"] -= 1
+            if not state["waiters"] and not task.done():
+                # Later callers start over instead of joining the cancelled call.
+                self._forget(key, task)
+                task.cancel()
+
+    def _forget(self, key: Hashable, task: "asyncio.Task[Any]") -> None:
+        call = self._calls.get(key)
+        if call is not None and call[0] is task:
+            del self._calls[key]
+        if task.done() and not task.cancelled():
+            # Retrieved here, so failures nobody waits for are not logged.
+            task.exception()
@@ -0,0 +1,246 @@
+import sqlite3
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class TemplateMirror:
+    """This class keeps a local SQLite copy of the templates of Notion databases.
+
+    A mirror is refreshed incrementally with the pages edited since the newest
+    `last_edited_time` it has seen. Pages deleted in Notion do not show up in that
+    query, so a full sync replaces the mirror every `full_sync_interval` seconds.
+    Reads are served from the mirror as long as its last sync is at most
+    `max_staleness` seconds old.
+
+    Parameters:
+    - path (str, optional): The SQLite database file. Defaults to None, which keeps
+        the mirror in memory.
+    - max_staleness (float, optional): The age in seconds after which a mirror is
+        synced before it is read. Defaults to 30.
+    - full_sync_interval (float, optional): The number of seconds between full
+        syncs. Defaults to 3600.
+    - clock (Callable[[], float], optional): The time source. Defaults to
+        `time.time`.
+
+    Methods:
+    - is_fresh(key: str) -> bool: Returns whether a mirror can be read without a
+        sync.
+    - sync_since(key: str) -> Optional[str]: Returns the `last_edited_time` an
+        incremental sync starts from, or None when a full sync is due.
+    - apply(key: str, templates: List[Dict[str, str]], removed: List[str],
+        watermark: str, full: bool) -> None: Stores the result of a sync.
+    - add(key: str, template: Dict[str, str]) -> None: Adds a template written by
+        this service to an existing mirror.
+    - templates(key: str) -> List[Dict[str, str]]: Returns the mirrored
+        templates.
+    - revision(key: str) -> int: Returns a number that changes with every update
+        of a mirror.
+    - close() -> None: Closes the database.
+
+    Example:
+    ```python
+    mirror = TemplateMirror(path="templates.sqlite3", max_staleness=60)
+    if not mirror.is_fresh(key):
+        templates, newest_edit = await fetch_edited_since(mirror.sync_since(key))
+        mirror.apply(key, templates, [], newest_edit, full=False)
+    mirror.templates(key)
+    ```
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_staleness: float = 30.0,
+        full_sync_interval: float = 3600.0,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """Initialize the template mirror.
+
+        Parameters:
+        - path (str, optional): The SQLite database file. Defaults to None, which
+            keeps the mirror in memory.
+        - max_staleness (float, optional): The age in seconds after which a mirror
+            is synced before it is read. Defaults to 30.
+        - full_sync_interval (float, optional): The number of seconds between full
+            syncs. Defaults to 3600.
+        - clock (Callable[[], float], optional): The time source. Defaults to
+            `time.time`.
+        """
+        self.max_staleness = max_staleness
+        self.full_sync_interval = full_sync_interval
+        self._clock = clock
+        self._connection = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS templates (
+                mirror TEXT NOT NULL,
+                page_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_time TEXT NOT NULL,
+                last_edited_time TEXT NOT NULL,
+                PRIMARY KEY (mirror, page_id)
+            );
+            CREATE TABLE IF NOT EXISTS syncs (
+                mirror TEXT PRIMARY KEY,
+                synced_at REAL NOT NULL,
+                full_synced_at REAL NOT NULL,
+                watermark TEXT NOT NULL,
+                revision INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        self._connection.commit()
+
+    def is_fresh(self, key: str) -> bool:
+        """Returns whether a mirror can be read without a sync.
+
+        Args:
+            key (str): The mirror key, e.g. the integration and database id.
+
+        Returns:
+            bool: True if the mirror was synced within `max_staleness` seconds.
+        """
+        sync = self._sync(key)
+        return sync is not None and self._clock() - sync[0] < self.max_staleness
+
+    def sync_since(self, key: str) -> Optional[str]:
+        """Returns the `last_edited_time` an incremental sync starts from.
+
+        Args:
+            key (str): The mirror key.
+
+        Returns:
+            Optional[str]: The newest mirrored `last_edited_time`, or None when
+                the mirror is missing or due for a full sync.
+        """
+        sync = self._sync(key)
+        if sync is None or self._clock() - sync[1] >= self.full_sync_interval:
+            return None
+        return sync[2]
+
+    def apply(
+        self,
+        key: str,
+        templates: List[Dict[str, str]],
+        removed: List[str],
+        watermark: str,
+        full: bool,
+    ) -> None:
+        """Stores the result of a sync.
+
+        Args:
+            key (str): The mirror key.
+            templates (List[Dict[str, str]]): The changed templates with their
+                `pageId`, `title`, `content`, `createdTime` and `lastEditedTime`.
+            removed (List[str]): The page ids that are no longer templates.
+            watermark (str): The newest `last_edited_time` of the queried pages,
+                empty if there were none.
+            full (bool): Whether the templates are the whole database, which
+                replaces the mirror.
+        """
+        now = self._clock()
+        sync = self._sync(key)
+        if sync is not None and not full:
+            watermark = max(watermark, sync[2])
+        full_synced_at = now if full or sync is None else sync[1]
+
+        with self._connection:
+            if full:
+                self._connection.execute(
+                    "DELETE FROM templates WHERE mirror = ?", (key,)
+                )
+            self._upsert(key, templates)
+            self._connection.executemany(
+                "DELETE FROM templates WHERE mirror = ? AND page_id = ?",
+                [(key, page_id) for page_id in removed],
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO syncs "
+                "(mirror, synced_at, full_synced_at, watermark, revision) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, now, full_synced_at, watermark, self.revision(key) + 1),
+            )
+
+    def add(self, key: str, template: Dict[str, str]) -> None:
+        """Adds a template written by this service to an existing mirror.
+
+        Args:
+            key (str): The mirror key.
+            template (Dict[str, str]): The template, see `apply`.
+        """
+        if self._sync(key) is None:
+            return
+
+        with self._connection:
+            self._upsert(key, [template])
+            self._connection.execute(
+                "UPDATE syncs SET revision = revision + 1 WHERE mirror = ?", (key,)
+            )
+
+    def templates(self, key: str) -> List[Dict[str, str]]:
+        """Returns the mirrored templates in creation order.
+
+        Args:
+            key (str): The mirror key.
+
+        Returns:
+            List[Dict[str, str]]: The templates with their `pageId`, `title`,
+                `content` and `lastEditedTime`.
+        """
+        rows = self._connection.execute(
+            "SELECT page_id, title, content, last_edited_time FROM templates "
+            "WHERE mirror = ? ORDER BY created_time, page_id",
+            (key,),
+        ).fetchall()
+        return [
+            {
+                "pageId": page_id,
+                "title": title,
+                "content": content,
+                "lastEditedTime": last_edited_time,
+            }
+            for page_id, title, content, last_edited_time in rows
+        ]
+
+    def revision(self, key: str) -> int:
+        """Returns a number that changes with every update of a mirror.
+
+        Args:
+            key (str): The mirror key.
+
+        Returns:
+            int: The revision, 0 for mirrors that were never synced.
+        """
+        row = self._connection.execute(
+            "SELECT revision FROM syncs WHERE mirror = ?", (key,)
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def close(self) -> None:
+        """Closes the database."""
+        self._connection.close()
+
+    def _sync(self, key: str) -> Optional[Tuple[float, float, str]]:
+        return self._connection.execute(
+            "SELECT synced_at, full_synced_at, watermark FROM syncs WHERE mirror = ?",
+            (key,),
+        ).fetchone()
+
+    def _upsert(self, key: str, templates: List[Dict[str, str]]) -> None:
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO templates "
+            "(mirror, page_id, title, content, created_time, last_edited_time) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    key,
+                    template["pageId"],
+                    template["title"],
+                    template["content"],
+                    template["createdTime"],
+                    template["lastEditedTime"],
+                )
+                for template in templates
+            ],
+        )
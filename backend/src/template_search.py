@@ -0,0 +1,227 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+TOKEN = re.compile(r"\w\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits a text into lower cased word tokens of at least two characters.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        List[str]: The tokens in order of appearance.
+    """
+    return TOKEN.findall(text.lower())
+
+
+class TemplateIndex:
+    """This class ranks templates by TF-IDF similarity to a query or a post.
+
+    An inverted index maps every term to the slots of the templates containing it
+    and their length normalized, sublinear term weights. The weights do not
+    depend on the rest of the library, so adding a template only touches its own
+    terms. The IDF is applied at query time and the scores of the candidate
+    templates are accumulated with NumPy.
+
+    Parameters:
+    - title_weight (float, optional): How much more a title term counts than a
+        body term. Defaults to 2.
+
+    Methods:
+    - add(doc_id: str, title: str, content: str, version: str = "") -> None:
+        Indexes a template, replacing an older version.
+    - remove(doc_id: str) -> None: Removes a template.
+    - sync(templates: List[Dict[str, str]]) -> None: Indexes the new and changed
+        templates and removes the missing ones.
+    - search(text: str, k: int = 5) -> List[Tuple[str, float]]: Returns the ids
+        and scores of the best matching templates.
+
+    Example:
+    ```python
+    index = TemplateIndex()
+    index.add("page_id", "Lessons from failure", "I failed [number] times ...")
+    index.search("failure lessons", k=3)  # [("page_id", 0.83)]
+    ```
+    """
+
+    def __init__(self, title_weight: float = 2.0) -> None:
+        """Initialize the template index.
+
+        Parameters:
+        - title_weight (float, optional): How much more a title term counts than a
+            body term. Defaults to 2.
+        """
+        self.title_weight = title_weight
+        self._versions: Dict[str, str] = {}
+        self._slots: Dict[str, int] = {}
+        self._slot_ids: List[Optional[str]] = []
+        self._slot_terms: List[Tuple[str, ...]] = []
+        self._postings: Dict[str, Tuple[List[int], List[float]]] = {}
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._document_frequency: Counter = Counter()
+        self._live: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        """Returns the number of indexed templates."""
+        return len(self._slots)
+
+    def __contains__(self, doc_id: str) -> bool:
+        """Returns whether a template is indexed."""
+        return doc_id in self._slots
+
+    def add(self, doc_id: str, title: str, content: str, version: str = "") -> None:
+        """Indexes a template, replacing an older version.
+
+        Args:
+            doc_id (str): The template id, e.g. the Notion page id.
+            title (str): The template title.
+            content (str): The template body.
+            version (str, optional): Identifies the revision, e.g. the
+                `last_edited_time`, so `sync` skips unchanged templates.
+                Defaults to "".
+        """
+        self.remove(doc_id)
+
+        weights: Dict[str, float] = Counter(tokenize(content))
+        for term in tokenize(title):
+            weights[term] = weights.get(term, 0.0) + self.title_weight
+        for term, frequency in weights.items():
+            weights[term] = 1 + math.log(frequency)
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+
+        slot = len(self._slot_ids)
+        self._slot_ids.append(doc_id)
+        self._slot_terms.append(tuple(weights))
+        self._slots[doc_id] = slot
+        self._versions[doc_id] = version
+        self._live = None
+
+        for term, weight in weights.items():
+            slots, term_weights = self._postings.setdefault(term, ([], []))
+            slots.append(slot)
+            term_weights.append(weight / norm)
+            self._arrays.pop(term, None)
+            self._document_frequency[term] += 1
+
+    def remove(self, doc_id: str) -> None:
+        """Removes a template, unknown ids are ignored.
+
+        Args:
+            doc_id (str): The template id.
+        """
+        slot = self._slots.pop(doc_id, None)
+        if slot is None:
+            return
+
+        del self._versions[doc_id]
+        self._slot_ids[slot] = None
+        for term in self._slot_terms[slot]:
+            self._document_frequency[term] -= 1
+        self._slot_terms[slot] = ()
+        self._live = None
+
+        # Postings of removed templates are skipped at query time and dropped
+        # once they make up half of the index.
+        if len(self._slot_ids) > 2 * len(self._slots) + 64:
+            self._compact()
+
+    def sync(self, templates: List[Dict[str, str]]) -> None:
+        """Indexes the new and changed templates and removes the missing ones.
+
+        Args:
+            templates (List[Dict[str, str]]): The templates with their `pageId`,
+                `title`, `content` and `lastEditedTime`.
+        """
+        current = {template["pageId"] for template in templates}
+        for doc_id in [doc_id for doc_id in self._slots if doc_id not in current]:
+            self.remove(doc_id)
+
+        for template in templates:
+            version = template.get("lastEditedTime", "")
+            if self._versions.get(template["pageId"]) != version or not version:
+                self.add(
+                    template["pageId"], template["title"], template["content"], version
+                )
+
+    def search(self, text: str, k: int = 5) -> List[Tuple[str, float]]:
+        """Returns the best matching templates.
+
+        Args:
+            text (str): A search query or a whole post.
+            k (int, optional): The maximum number of results. Defaults to 5.
+
+        Returns:
+            List[Tuple[str, float]]: The template ids and their cosine similarity
+                to the IDF weighted query, best first.
+        """
+        query = Counter(tokenize(text))
+        if not query or not self._slots:
+            return []
+
+        documents = len(self._slots)
+        scores = np.zeros(len(self._slot_ids))
+        query_norm = 0.0
+
+        for term, frequency in query.items():
+            document_frequency = self._document_frequency.get(term, 0)
+            idf = math.log((1 + documents) / (1 + document_frequency)) + 1
+            query_weight = (1 + math.log(frequency)) * idf
+            query_norm += query_weight * query_weight
+
+            if document_frequency:
+                slots, weights = self._posting_arrays(term)
+                # Slots are unique within a posting list, so += does not drop hits.
+                scores[slots] += query_weight * weights
+
+        candidates = np.flatnonzero((scores > 0) & self._live_slots())
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        query_norm = math.sqrt(query_norm)
+        return [
+            (self._slot_ids[slot], float(scores[slot]) / query_norm) for slot in ranked
+        ]
+
+    def _live_slots(self) -> np.ndarray:
+        if self._live is None:
+            self._live = np.array(
+                [doc_id is not None for doc_id in self._slot_ids], dtype=bool
+            )
+        return self._live
+
+    def _posting_arrays(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            slots, weights = self._postings[term]
+            arrays = (np.array(slots, dtype=np.intp), np.array(weights))
+            self._arrays[term] = arrays
+        return arrays
+
+    def _compact(self) -> None:
+        live = sorted(self._slots.values())
+        remap = {old: new for new, old in enumerate(live)}
+
+        self._slot_ids = [self._slot_ids[old] for old in live]
+        self._slot_terms = [self._slot_terms[old] for old in live]
+        self._slots = {doc_id: remap[slot] for doc_id, slot in self._slots.items()}
+
+        postings: Dict[str, Tuple[List[int], List[float]]] = {}
+        for term, (slots, weights) in self._postings.items():
+            kept = [
+                (remap[slot], weight)
+                for slot, weight in zip(slots, weights)
+                if slot in remap
+            ]
+            if kept:
+                postings[term] = ([slot for slot, _ in kept], [w for _, w in kept])
+        self._postings = postings
+        self._arrays = {}
+        self._live = None
+        self._document_frequency = +self._document_frequency
@@ -0,0 +1,564 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import httpx
+
+from src.metrics import TRACE_SPANS_DROPPED, ASGIApp
+
+logger = logging.getLogger(__name__)
+
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+AttributeValue = Union[str, int, float, bool]
+OTLPPayload = Dict[str, Any]
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """This class is a timed operation of a trace, e.g. one Notion call.
+
+    Parameters:
+    - name (str): The operation name.
+    - trace_id (str): The 32 hex digit id shared by every span of the trace.
+    - parent_id (str, optional): The id of the enclosing span. Defaults to "".
+    - kind (str, optional): "internal", "server" or "client".
+        Defaults to "internal".
+    - sampled (bool, optional): Whether the span is exported. Defaults to False.
+
+    Attributes:
+    - span_id (str): The 16 hex digit id of the span.
+    - attributes (Dict[str, AttributeValue]): The attributes of the span.
+    - start_ns (int): The start time in nanoseconds since the epoch.
+    - end_ns (int): The end time, 0 while the span is running.
+    - error (str): The error the operation failed with, "" if it succeeded.
+
+    Methods:
+    - set_attribute(key: str, value: AttributeValue) -> None: Sets an attribute.
+    - to_otlp() -> Dict[str, Any]: Returns the span in the OTLP/JSON format.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str = "",
+        kind: str = "internal",
+        sampled: bool = False,
+    ) -> None:
+        """Initialize the span and start its clock.
+
+        Parameters:
+        - name (str): The operation name.
+        - trace_id (str): The 32 hex digit id shared by every span of the trace.
+        - parent_id (str, optional): The id of the enclosing span. Defaults to "".
+        - kind (str, optional): "internal", "server" or "client".
+            Defaults to "internal".
+        - sampled (bool, optional): Whether the span is exported.
+            Defaults to False.
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _random_id(16)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes: Dict[str, AttributeValue] = {}
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error = ""
+
+    @property
+    def duration(self) -> float:
+        """The duration in seconds, up to now while the span is running."""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value: AttributeValue) -> None:
+        """Sets an attribute of the span.
+
+        Args:
+            key (str): The attribute name, e.g. "http.status_code".
+            value (AttributeValue): The attribute value.
+        """
+        self.attributes[key] = value
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Returns the span in the OTLP/JSON format.
+
+        Returns:
+            Dict[str, Any]: The span as in an OTLP `ExportTraceServiceRequest`.
+        """
+        span: Dict[str, Any] = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class FileSpanExporter:
+    """This class appends spans to a file, one OTLP/JSON export request per line.
+
+    The OpenTelemetry Collector reads such files with its `otlpjsonfile`
+    receiver.
+
+    Parameters:
+    - path (str): The file the spans are appended to.
+
+    Methods:
+    - export(payload: OTLPPayload) -> None: Appends an export request.
+    - close() -> None: Closes the file.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize the exporter.
+
+        Parameters:
+        - path (str): The file the spans are appended to.
+        """
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, payload: OTLPPayload) -> None:
+        """Appends an export request to the file.
+
+        Args:
+            payload (OTLPPayload): The OTLP/JSON export request.
+        """
+        self._file.write(json.dumps(payload, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        """Closes the file."""
+        self._file.close()
+
+
+class OTLPSpanExporter:
+    """This class sends spans to an OTLP/HTTP collector in the JSON encoding.
+
+    Parameters:
+    - endpoint (str): The traces endpoint, e.g. "http://localhost:4318/v1/traces".
+    - headers (Dict[str, str], optional): Extra headers, e.g. for authentication.
+        Defaults to None.
+    - timeout (float, optional): The timeout of an export in seconds.
+        Defaults to 10.
+
+    Methods:
+    - export(payload: OTLPPayload) -> None: Sends an export request.
+    - close() -> None: Closes the HTTP connections.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: float = 10,
+    ) -> None:
+        """Initialize the exporter.
+
+        Parameters:
+        - endpoint (str): The traces endpoint, e.g.
+            "http://localhost:4318/v1/traces".
+        - headers (Dict[str, str], optional): Extra headers, e.g. for
+            authentication. Defaults to None.
+        - timeout (float, optional): The timeout of an export in seconds.
+            Defaults to 10.
+        """
+        self.endpoint = endpoint
+        self._client = httpx.Client(headers=headers, timeout=timeout)
+
+    def export(self, payload: OTLPPayload) -> None:
+        """Sends an export request to the collector.
+
+        Args:
+            payload (OTLPPayload): The OTLP/JSON export request.
+        """
+        response = self._client.post(self.endpoint, json=payload)
+        response.raise_for_status()
+
+    def close(self) -> None:
+        """Closes the HTTP connections."""
+        self._client.close()
+
+
+class Tracer:
+    """This class records the spans of the requests and exports the sampled ones.
+
+    Spans nest through a context variable, so the spans opened while handling a
+    request, including those of the tasks it starts, belong to its trace. Finished
+    spans are exported in batches by a background thread, a slow or unreachable
+    collector never blocks a request; spans that do not fit into the queue are
+    dropped and counted. Without an exporter, spans are only timed.
+
+    Parameters:
+    - exporter (FileSpanExporter | OTLPSpanExporter, optional): Receives the
+        finished spans. Defaults to None, which disables exporting.
+    - sample_rate (float, optional): The share of traces exported.
+        Defaults to 1.0.
+    - service_name (str, optional): The `service.name` of the exported spans.
+        Defaults to "socialmediagpt-backend".
+    - batch_size (int, optional): The maximum number of spans per export.
+        Defaults to 512.
+    - max_queue_size (int, optional): The maximum number of spans waiting for
+        export. Defaults to 8192.
+    - flush_interval (float, optional): How long finished spans wait for a batch
+        to fill up, in seconds. Defaults to 1.
+
+    Methods:
+    - configure(exporter: Any, sample_rate: float = 1.0) -> None: Sets the
+        exporter.
+    - span(name: str, kind: str = "internal", parent: Optional[Span] = None,
+        **attributes: AttributeValue) -> Iterator[Span]: Context manager timing
+        the block as the current span.
+    - start_span(name: str, kind: str = "internal", parent: Optional[Span] = None,
+        **attributes: AttributeValue) -> Span: Starts a span without making it the
+        current one.
+    - end_span(span: Span, error: Optional[BaseException] = None) -> None: Ends a
+        span and queues it for export.
+    - current_span() -> Optional[Span]: Returns the innermost running span.
+    - flush() -> None: Waits until the queued spans were exported.
+    - close() -> None: Exports the queued spans and stops the export thread.
+
+    Example:
+    ```python
+    tracer.configure(FileSpanExporter("traces.jsonl"))
+    with tracer.span("notion.pages.create", kind="client") as span:
+        await notion.pages.create(...)
+        span.set_attribute("notion.attempt", 1)
+    ```
+    """
+
+    def __init__(
+        self,
+        exporter: Any = None,
+        sample_rate: float = 1.0,
+        service_name: str = "socialmediagpt-backend",
+        batch_size: int = 512,
+        max_queue_size: int = 8192,
+        flush_interval: float = 1,
+    ) -> None:
+        """Initialize the tracer.
+
+        Parameters:
+        - exporter (FileSpanExporter | OTLPSpanExporter, optional): Receives the
+            finished spans. Defaults to None, which disables exporting.
+        - sample_rate (float, optional): The share of traces exported.
+            Defaults to 1.0.
+        - service_name (str, optional): The `service.name` of the exported spans.
+            Defaults to "socialmediagpt-backend".
+        - batch_size (int, optional): The maximum number of spans per export.
+            Defaults to 512.
+        - max_queue_size (int, optional): The maximum number of spans waiting for
+            export. Defaults to 8192.
+        - flush_interval (float, optional): How long finished spans wait for a
+            batch to fill up, in seconds. Defaults to 1.
+        """
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.exporter = None
+        self.sample_rate = sample_rate
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self.configure(exporter, sample_rate)
+
+    def configure(self, exporter: Any, sample_rate: float = 1.0) -> None:
+        """Sets the exporter and starts the export thread.
+
+        Args:
+            exporter (Any): Receives the finished spans, None disables exporting.
+            sample_rate (float, optional): The share of traces exported.
+                Defaults to 1.0.
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        if exporter is not None and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._export_loop, name="span-exporter", daemon=True
+            )
+            self._thread.start()
+
+    @contextmanager
+    def span(
+        self,
+        name: str,
+        kind: str = "internal",
+        parent: Optional[Span] = None,
+        **attributes: AttributeValue,
+    ) -> Iterator[Span]:
+        """Times the block as the current span, failed if the block raises.
+
+        Args:
+            name (str): The operation name.
+            kind (str, optional): "internal", "server" or "client".
+                Defaults to "internal".
+            parent (Span, optional): The enclosing span. Defaults to the current
+                span.
+            **attributes (AttributeValue): The attributes of the span.
+
+        Yields:
+            Span: The running span.
+        """
+        span = self.start_span(name, kind, parent, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            self.end_span(span, error)
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            _current_span.reset(token)
+
+    def start_span(
+        self,
+        name: str,
+        kind: str = "internal",
+        parent: Optional[Span] = None,
+        **attributes: AttributeValue,
+    ) -> Span:
+        """Starts a span without making it the current one, e.g. around an
+        asynchronous generator.
+
+        Args:
+            name (str): The operation name.
+            kind (str, optional): "internal", "server" or "client".
+                Defaults to "internal".
+            parent (Span, optional): The enclosing span. Defaults to the current
+                span.
+            **attributes (AttributeValue): The attributes of the span.
+
+        Returns:
+            Span: The running span.
+        """
+        parent = parent if parent is not None else _current_span.get()
+        if parent is None:
+            sampled = self.exporter is not None and random.random() < self.sample_rate
+            span = Span(name, _random_id(32), kind=kind, sampled=sampled)
+        else:
+            span = Span(
+                name, parent.trace_id, parent.span_id, kind, sampled=parent.sampled
+            )
+        span.attributes.update(attributes)
+        return span
+
+    def end_span(self, span: Span, error: Optional[BaseException] = None) -> None:
+        """Ends a span and queues it for export if its trace is sampled.
+
+        Args:
+            span (Span): The running span.
+            error (BaseException, optional): The error the operation failed with.
+                Defaults to None.
+        """
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = repr(error)
+        if not span.sampled or self.exporter is None:
+            return
+
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            TRACE_SPANS_DROPPED.inc()
+
+    def current_span(self) -> Optional[Span]:
+        """Returns the innermost running span.
+
+        Returns:
+            Optional[Span]: The current span, None outside of any span.
+        """
+        return _current_span.get()
+
+    def flush(self) -> None:
+        """Waits until the queued spans were exported."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """Exports the queued spans, stops the export thread and closes the
+        exporter."""
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self.exporter.close()
+
+    def _export_loop(self) -> None:
+        while True:
+            span = self._queue.get()
+            batch = [span]
+            deadline = time.monotonic() + self.flush_interval
+            while span is not None and len(batch) < self.batch_size:
+                try:
+                    span = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                batch.append(span)
+
+            spans = [span for span in batch if span is not None]
+            if spans:
+                self._export(spans)
+            for _ in batch:
+                self._queue.task_done()
+            if len(spans) < len(batch):
+                return
+
+    def _export(self, spans: List[Span]) -> None:
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": _otlp_attributes(
+                            {"service.name": self.service_name}
+                        )
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            self.exporter.export(payload)
+        except Exception:
+            TRACE_SPANS_DROPPED.inc(len(spans))
+            logger.exception("Exporting %d spans failed", len(spans))
+
+
+tracer = Tracer()
+
+
+class TracingMiddleware:
+    """This ASGI middleware opens the root span of every HTTP request.
+
+    The span is named after the route template, e.g. `POST /create_template`, and
+    joins the trace of a W3C `traceparent` request header. With a profiler, the
+    requests slower than its threshold leave a profile named after their trace id.
+
+    Parameters:
+    - app (ASGIApp): The wrapped application.
+    - tracer (Tracer, optional): The tracer. Defaults to the shared `tracer`.
+    - profiler (SlowRequestProfiler, optional): Profiles slow requests.
+        Defaults to None.
+
+    Example:
+    ```python
+    app.add_middleware(TracingMiddleware, profiler=SlowRequestProfiler(2.0, "."))
+    ```
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        tracer: Tracer = tracer,
+        profiler: Any = None,
+    ) -> None:
+        """Initialize the middleware.
+
+        Parameters:
+        - app (ASGIApp): The wrapped application.
+        - tracer (Tracer, optional): The tracer. Defaults to the shared `tracer`.
+        - profiler (SlowRequestProfiler, optional): Profiles slow requests.
+            Defaults to None.
+        """
+        self.app = app
+        self.tracer = tracer
+        self.profiler = profiler
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        """Handles a request within its root span.
+
+        Args:
+            scope (Dict[str, Any]): The ASGI connection scope.
+            receive (Any): The ASGI receive channel.
+            send (Any): The ASGI send channel.
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+            await send(message)
+
+        method = scope["method"]
+        profile: Dict[str, Any] = {}
+        with self.tracer.span(
+            method,
+            kind="server",
+            parent=_remote_parent(scope, self.tracer),
+            **{"http.method": method, "http.target": scope["path"]},
+        ) as span:
+            try:
+                if self.profiler is None:
+                    await self.app(scope, receive, send_with_status)
+                else:
+                    with self.profiler.watch(span.trace_id) as profile:
+                        await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                span.name = f"{method} {getattr(route, 'path', 'unmatched')}"
+                if profile.get("path"):
+                    span.set_attribute("profile.path", profile["path"])
+
+
+def _remote_parent(scope: Dict[str, Any], tracer: Tracer) -> Optional[Span]:
+    for name, value in scope.get("headers", ()):
+        if name == b"traceparent":
+            match = TRACEPARENT.match(value.decode("latin-1").strip().lower())
+            if match is None:
+                return None
+            parent = Span("remote", match.group(1), sampled=match.group(3) == "01")
+            parent.span_id = match.group(2)
+            # The caller decided to record the trace, it is exported if possible.
+            parent.sampled = parent.sampled and tracer.exporter is not None
+            return parent
+    return None
+
+
+def _otlp_attributes(attributes: Dict[str, AttributeValue]) -> List[Dict[str, Any]]:
+    converted = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed: Dict[str, Any] = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        converted.append({"key": key, "value": typed})
+    return converted
+
+
+def _random_id(digits: int) -> str:
+    return os.urandom(digits // 2).hex()
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from src.metrics import WRITE_BEHIND_PENDING, WRITE_BEHIND_WRITES
+from src.rate_limiter import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+Writer = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class WriteBehindQueue:
+    """This class persists writes in a local write-ahead log and applies them in
+    the background, so requests do not wait for (or fail with) the backend.
+
+    Entries are grouped in partitions, e.g. one per Notion database. A partition
+    is flushed in order by its own task, so a slow or failing database does not
+    hold back the others. Failed writes are retried with exponential backoff and
+    entries still failing after `max_attempts` are kept in the log as `failed`.
+    With a `path`, the log is a SQLite table and unflushed entries are replayed on
+    start. Delivery is at least once: a write that succeeded right before a crash
+    is repeated after the restart.
+
+    Parameters:
+    - writer (Writer): Coroutine function applying an entry.
+    - path (str, optional): The SQLite database file of the log. Defaults to None,
+        which keeps the log in memory.
+    - max_attempts (int, optional): How often an entry is tried before it is
+        marked as failed. Defaults to 8.
+    - base_delay (float, optional): The backoff of the first retry in seconds.
+        Defaults to 1.
+    - max_delay (float, optional): The maximum backoff in seconds. Defaults to 60.
+
+    Attributes:
+    - durable (bool): Whether unflushed entries survive a restart.
+
+    Methods:
+    - start() -> None: Replays the unflushed entries.
+    - stop(timeout: float = 10.0) -> None: Flushes for at most `timeout` seconds
+        and stops the flushers.
+    - enqueue(partition: str, entry: Dict[str, Any]) -> str: Logs an entry and
+        returns its id.
+    - join() -> None: Waits until every entry was flushed or failed.
+    - pending() -> int: Returns the number of unflushed entries.
+
+    Example:
+    ```python
+    async def write(entry):
+        await notion.pages.create(**entry)
+
+    queue = WriteBehindQueue(write, path="write_behind.sqlite3")
+    await queue.enqueue(database_id, {"parent": {"database_id": database_id}})
+    ```
+    """
+
+    def __init__(
+        self,
+        writer: Writer,
+        path: Optional[str] = None,
+        max_attempts: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ) -> None:
+        """Initialize the write-behind queue.
+
+        Parameters:
+        - writer (Writer): Coroutine function applying an entry.
+        - path (str, optional): The SQLite database file of the log. Defaults to
+            None, which keeps the log in memory.
+        - max_attempts (int, optional): How often an entry is tried before it is
+            marked as failed. Defaults to 8.
+        - base_delay (float, optional): The backoff of the first retry in seconds.
+            Defaults to 1.
+        - max_delay (float, optional): The maximum backoff in seconds.
+            Defaults to 60.
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+
+        self.writer = writer
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.durable = path is not None
+        self._partitions: Dict[str, Deque[Dict[str, Any]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._started = False
+        self._connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS write_behind "
+                "(seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, "
+                "partition TEXT NOT NULL, entry TEXT NOT NULL, "
+                "status TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._connection.commit()
+
+    async def start(self) -> None:
+        """Replays the unflushed entries of the log."""
+        if self._started:
+            return
+        self._started = True
+
+        if self._connection is not None and not self._partitions:
+            rows = self._connection.execute(
+                "SELECT id, partition, entry FROM write_behind "
+                "WHERE status = 'pending' ORDER BY seq"
+            ).fetchall()
+            for entry_id, partition, entry in rows:
+                self._append(partition, {"id": entry_id, "entry": json.loads(entry)})
+            if rows:
+                logger.info("Replaying %d unflushed writes", len(rows))
+
+        for partition in self._partitions:
+            self._schedule(partition)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Flushes for at most `timeout` seconds and stops the flushers.
+
+        Args:
+            timeout (float, optional): The number of seconds spent flushing.
+                Defaults to 10.
+        """
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %d unflushed writes", self.pending())
+
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = {}
+        self._started = False
+
+    async def enqueue(self, partition: str, entry: Dict[str, Any]) -> str:
+        """Logs an entry and flushes it in the background.
+
+        Args:
+            partition (str): The ordering key, e.g. the Notion database id.
+            entry (Dict[str, Any]): The JSON serializable input of the writer.
+
+        Returns:
+            str: The entry id.
+        """
+        entry_id = uuid.uuid4().hex
+
+        if self._connection is not None:
+            self._connection.execute(
+                "INSERT INTO write_behind "
+                "(id, partition, entry, status, created_at) "
+                "VALUES (?, ?, ?, 'pending', ?)",
+                (entry_id, partition, json.dumps(entry), time.time()),
+            )
+            self._connection.commit()
+
+        self._append(partition, {"id": entry_id, "entry": entry})
+        await self.start()
+        self._schedule(partition)
+
+        return entry_id
+
+    async def join(self) -> None:
+        """Waits until every entry was flushed or failed."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def pending(self) -> int:
+        """Returns the number of unflushed entries."""
+        return sum(len(entries) for entries in self._partitions.values())
+
+    def _append(self, partition: str, item: Dict[str, Any]) -> None:
+        self._partitions.setdefault(partition, deque()).append(item)
+        WRITE_BEHIND_PENDING.set(self.pending())
+
+    def _schedule(self, partition: str) -> None:
+        if self._started and partition not in self._tasks:
+            self._tasks[partition] = asyncio.ensure_future(self._flush(partition))
+
+    async def _flush(self, partition: str) -> None:
+        entries = self._partitions[partition]
+        attempts = 0
+
+        try:
+            while entries:
+                item = entries[0]
+                try:
+                    await self.writer(item["entry"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    attempts += 1
+                    if attempts < self.max_attempts:
+                        delay = backoff_delay(
+                            attempts - 1, base=self.base_delay, cap=self.max_delay
+                        )
+                        logger.warning(
+                            "Write %s failed, retrying in %.2fs: %s",
+                            item["id"],
+                            delay,
+                            error,
+                        )
+                        WRITE_BEHIND_WRITES.inc(outcome="retried")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    logger.error("Giving up on write %s: %s", item["id"], error)
+                    WRITE_BEHIND_WRITES.inc(outcome="failed")
+                    self._finish(item, "failed")
+                else:
+                    WRITE_BEHIND_WRITES.inc(outcome="written")
+                    self._finish(item, None)
+
+                entries.popleft()
+                WRITE_BEHIND_PENDING.set(self.pending())
+                attempts = 0
+        finally:
+            if not entries:
+                self._partitions.pop(partition, None)
+            if self._tasks.get(partition) is asyncio.current_task():
+                del self._tasks[partition]
+
+    def _finish(self, item: Dict[str, Any], status: Optional[str]) -> None:
+        if self._connection is None:
+            return
+
+        if status is None:
+            self._connection.execute(
+                "DELETE FROM write_behind WHERE id = ?", (item["id"],)
+            )
+        else:
+            self._connection.execute(
+                "UPDATE write_behind SET status = ? WHERE id = ?", (status, item["id"])
+            )
+        self._connection.commit()
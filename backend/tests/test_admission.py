@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from src.admission import FairScheduler, Overloaded
+
+
+def test_scheduler_admits_queued_tenants_fairly():
+    scheduler = FairScheduler("generate_posts", capacity=1)
+    admitted = []
+
+    async def request(tenant, cost=1):
+        async with scheduler.admit(tenant, cost):
+            admitted.append(tenant)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        # The heavy tenant's requests are queued before the light tenant's one.
+        heavy = [asyncio.ensure_future(request("heavy", 3)) for _ in range(4)]
+        await asyncio.sleep(0)
+        light = asyncio.ensure_future(request("light"))
+        await asyncio.gather(*heavy, light)
+
+    asyncio.run(run())
+
+    # The light tenant's single request is not queued behind the heavy tenant's.
+    assert admitted == ["heavy", "light", "heavy", "heavy", "heavy"]
+    assert scheduler.running == 0
+    assert scheduler.queued == 0
+
+
+def test_scheduler_rejects_when_queues_are_full_or_deadlines_pass():
+    scheduler = FairScheduler(
+        "create_template", capacity=1, max_queue=2, max_queue_per_tenant=1, timeout=0.05
+    )
+
+    async def run():
+        release = await scheduler.acquire("a")
+        waiting = asyncio.ensure_future(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(Overloaded) as tenant_full:
+            await scheduler.acquire("a")
+        other = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as queue_full:
+            await scheduler.acquire("c")
+        with pytest.raises(Overloaded) as timed_out:
+            await waiting
+        other.cancel()
+        release()
+        return tenant_full.value, queue_full.value, timed_out.value
+
+    tenant_full, queue_full, timed_out = asyncio.run(run())
+
+    assert tenant_full.status == 429
+    assert queue_full.status == 503
+    assert timed_out.status == 503
+    assert tenant_full.retry_after >= 1
+    assert (scheduler.running, scheduler.queued) == (0, 0)
+
+
+def test_scheduler_hands_slots_of_cancelled_requests_on():
+    scheduler = FairScheduler("generate_posts", capacity=1)
+
+    async def run():
+        release = await scheduler.acquire("a")
+        cancelled = asyncio.ensure_future(scheduler.acquire("b"))
+        waiting = asyncio.ensure_future(scheduler.acquire("c"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release()
+        release()
+        (await waiting)()
+
+    asyncio.run(run())
+
+    assert (scheduler.running, scheduler.queued) == (0, 0)
+
+
+def test_scheduler_lets_background_jobs_wait_without_deadline_or_queue_cap():
+    scheduler = FairScheduler(
+        "generate_posts", capacity=1, max_queue=0, max_queue_per_tenant=0, timeout=0.01
+    )
+
+    async def run():
+        release = await scheduler.acquire("a")
+        job = asyncio.ensure_future(scheduler.acquire("a", background=True))
+        await asyncio.sleep(0.05)
+        assert not job.done()
+        with pytest.raises(Overloaded):
+            await scheduler.acquire("b")
+        release()
+        (await job)()
+
+    asyncio.run(run())
+
+    assert (scheduler.running, scheduler.queued) == (0, 0)
@@ -0,0 +1,458 @@
+import asyncio
+import json
+import time
+import uuid
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import pytest
+
+from src.admission import FairScheduler
+from src.app import app, jobs, llms, notion_clients, write_behind
+from src.metrics import CLIENT_DISCONNECTS
+from src.rate_limiter import RateLimiter
+from src.write_behind import WriteBehindQueue
+
+LLM_LATENCY = 0.2
+CONCURRENT_REQUESTS = 10
+
+
+class FakeSlowLLM:
+    calls = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def acall(self, placeholder_mapping):
+        FakeSlowLLM.calls += 1
+        await asyncio.sleep(LLM_LATENCY)
+        return "[{'title': 'Title', 'post': 'Post'}]"
+
+    async def aclose(self):
+        pass
+
+
+class FakeAsyncClient:
+    def __init__(self, *args, **kwargs):
+        self.pages = MagicMock()
+        self.pages.create = AsyncMock(return_value={"id": "page_id"})
+        self.databases = MagicMock()
+        self.databases.query = AsyncMock(
+            return_value={
+                "results": [
+                    {
+                        "id": "template_id",
+                        "properties": {
+                            "Title": {"title": [{"text": {"content": "Template"}}]}
+                        },
+                    }
+                ],
+                "has_more": False,
+                "next_cursor": None,
+            }
+        )
+        self.blocks = MagicMock()
+        self.blocks.children.list = AsyncMock(
+            return_value={
+                "results": [
+                    {"paragraph": {"rich_text": [{"text": {"content": "Content"}}]}}
+                ]
+            }
+        )
+
+    async def aclose(self):
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return None
+
+
+@pytest.fixture
+def fake_backends():
+    # Every fake request shares one Notion key, Notion's rate limit is not under test.
+    unlimited = RateLimiter(rate=1000, burst=1000)
+    with patch("src.app.LLM", FakeSlowLLM), patch(
+        "src.app.AsyncClient", FakeAsyncClient
+    ), patch("src.app.notion_rate_limiter", unlimited):
+        yield
+        asyncio.run(notion_clients.aclose())
+        asyncio.run(llms.aclose())
+
+
+async def _fire_generate_posts(num_requests):
+    payload = {
+        "notionKey": "notionkey",
+        "openaiKey": "openaikey",
+        "databaseId": "databaseid",
+        "templateText": "template_text",
+        "numPosts": 1,
+        "model": "model_name",
+        "topics": "topics",
+    }
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(
+            *(client.post("/generate_posts", json=payload) for _ in range(num_requests))
+        )
+
+
+def test_generate_posts_requests_overlap(fake_backends):
+    start = time.perf_counter()
+    responses = asyncio.run(_fire_generate_posts(CONCURRENT_REQUESTS))
+    elapsed = time.perf_counter() - start
+
+    assert all(response.status_code == 200 for response in responses)
+    assert responses[0].json() == [{"title": "Title", "post": "Post", "stored": True}]
+    # Serial handling would take CONCURRENT_REQUESTS * LLM_LATENCY seconds.
+    assert elapsed < CONCURRENT_REQUESTS * LLM_LATENCY / 2
+
+
+def test_get_templates_streams_ndjson(fake_backends):
+    async def fetch():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await client.post(
+                "/get_templates",
+                json={"notionKey": "notionkey", "databaseId": "db", "stream": True},
+            )
+
+    response = asyncio.run(fetch())
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"id": 0, "title": "Template", "content": "Content"}
+    ]
+
+
+def test_generate_posts_background_job(fake_backends):
+    async def submit_and_poll():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            submitted = await client.post(
+                "/generate_posts",
+                json={
+                    "notionKey": "notionkey",
+                    "openaiKey": "openaikey",
+                    "databaseId": "databaseid",
+                    "templateText": "template_text",
+                    "numPosts": 1,
+                    "model": "model_name",
+                    "topics": "topics",
+                    "background": True,
+                },
+            )
+            job_id = submitted.json()["jobId"]
+
+            for _ in range(50):
+                job = (await client.get(f"/jobs/{job_id}")).json()
+                if job["status"] == "succeeded":
+                    break
+                await asyncio.sleep(LLM_LATENCY / 4)
+
+            missing = await client.get("/jobs/unknown")
+        await jobs.stop()
+        return submitted, job, missing
+
+    submitted, job, missing = asyncio.run(submit_and_poll())
+
+    assert submitted.status_code == 202
+    assert job["status"] == "succeeded"
+    assert job["progress"] == {"postsGenerated": 1, "postsWritten": 1}
+    assert job["result"] == [{"title": "Title", "post": "Post", "stored": True}]
+    assert missing.status_code == 404
+
+
+def test_metrics_endpoint_exposes_request_and_notion_metrics(fake_backends):
+    async def generate_and_scrape():
+        await _fire_generate_posts(1)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await client.get("/metrics")
+
+    response = asyncio.run(generate_and_scrape())
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert (
+        'http_request_duration_seconds_count{method="POST",'
+        'endpoint="/generate_posts",status="200"}' in response.text
+    )
+    assert (
+        'notion_call_duration_seconds_count{method="pages.create",status="ok"}'
+        in response.text
+    )
+    assert "llm_output_parse_duration_seconds_count" in response.text
+
+
+def test_generate_posts_write_behind_flushes_in_background(fake_backends, tmp_path):
+    async def generate_and_flush():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            response = await client.post(
+                "/generate_posts",
+                json={
+                    "notionKey": "notionkey",
+                    "openaiKey": "openaikey",
+                    "databaseId": "databaseid",
+                    "templateText": "template_text",
+                    "numPosts": 1,
+                    "model": "model_name",
+                    "topics": "topics",
+                    "writeBehind": True,
+                },
+            )
+        pending = queue.pending()
+        await queue.stop()
+        return response, pending
+
+    write_page = write_behind.writer
+
+    async def slow_write_page(entry):
+        # Takes longer than the response, whatever order the tasks run in.
+        await asyncio.sleep(LLM_LATENCY)
+        await write_page(entry)
+
+    queue = WriteBehindQueue(slow_write_page, path=str(tmp_path / "write_behind.db"))
+    with patch("src.app.write_behind", queue):
+        response, pending = asyncio.run(generate_and_flush())
+
+    assert response.json()[0]["stored"] is False
+    assert "writeId" in response.json()[0]
+    assert pending == 1
+    assert queue.pending() == 0
+
+
+def test_write_behind_is_rejected_without_a_durable_log(fake_backends):
+    payload = {
+        "notionKey": "notionkey",
+        "openaiKey": "openaikey",
+        "databaseId": "databaseid",
+        "model": "model_name",
+        "writeBehind": True,
+    }
+
+    async def post_all():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                client.post("/create_template", json={**payload, "text": "text"}),
+                client.post(
+                    "/generate_posts",
+                    json={
+                        **payload,
+                        "templateText": "template_text",
+                        "numPosts": 1,
+                        "topics": "topics",
+                    },
+                ),
+            )
+
+    calls = FakeSlowLLM.calls
+    responses = asyncio.run(post_all())
+
+    assert [response.status_code for response in responses] == [400] * 2
+    assert FakeSlowLLM.calls == calls
+    assert write_behind.pending() == 0
+
+
+def test_generate_posts_idempotency_key_runs_retries_once(fake_backends):
+    payload = {
+        "notionKey": "notionkey",
+        "openaiKey": "openaikey",
+        "databaseId": "databaseid",
+        "templateText": "template_text",
+        "numPosts": 1,
+        "model": "model_name",
+        "topics": "topics",
+    }
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    async def retry():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            concurrent = await asyncio.gather(
+                *(
+                    client.post("/generate_posts", json=payload, headers=headers)
+                    for _ in range(3)
+                )
+            )
+            later = await client.post("/generate_posts", json=payload, headers=headers)
+            conflict = await client.post(
+                "/generate_posts", json={**payload, "numPosts": 2}, headers=headers
+            )
+        return concurrent, later, conflict
+
+    calls = FakeSlowLLM.calls
+    concurrent, later, conflict = asyncio.run(retry())
+
+    assert FakeSlowLLM.calls == calls + 1
+    bodies = [response.json() for response in (*concurrent, later)]
+    assert bodies == [[{"title": "Title", "post": "Post", "stored": True}]] * 4
+    replayed = [
+        response.headers.get("Idempotent-Replayed") for response in (*concurrent, later)
+    ]
+    assert replayed.count("true") == 3
+    assert conflict.status_code == 422
+
+
+def test_generate_posts_sheds_load_beyond_admission_queue(fake_backends):
+    scheduler = FairScheduler("generate_posts", capacity=1, max_queue=1)
+    with patch.dict("src.app.admission", {"generate_posts": scheduler}):
+        responses = asyncio.run(_fire_generate_posts(3))
+
+    statuses = sorted(response.status_code for response in responses)
+    assert statuses == [200, 200, 503]
+    rejected = next(response for response in responses if response.status_code == 503)
+    assert int(rejected.headers["Retry-After"]) >= 1
+    assert "overloaded" in rejected.json()["detail"]
+
+
+def test_generate_posts_is_cancelled_when_the_client_disconnects(fake_backends):
+    body = json.dumps(
+        {
+            "notionKey": "notionkey",
+            "openaiKey": "openaikey",
+            "databaseId": "databaseid",
+            "templateText": "template_text",
+            "numPosts": 1,
+            "model": "model_name",
+            "topics": "topics",
+        }
+    ).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/generate_posts",
+        "raw_path": b"/generate_posts",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # The client leaves while the LLM is still generating.
+        await asyncio.sleep(LLM_LATENCY / 4)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    disconnects = CLIENT_DISCONNECTS.value(endpoint="generate_posts")
+    start = time.perf_counter()
+    asyncio.run(app(scope, receive, send))
+
+    assert time.perf_counter() - start < LLM_LATENCY
+    assert sent[0]["status"] == 499
+    assert CLIENT_DISCONNECTS.value(endpoint="generate_posts") == disconnects + 1
+
+
+def test_generate_posts_rejects_out_of_range_post_counts(fake_backends):
+    payload = {
+        "notionKey": "notionkey",
+        "openaiKey": "openaikey",
+        "databaseId": "databaseid",
+        "templateText": "template_text",
+        "model": "model_name",
+        "topics": "topics",
+    }
+
+    async def post_all():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    client.post("/generate_posts", json={**payload, "numPosts": num})
+                    for num in (0, -3, 10**6)
+                )
+            )
+
+    calls = FakeSlowLLM.calls
+    responses = asyncio.run(post_all())
+
+    assert [response.status_code for response in responses] == [422] * 3
+    assert FakeSlowLLM.calls == calls
+
+
+def test_create_templates_rejects_out_of_range_text_counts(fake_backends):
+    payload = {
+        "notionKey": "notionkey",
+        "openaiKey": "openaikey",
+        "model": "model_name",
+        "databaseId": "databaseid",
+    }
+
+    async def post_all():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    client.post("/create_templates", json={**payload, "texts": texts})
+                    for texts in ([], ["text"] * 101)
+                )
+            )
+
+    calls = FakeSlowLLM.calls
+    responses = asyncio.run(post_all())
+
+    assert [response.status_code for response in responses] == [422] * 2
+    assert FakeSlowLLM.calls == calls
+
+
+def test_get_templates_rejects_malformed_mirror_cursors(fake_backends):
+    async def get_all():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    client.post(
+                        "/get_templates",
+                        json={
+                            "notionKey": "notionkey",
+                            "databaseId": "databaseid",
+                            "pageSize": 1,
+                            "cursor": cursor,
+                            "stream": stream,
+                        },
+                    )
+                    for cursor, stream in (
+                        ("mirror:-1", False),
+                        ("mirror:abc", True),
+                        ("3c9f-notion-cursor", False),
+                    )
+                )
+            )
+
+    responses = asyncio.run(get_all())
+
+    assert [response.status_code for response in responses] == [400, 400, 200]
+    assert responses[2].json()["data"][0]["title"] == "Template"
@@ -0,0 +1,57 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+from benchmarks.fake_services import Cassette
+
+BACKEND = Path(__file__).resolve().parents[1]
+
+
+def test_cassette_keys_chat_completions_by_model_and_prompt():
+    def key(body):
+        return Cassette.key("POST", "/v1/chat/completions", json.dumps(body).encode())
+
+    body = {
+        "model": "gpt-3.5-turbo-1106",
+        "temperature": 0,
+        "messages": [{"role": "user", "content": "Turn  this post\n into a template"}],
+    }
+
+    assert key(body) == key(
+        {
+            **body,
+            "temperature": 0.7,
+            "messages": [{"role": "user", "content": "Turn this post into a template"}],
+        }
+    )
+    assert key(body) != key({**body, "model": "gpt-4-1106-preview"})
+
+
+def test_bench_load_replays_the_recorded_fixtures_without_errors(tmp_path):
+    output = tmp_path / "report.json"
+
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.bench_load",
+            "--replay",
+            "benchmarks/fixtures",
+            "--requests",
+            "10",
+            "--concurrency",
+            "10",
+            "--output",
+            str(output),
+        ],
+        cwd=BACKEND,
+        check=True,
+        capture_output=True,
+        timeout=120,
+    )
+
+    report = json.loads(output.read_text())
+    assert set(report) == {"create_template", "get_templates", "generate_posts"}
+    for result in report.values():
+        assert result["errors"] == {}
@@ -0,0 +1,88 @@
+import pytest
+
+from src.cache import LRUCache, ResultCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get("b", "missing") == "missing"
+    assert len(cache) == 2
+
+
+def test_lru_cache_rejects_invalid_size():
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=0)
+
+
+def test_result_cache_returns_copies_and_counts_hits(tmp_path):
+    cache = ResultCache()
+    key = ResultCache.make_key("model", "prompt", "text")
+    cache.set(key, {"title": "Title"})
+
+    first = cache.get(key)
+    first["databaseId"] = "mutated"
+
+    assert cache.get(key) == {"title": "Title"}
+    assert cache.get(ResultCache.make_key("model", "prompt", "other")) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_result_cache_persists_to_sqlite_and_expires(tmp_path):
+    now = [0.0]
+    path = str(tmp_path / "results.sqlite3")
+    key = ResultCache.make_key("model", "prompt", "text")
+
+    writer = ResultCache(path=path, ttl=10, clock=lambda: now[0])
+    writer.set(key, {"title": "Title"})
+    writer.close()
+
+    reader = ResultCache(path=path, ttl=10, clock=lambda: now[0])
+    assert reader.get(key) == {"title": "Title"}
+
+    now[0] = 10
+    assert reader.get(key) is None
+    reader.close()
+
+
+def test_result_cache_purges_expired_and_surplus_rows(tmp_path):
+    now = [0.0]
+    path = str(tmp_path / "results.sqlite3")
+    cache = ResultCache(maxsize=2, path=path, ttl=10, clock=lambda: now[0])
+
+    def rows():
+        return cache._connection.execute(
+            "SELECT key FROM results ORDER BY created_at"
+        ).fetchall()
+
+    cache.set("a", 1)
+    now[0] = 1
+    cache.set("b", 2)
+    now[0] = 2
+    cache.set("c", 3)
+
+    assert rows() == [("b",), ("c",)]
+
+    now[0] = 11
+    cache.set("d", 4)
+
+    assert rows() == [("c",), ("d",)]
+
+    now[0] = 12
+    cache.set("e", 5)
+
+    assert rows() == [("d",), ("e",)]
+    cache.close()
+
+
+def test_result_cache_key_separates_parts():
+    assert ResultCache.make_key("ab", "c") != ResultCache.make_key("a", "bc")
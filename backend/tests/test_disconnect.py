@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from src.disconnect import ClientDisconnected, cancel_on_disconnect
+
+
+def _receive(disconnected):
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    return receive
+
+
+def test_cancel_on_disconnect_returns_the_result_of_finished_work():
+    async def run():
+        disconnected = asyncio.Event()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            return "posts"
+
+        return await cancel_on_disconnect(
+            "generate_posts", _receive(disconnected), work
+        )
+
+    assert asyncio.run(run()) == "posts"
+
+
+def test_cancel_on_disconnect_cancels_the_work_of_a_disconnected_client():
+    events = []
+
+    async def run():
+        disconnected = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                events.append("cancelled")
+                raise
+            finally:
+                events.append("unwound")
+
+        asyncio.get_running_loop().call_later(0.01, disconnected.set)
+        with pytest.raises(ClientDisconnected):
+            await cancel_on_disconnect("generate_posts", _receive(disconnected), work)
+        # The work unwound before the error was raised.
+        events.append("raised")
+
+    asyncio.run(run())
+
+    assert events == ["cancelled", "unwound", "raised"]
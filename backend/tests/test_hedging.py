@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from src.hedging import LatencyTracker, hedge
+
+
+def call(result, delay=0.0, error=None):
+    async def run():
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+    return run
+
+
+def test_latency_tracker_returns_quantiles_of_the_window():
+    latencies = LatencyTracker(window=10, min_samples=5)
+    for seconds in range(1, 5):
+        latencies.observe("model", seconds)
+
+    assert latencies.quantile("model", 0.9) is None
+
+    for seconds in range(5, 21):
+        latencies.observe("model", seconds)
+
+    assert latencies.quantile("model", 0.5) == 15
+    assert latencies.quantile("model", 0.9) == 19
+    assert latencies.quantile("other", 0.9) is None
+
+
+def test_hedge_returns_the_primary_result_before_the_delay():
+    result = asyncio.run(hedge(call("primary"), call("backup"), delay=1))
+
+    assert result == ("primary", False)
+
+
+def test_hedge_returns_the_first_result_and_cancels_the_other():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    result = asyncio.run(hedge(slow, call("backup"), delay=0.01))
+
+    assert result == ("backup", True)
+    assert cancelled == [True]
+
+
+def test_hedge_survives_one_failed_call_and_raises_when_both_fail():
+    primary = call("primary", delay=0.05)
+    failing = call(None, error=ValueError("backup failed"))
+
+    assert asyncio.run(hedge(primary, failing, delay=0.01)) == ("primary", False)
+
+    with pytest.raises(ValueError, match="primary failed"):
+        asyncio.run(
+            hedge(
+                call(None, delay=0.02, error=ValueError("primary failed")),
+                failing,
+                delay=0.01,
+            )
+        )
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from src.cache import ResultCache
+from src.idempotency import IdempotencyConflict, IdempotencyStore
+
+
+def test_idempotency_store_replays_stored_responses():
+    store = IdempotencyStore(ResultCache())
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        return {"posts": ["Post"]}
+
+    async def run():
+        first = await store.run("key", "fingerprint", generate)
+        second = await store.run("key", "fingerprint", generate)
+        with pytest.raises(IdempotencyConflict):
+            await store.run("key", "other fingerprint", generate)
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first == ({"posts": ["Post"]}, False)
+    assert second == ({"posts": ["Post"]}, True)
+    assert len(calls) == 1
+
+
+def test_idempotency_store_finishes_requests_of_disconnected_clients():
+    store = IdempotencyStore(ResultCache())
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        original = asyncio.ensure_future(store.run("key", "fingerprint", generate))
+        await asyncio.sleep(0)
+        original.cancel()
+        await asyncio.sleep(0.02)
+        return await store.run("key", "fingerprint", generate)
+
+    assert asyncio.run(run()) == ("result", True)
+    assert len(calls) == 1
+
+
+def test_idempotency_store_runs_failed_requests_again():
+    store = IdempotencyStore(ResultCache())
+    outcomes = [ValueError("LLM output invalid"), "result"]
+
+    async def generate():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def run():
+        with pytest.raises(ValueError):
+            await store.run("key", "fingerprint", generate)
+        return await store.run("key", "fingerprint", generate)
+
+    assert asyncio.run(run()) == ("result", False)
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from src.admission import Overloaded
+from src.jobs import JobManager
+
+
+async def _wait_for(jobs, job_id, status):
+    for _ in range(100):
+        if jobs.get(job_id)["status"] == status:
+            return jobs.get(job_id)
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Job {job_id} never reached {status}")
+
+
+def test_job_reports_progress_and_result():
+    async def generate(payload, report):
+        report(postsGenerated=payload["count"], postsWritten=0)
+        report(postsWritten=payload["count"])
+        return ["post"] * payload["count"]
+
+    async def run():
+        jobs = JobManager({"generate_posts": generate})
+        job_id = await jobs.submit("generate_posts", {"count": 2})
+        job = await _wait_for(jobs, job_id, "succeeded")
+        await jobs.stop()
+        return job
+
+    job = asyncio.run(run())
+
+    assert job["progress"] == {"postsGenerated": 2, "postsWritten": 2}
+    assert job["result"] == ["post", "post"]
+    assert "payload" not in job
+
+
+def test_failed_job_keeps_error():
+    async def fail(payload, report):
+        raise RuntimeError("LLM unavailable")
+
+    async def run():
+        jobs = JobManager({"fail": fail})
+        job_id = await jobs.submit("fail", {})
+        job = await _wait_for(jobs, job_id, "failed")
+        await jobs.stop()
+        return job
+
+    assert asyncio.run(run())["error"] == "LLM unavailable"
+
+
+def test_unfinished_jobs_survive_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+
+    async def hang(payload, report):
+        await asyncio.sleep(10)
+
+    async def finish(payload, report):
+        return payload["value"]
+
+    async def submit_and_crash():
+        jobs = JobManager({"work": hang}, path=path)
+        job_id = await jobs.submit("work", {"value": 42})
+        await _wait_for(jobs, job_id, "running")
+        await jobs.stop()
+        return job_id
+
+    async def restart(job_id):
+        jobs = JobManager({"work": finish}, path=path)
+        await jobs.start()
+        job = await _wait_for(jobs, job_id, "succeeded")
+        await jobs.stop()
+        return job
+
+    job_id = asyncio.run(submit_and_crash())
+
+    assert asyncio.run(restart(job_id))["result"] == 42
+
+
+def test_unfinished_jobs_are_bounded_in_total_and_per_tenant():
+    async def block(payload, report):
+        await asyncio.sleep(10)
+
+    async def run():
+        jobs = JobManager(
+            {"generate_posts": block},
+            workers=1,
+            max_pending=3,
+            max_pending_per_tenant=2,
+        )
+        for _ in range(2):
+            await jobs.submit("generate_posts", {}, tenant="a")
+        with pytest.raises(Overloaded) as tenant_full:
+            await jobs.submit("generate_posts", {}, tenant="a")
+        job_id = await jobs.submit("generate_posts", {}, tenant="b")
+        with pytest.raises(Overloaded) as queue_full:
+            await jobs.submit("generate_posts", {}, tenant="c")
+        job = jobs.get(job_id)
+        await jobs.stop()
+        return tenant_full.value, queue_full.value, job
+
+    tenant_full, queue_full, job = asyncio.run(run())
+
+    assert tenant_full.status == 429
+    assert queue_full.status == 503
+    assert tenant_full.retry_after >= 1
+    assert "tenant" not in job
@@ -1,38 +1,322 @@
-from unittest.mock import patch
+import asyncio
+import json
+import subprocess
+import sys
+from unittest.mock import AsyncMock, patch
 
-from langchain import PromptTemplate
+import httpx
+import pytest
+from langchain.schema import ChatGeneration, LLMResult
+from langchain.schema.messages import AIMessage
 
-from src.llm import LLM
+from src.hedging import LatencyTracker
+from src.llm import LLM, OpenAIError, supports_json_mode
+from src.metrics import LLM_CANCELLED_CALLS, LLM_HEDGES, LLM_LATENCY, LLM_TOKENS
+
+ASYNC_CLIENT = httpx.AsyncClient
+CLIENT = httpx.Client
+
+
+def completion(content, prompt_tokens=0, completion_tokens=0):
+    return {
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+        },
+    }
+
+
+def mock_openai(handler):
+    transport = httpx.MockTransport(handler)
+    return patch(
+        "httpx.AsyncClient",
+        lambda **kwargs: ASYNC_CLIENT(transport=transport, **kwargs),
+    ), patch("httpx.Client", lambda **kwargs: CLIENT(transport=transport, **kwargs))
 
 
 def test_llm_call():
-    with patch("src.llm.ChatOpenAI") as mock_chat_openai, patch(
-        "src.llm.LLMChain"
-    ) as mock_llm_chain:
-        prompt_template = PromptTemplate.from_template("your_template")
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=completion("Generated response"))
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="your_model",
+            prompt_template="Write about {TOPIC} in {{braces}}",
+        )
 
-        mock_chat_openai_instance = mock_chat_openai.return_value
-        mock_llm_chain_instance = mock_llm_chain.return_value
+        result = llm_instance({"TOPIC": "AI"})
 
-        mock_llm_chain_instance.return_value = {"text": "Generated response"}
+    assert result == "Generated response"
+    assert str(requests[0].url) == "https://api.openai.com/v1/chat/completions"
+    assert requests[0].headers["Authorization"] == "Bearer your_openai_key"
+    assert json.loads(requests[0].content) == {
+        "model": "your_model",
+        "temperature": 0.0,
+        "messages": [{"role": "user", "content": "Write about AI in {braces}"}],
+    }
 
+
+def test_llm_acall_records_latency_and_token_usage():
+    def handler(request):
+        return httpx.Response(200, json=completion("Generated response", 120, 30))
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="metered_model",
+            prompt_template="your_template",
+            base_url="http://localhost:8080/v1/",
+        )
+
+        async def call():
+            try:
+                return await llm_instance.acall({})
+            finally:
+                await llm_instance.aclose()
+
+        assert asyncio.run(call()) == "Generated response"
+
+    assert LLM_TOKENS.value(model="metered_model", kind="prompt") == 120
+    assert LLM_TOKENS.value(model="metered_model", kind="completion") == 30
+    assert LLM_LATENCY.count(model="metered_model", mode="call") == 1
+
+
+def test_llm_acall_retries_throttled_requests():
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "0"}, json={"error": {}}),
+        httpx.Response(200, json=completion("Generated response")),
+    ]
+
+    async_client, client = mock_openai(lambda request: responses.pop(0))
+    with async_client, client:
         llm_instance = LLM(
             openai_api_key="your_openai_key",
             model_name="your_model",
-            prompt_template=prompt_template,
+            prompt_template="your_template",
         )
 
-        result = llm_instance({"placeholder_mapping": "some_data"})
+        assert asyncio.run(llm_instance.acall({})) == "Generated response"
+
+    assert not responses
+
 
-        assert result == "Generated response"
+def test_llm_acall_raises_client_errors():
+    def handler(request):
+        return httpx.Response(401, json={"error": {"message": "Invalid key"}})
 
-        mock_chat_openai.assert_called_once_with(
-            openai_api_key="your_openai_key", temperature=0.0, model_name="your_model"
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="wrong_key",
+            model_name="your_model",
+            prompt_template="your_template",
         )
-        mock_llm_chain.assert_called_once_with(
-            llm=mock_chat_openai_instance,
-            prompt=prompt_template,
+
+        with pytest.raises(OpenAIError, match="Invalid key") as error:
+            asyncio.run(llm_instance.acall({}))
+
+    assert error.value.status == 401
+
+
+def test_llm_astream():
+    def handler(request):
+        assert json.loads(request.content)["stream"] is True
+        events = [
+            {"choices": [{"delta": {"role": "assistant"}}]},
+            {"choices": [{"delta": {"content": "Generated "}}]},
+            {"choices": [{"delta": {"content": "response"}}]},
+        ]
+        body = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+        return httpx.Response(200, text=body + "data: [DONE]\n\n")
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="your_model",
+            prompt_template="Write about {TOPIC}",
         )
-        mock_llm_chain_instance.assert_called_once_with(
-            {"placeholder_mapping": "some_data"}
+
+        async def collect():
+            return [chunk async for chunk in llm_instance.astream({"TOPIC": "AI"})]
+
+        assert asyncio.run(collect()) == ["Generated ", "response"]
+
+
+def test_llm_json_mode():
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json=completion("{}"))
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        LLM(
+            openai_api_key="your_openai_key",
+            model_name="gpt-4-1106-preview",
+            prompt_template="your_template",
+            json_mode=True,
+        )({})
+
+    assert requests[0]["response_format"] == {"type": "json_object"}
+    assert supports_json_mode("gpt-4-1106-preview")
+    assert not supports_json_mode("gpt-4")
+
+
+def test_llm_acall_hedges_slow_calls_with_the_fallback_model():
+    requests = []
+
+    async def handler(request):
+        model = json.loads(request.content)["model"]
+        requests.append(model)
+        if model == "slow_model":
+            await asyncio.sleep(5)
+        return httpx.Response(200, json=completion(model, 10, 5))
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="slow_model",
+            prompt_template="your_template",
+            hedge_quantile=0.9,
+            hedge_min_delay=0.01,
+            fallback_model="fast_model",
+            latencies=LatencyTracker(min_samples=1),
+        )
+        llm_instance.latencies.observe(("slow_model", llm_instance.prompt_version), 0)
+
+        async def call():
+            try:
+                return await asyncio.wait_for(llm_instance.acall({}), 1)
+            finally:
+                await llm_instance.aclose()
+
+        assert asyncio.run(call()) == "fast_model"
+
+    assert requests == ["slow_model", "fast_model"]
+    labels = {"model": "slow_model", "backup_model": "fast_model"}
+    assert LLM_HEDGES.value(winner="backup", **labels) == 1
+    assert LLM_TOKENS.value(model="fast_model", kind="prompt") == 10
+    # The cancelled primary call still counts as a slow sample.
+    assert (
+        llm_instance.latencies.quantile(("slow_model", llm_instance.prompt_version), 1)
+        >= 0.01
+    )
+
+
+def test_llm_acall_cancelled_during_a_hedge_leaves_the_latencies_unchanged():
+    async def handler(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, json=completion("too late"))
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="slow_model",
+            prompt_template="your_template",
+            hedge_quantile=0.9,
+            hedge_min_delay=0.01,
+            fallback_model="fast_model",
+            latencies=LatencyTracker(min_samples=1),
+        )
+        llm_instance.latencies.observe(("slow_model", llm_instance.prompt_version), 0)
+
+        async def call():
+            try:
+                # E.g. the client disconnected while both calls were in flight.
+                await asyncio.wait_for(llm_instance.acall({}), 0.2)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                await llm_instance.aclose()
+
+        asyncio.run(call())
+
+    version = llm_instance.prompt_version
+    assert llm_instance.latencies.quantile(("slow_model", version), 1) == 0
+    assert llm_instance.latencies.quantile(("fast_model", version), 1) is None
+
+
+def test_llm_langchain_backend():
+    with patch("langchain.chat_models.ChatOpenAI") as mock_chat_openai:
+        mock_chat_openai.return_value.agenerate = AsyncMock(
+            return_value=LLMResult(
+                generations=[
+                    [ChatGeneration(message=AIMessage(content="Generated response"))]
+                ],
+                llm_output={"token_usage": {"prompt_tokens": 7}},
+            )
+        )
+
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="langchain_model",
+            prompt_template="Write about {TOPIC}",
+            json_mode=True,
+            backend="langchain",
+        )
+
+        assert asyncio.run(llm_instance.acall({"TOPIC": "AI"})) == "Generated response"
+
+    mock_chat_openai.assert_called_once_with(
+        openai_api_key="your_openai_key",
+        openai_api_base="https://api.openai.com/v1",
+        temperature=0.0,
+        model_name="langchain_model",
+        request_timeout=600.0,
+        max_retries=2,
+        model_kwargs={"response_format": {"type": "json_object"}},
+    )
+    messages = mock_chat_openai.return_value.agenerate.await_args.args[0]
+    assert messages[0][0].content == "Write about AI"
+    assert LLM_TOKENS.value(model="langchain_model", kind="prompt") == 7
+
+
+def test_app_does_not_import_langchain():
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, src.app; print('langchain' in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert imported.stdout.strip() == "False"
+
+
+def test_llm_acall_counts_cancelled_calls():
+    async def handler(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, json=completion("never"))
+
+    async_client, client = mock_openai(handler)
+    with async_client, client:
+        llm_instance = LLM(
+            openai_api_key="your_openai_key",
+            model_name="abandoned_model",
+            prompt_template="your_template",
         )
+
+        async def call():
+            try:
+                await asyncio.wait_for(llm_instance.acall({}), 0.01)
+            finally:
+                await llm_instance.aclose()
+
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(call())
+
+    assert LLM_CANCELLED_CALLS.value(model="abandoned_model", mode="call") == 1
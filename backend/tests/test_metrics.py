@@ -0,0 +1,54 @@
+import pytest
+
+from src.metrics import MetricsRegistry, _Metric
+
+
+def test_registry_renders_prometheus_text_format():
+    registry = MetricsRegistry()
+    tokens = registry.counter("tokens_total", "Used tokens.", ["model"])
+    in_flight = registry.gauge("calls_in_flight", "Running calls.")
+    latency = registry.histogram(
+        "call_duration_seconds", "Call latency.", ["method"], buckets=(0.1, 1.0)
+    )
+
+    tokens.inc(3, model='gpt-4 "turbo"')
+    with in_flight.track_inprogress():
+        assert in_flight.value() == 1
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, method="pages.create")
+
+    assert registry.render().splitlines() == [
+        "# HELP tokens_total Used tokens.",
+        "# TYPE tokens_total counter",
+        'tokens_total{model="gpt-4 \\"turbo\\""} 3.0',
+        "# HELP calls_in_flight Running calls.",
+        "# TYPE calls_in_flight gauge",
+        "calls_in_flight 0.0",
+        "# HELP call_duration_seconds Call latency.",
+        "# TYPE call_duration_seconds histogram",
+        'call_duration_seconds_bucket{method="pages.create",le="0.1"} 1',
+        'call_duration_seconds_bucket{method="pages.create",le="1.0"} 2',
+        'call_duration_seconds_bucket{method="pages.create",le="+Inf"} 3',
+        'call_duration_seconds_sum{method="pages.create"} 5.55',
+        'call_duration_seconds_count{method="pages.create"} 3',
+    ]
+
+
+def test_metrics_reject_wrong_labels_and_negative_counts():
+    registry = MetricsRegistry()
+    tokens = registry.counter("tokens_total", "Used tokens.", ["model"])
+
+    with pytest.raises(ValueError):
+        tokens.inc(model="gpt-4", kind="prompt")
+    with pytest.raises(ValueError):
+        tokens.inc(-1, model="gpt-4")
+    with pytest.raises(ValueError):
+        registry.gauge("tokens_total", "Duplicate.")
+
+
+def test_metric_without_samples_cannot_be_created():
+    class Incomplete(_Metric):
+        kind = "untyped"
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Never rendered.")
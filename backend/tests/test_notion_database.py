@@ -1,15 +1,30 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+import time
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
+import httpx
 import pytest
-from notion_client import Client
+from notion_client import AsyncClient
+from notion_client.errors import APIErrorCode, APIResponseError
 
-from src.data_models import GeneratePosts, GetTemplates, TemplateCreate
-from src.notion_database import NotionDatabase
+from src.cache import ResultCache
+from src.data_models import (
+    GeneratePosts,
+    GetTemplates,
+    SearchTemplates,
+    TemplateCreate,
+    TemplatesCreate,
+)
+from src.notion_database import InvalidCursor, NotionDatabase
+from src.rate_limiter import RateLimiter
+from src.similarity_cache import SimilarityCache
+from src.single_flight import SingleFlight
+from src.template_mirror import TemplateMirror
 
 
 @pytest.fixture
 def mock_notion_client():
-    return MagicMock(spec=Client)
+    return MagicMock(spec=AsyncClient)
 
 
 @pytest.fixture
@@ -43,8 +58,10 @@ def test_get_templates(mock_notion_client):
             {"id": 0, "title": "Template 1", "content": "Template content"}
         ]
 
-        result = notion_db.get_templates(
-            data=GetTemplates(notionKey="notionkey", databaseId="databaseid")
+        result = asyncio.run(
+            notion_db.get_templates(
+                data=GetTemplates(notionKey="notionkey", databaseId="databaseid")
+            )
         )
 
         assert result == {
@@ -52,7 +69,7 @@ def test_get_templates(mock_notion_client):
             "data": [{"id": 0, "title": "Template 1", "content": "Template content"}],
         }
 
-        mock_query.assert_called_once_with("databaseid")
+        mock_query.assert_called_once_with("databaseid", None)
         mock_format_templates.assert_called_once_with(
             [
                 {
@@ -86,7 +103,7 @@ def test_create_template(mock_notion_client, mock_llm):
             "post": "Template content",
         }
 
-        result = notion_db.create_template(data=data)
+        result = asyncio.run(notion_db.create_template(data=data))
 
         assert result == {
             "title": "Template 1",
@@ -132,8 +149,14 @@ def test_generate_posts(mock_notion_client, mock_llm):
             {"title": "Short Title of the post", "post": "The post you made"},
             {"title": "Another short title", "post": "Another post you made"},
         ]
+        mock_store_generated_posts.return_value = [
+            {"pageId": "page_id", "error": None},
+            {"pageId": None, "error": "Notion is down"},
+        ]
+
+        result = asyncio.run(notion_db.generate_posts(data))
 
-        _ = notion_db.generate_posts(data)
+    assert [post["stored"] for post in result] == [True, False]
 
     mock_store_generated_posts.assert_called_once_with(
         [
@@ -141,6 +164,868 @@ def test_generate_posts(mock_notion_client, mock_llm):
             {"title": "Another short title", "post": "Another post you made"},
         ],
         "databaseid",
+        ANY,
     )
 
     mock_generate_posts.assert_called_once_with(data)
+
+
+def test_store_generated_posts_is_bounded_and_keeps_partial_results():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def create_page(parent, properties, children):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        title = properties["title"]["title"][0]["text"]["content"]
+        if title == "bad":
+            raise RuntimeError("Notion is down")
+        return {"id": f"page_{title}"}
+
+    notion = MagicMock()
+    notion.pages.create = create_page
+    notion_db = NotionDatabase(notion=notion, max_concurrency=2)
+    posts = [{"title": str(index), "post": "content"} for index in range(6)]
+    posts.insert(3, {"title": "bad", "post": "content"})
+
+    results = asyncio.run(notion_db._store_generated_posts(posts, "databaseid"))
+
+    assert max_in_flight == 2
+    assert results[3] == {"pageId": None, "error": "Notion is down"}
+    assert [result["pageId"] for result in results if result["error"] is None] == [
+        f"page_{index}" for index in range(6)
+    ]
+
+
+def _template_page(page_id, title, last_edited_time="2023-12-01T00:00:00.000Z"):
+    return {
+        "id": page_id,
+        "last_edited_time": last_edited_time,
+        "properties": {"Title": {"title": [{"text": {"content": title}}]}},
+    }
+
+
+def _paragraph_blocks(content):
+    return {"results": [{"paragraph": {"rich_text": [{"text": {"content": content}}]}}]}
+
+
+def test_format_templates_fetches_concurrently_and_caches_bodies():
+    fetched = []
+
+    async def list_children(block_id):
+        fetched.append(block_id)
+        await asyncio.sleep(0.01)
+        return _paragraph_blocks(f"content of {block_id}")
+
+    notion = MagicMock()
+    notion.blocks.children.list = list_children
+    notion_db = NotionDatabase(notion=notion, max_concurrency=4)
+    templates = [
+        _template_page(f"page_{index}", f"Title {index}") for index in range(8)
+    ]
+
+    result = asyncio.run(notion_db._format_templates(templates))
+
+    assert result[5] == {"id": 5, "title": "Title 5", "content": "content of page_5"}
+    assert sorted(fetched) == sorted(f"page_{index}" for index in range(8))
+
+    fetched.clear()
+    templates[2] = _template_page(
+        "page_2", "Title 2", last_edited_time="2023-12-02T00:00:00.000Z"
+    )
+
+    result = asyncio.run(notion_db._format_templates(templates))
+
+    assert fetched == ["page_2"]
+    assert len(result) == 8
+
+
+def _paginated_notion(pages):
+    queries = []
+
+    async def query(**kwargs):
+        queries.append(kwargs)
+        index = int(kwargs.get("start_cursor") or 0)
+        return {
+            "results": pages[index],
+            "has_more": index + 1 < len(pages),
+            "next_cursor": str(index + 1) if index + 1 < len(pages) else None,
+        }
+
+    async def list_children(block_id):
+        return _paragraph_blocks(f"content of {block_id}")
+
+    notion = MagicMock()
+    notion.databases.query = query
+    notion.blocks.children.list = list_children
+    return notion, queries
+
+
+def test_query_available_templates_follows_all_result_pages():
+    pages = [[_template_page("page_0", "A")], [_template_page("page_1", "B")]]
+    notion, queries = _paginated_notion(pages)
+    notion_db = NotionDatabase(notion=notion)
+
+    result = asyncio.run(notion_db._query_available_templates("databaseid"))
+
+    assert [template["id"] for template in result] == ["page_0", "page_1"]
+    assert [query.get("start_cursor") for query in queries] == [None, "1"]
+
+
+def test_get_templates_returns_single_page_with_cursor():
+    pages = [[_template_page("page_0", "A")], [_template_page("page_1", "B")]]
+    notion, queries = _paginated_notion(pages)
+    notion_db = NotionDatabase(notion=notion)
+
+    result = asyncio.run(
+        notion_db.get_templates(
+            GetTemplates(notionKey="notionkey", databaseId="databaseid", pageSize=1)
+        )
+    )
+
+    assert result == {
+        "count": 1,
+        "data": [{"id": 0, "title": "A", "content": "content of page_0"}],
+        "nextCursor": "1",
+    }
+    assert queries[0]["page_size"] == 1
+
+
+def test_get_templates_without_page_size_reads_on_from_the_cursor():
+    pages = [
+        [_template_page("page_0", "A")],
+        [_template_page("page_1", "B")],
+        [_template_page("page_2", "C")],
+    ]
+    notion, queries = _paginated_notion(pages)
+    notion_db = NotionDatabase(notion=notion)
+
+    result = asyncio.run(
+        notion_db.get_templates(
+            GetTemplates(notionKey="notionkey", databaseId="databaseid", cursor="1")
+        )
+    )
+
+    assert [template["title"] for template in result["data"]] == ["B", "C"]
+    assert queries[0]["start_cursor"] == "1"
+
+
+def test_stream_templates_yields_every_page_with_running_ids():
+    pages = [
+        [_template_page("page_0", "A"), _template_page("page_1", "B")],
+        [_template_page("page_2", "C")],
+    ]
+    notion, _ = _paginated_notion(pages)
+    notion_db = NotionDatabase(notion=notion)
+
+    async def collect():
+        data = GetTemplates(notionKey="notionkey", databaseId="databaseid")
+        return [template async for template in notion_db.stream_templates(data)]
+
+    result = asyncio.run(collect())
+
+    assert [(template["id"], template["title"]) for template in result] == [
+        (0, "A"),
+        (1, "B"),
+        (2, "C"),
+    ]
+
+
+def test_generate_template_uses_result_cache():
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+    llm.acall = AsyncMock(return_value="{'title': 'Title', 'post': 'Post'}")
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm, result_cache=ResultCache())
+
+    def data(text, bypass_cache=False):
+        return TemplateCreate(
+            notionKey="notionkey",
+            openaiKey="openaikey",
+            text=text,
+            model="model_name",
+            bypassCache=bypass_cache,
+        )
+
+    first = asyncio.run(notion_db._generate_template(data("A viral post")))
+    second = asyncio.run(notion_db._generate_template(data("A viral post  \r\n")))
+
+    assert first == second == {"title": "Title", "post": "Post"}
+    assert llm.acall.await_count == 1
+
+    asyncio.run(notion_db._generate_template(data("A viral post", True)))
+
+    assert llm.acall.await_count == 2
+
+
+def test_stream_posts_stores_posts_while_generating():
+    events = []
+
+    async def astream(placeholder_mapping):
+        for chunk in (
+            '[{"title": "One", "post": "First"},',
+            ' {"title": "Two", "post": "Second"}',
+            "]",
+        ):
+            await asyncio.sleep(0.02)
+            events.append("chunk")
+            yield chunk
+
+    async def create_page(parent, properties, children):
+        events.append("page")
+        return {"id": "page_id"}
+
+    llm = MagicMock()
+    llm.astream = astream
+    notion = MagicMock()
+    notion.pages.create = create_page
+    notion_db = NotionDatabase(notion=notion, llm=llm)
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=2,
+        model="model_name",
+        topics="topics",
+    )
+
+    async def collect():
+        return [post async for post in notion_db.stream_posts(data)]
+
+    posts = asyncio.run(collect())
+
+    assert posts == [
+        {"title": "One", "post": "First", "stored": True},
+        {"title": "Two", "post": "Second", "stored": True},
+    ]
+    assert events[:3] == ["chunk", "page", "chunk"]
+
+
+def test_generate_posts_only_requests_missing_posts_again():
+    llm = MagicMock()
+    llm.acall = AsyncMock(
+        side_effect=[
+            '[{"title": "A", "post": "B"}, {"title": "C", "post": }, '
+            '{"title": "D", "post": "E"}]',
+            '[{"title": "F", "post": "G"}]',
+        ]
+    )
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm)
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=3,
+        model="model_name",
+        topics="topics",
+    )
+
+    posts = asyncio.run(notion_db._generate_posts(data))
+
+    assert [post["title"] for post in posts] == ["A", "D", "F"]
+    assert llm.acall.await_args_list[1].args[0]["NUMBER_OF_POSTS"] == 1
+
+
+def test_generate_posts_reuses_posts_of_reworded_topics():
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+    llm.acall = AsyncMock(return_value='[{"title": "A", "post": "B"}]')
+    notion_db = NotionDatabase(
+        notion=MagicMock(), llm=llm, post_cache=SimilarityCache()
+    )
+
+    def data(topics, template_text="template_text", bypass_cache=False):
+        return GeneratePosts(
+            notionKey="notionkey",
+            openaiKey="openaikey",
+            databaseId="databaseid",
+            templateText=template_text,
+            numPosts=1,
+            model="model_name",
+            topics=topics,
+            bypassCache=bypass_cache,
+        )
+
+    first = asyncio.run(notion_db._generate_posts(data("AI, startups")))
+    second = asyncio.run(notion_db._generate_posts(data("startups and AI")))
+
+    assert first == second == [{"title": "A", "post": "B"}]
+    assert llm.acall.await_count == 1
+
+    asyncio.run(notion_db._generate_posts(data("remote work")))
+    asyncio.run(notion_db._generate_posts(data("AI, startups", "other template")))
+    asyncio.run(notion_db._generate_posts(data("AI, startups", bypass_cache=True)))
+
+    assert llm.acall.await_count == 4
+
+
+def test_generate_posts_fans_out_large_requests_and_deduplicates():
+    calls = []
+
+    async def acall(placeholders):
+        shard = len(calls)
+        calls.append(placeholders)
+        await asyncio.sleep(0.05)
+        posts = [
+            {"title": f"Shard {shard} post {index}", "post": f"Post {shard} {index}"}
+            for index in range(placeholders["NUMBER_OF_POSTS"])
+        ]
+        posts.append({"title": "Duplicate", "post": "Same in every shard"})
+        return repr(posts)
+
+    llm = MagicMock()
+    llm.acall = acall
+    notion_db = NotionDatabase(
+        notion=MagicMock(), llm=llm, posts_per_llm_call=5, max_llm_concurrency=6
+    )
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=28,
+        model="model_name",
+        topics="AI, startups, careers",
+    )
+
+    start = time.perf_counter()
+    posts = asyncio.run(notion_db._generate_posts(data))
+    elapsed = time.perf_counter() - start
+
+    assert [call["NUMBER_OF_POSTS"] for call in calls] == [5, 5, 5, 5, 4, 4]
+    assert [call["TOPICS"] for call in calls] == ["AI", "startups", "careers"] * 2
+    assert len(posts) == 29
+    assert [post["title"] for post in posts].count("Duplicate") == 1
+    assert elapsed < 0.05 * 3
+
+
+def test_generate_posts_keeps_the_posts_of_shards_that_did_not_fail():
+    calls = []
+
+    async def acall(placeholders):
+        shard = len(calls)
+        calls.append(placeholders)
+        await asyncio.sleep(0.01)
+        if shard == 1:
+            raise RuntimeError("OpenAI is down")
+        return repr(
+            [
+                {"title": f"Call {shard} post {index}", "post": f"Post {shard} {index}"}
+                for index in range(placeholders["NUMBER_OF_POSTS"])
+            ]
+        )
+
+    llm = MagicMock()
+    llm.acall = acall
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm, posts_per_llm_call=2)
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=6,
+        model="model_name",
+        topics="AI, startups, careers",
+    )
+
+    posts = asyncio.run(notion_db._generate_posts(data))
+
+    # The posts of the failed shard are requested again in a single call.
+    assert [call["NUMBER_OF_POSTS"] for call in calls] == [2, 2, 2, 2]
+    assert [post["title"] for post in posts] == [
+        "Call 0 post 0",
+        "Call 0 post 1",
+        "Call 2 post 0",
+        "Call 2 post 1",
+        "Call 3 post 0",
+        "Call 3 post 1",
+    ]
+
+
+def test_generate_posts_fails_when_every_shard_failed():
+    llm = MagicMock()
+    llm.acall = AsyncMock(side_effect=RuntimeError("OpenAI is down"))
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm, posts_per_llm_call=2)
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=4,
+        model="model_name",
+        topics="topics",
+    )
+
+    with pytest.raises(RuntimeError, match="OpenAI is down"):
+        asyncio.run(notion_db._generate_posts(data))
+    assert llm.acall.await_count == 2
+
+
+def _templates_data(texts):
+    return TemplatesCreate(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        texts=texts,
+        model="model_name",
+        databaseId="databaseid",
+    )
+
+
+def test_create_templates_packs_several_posts_per_llm_call():
+    calls = []
+
+    async def acall(placeholders):
+        calls.append(placeholders["LINKEDIN_POSTS"])
+        lines = placeholders["LINKEDIN_POSTS"].splitlines()
+        return repr(
+            [
+                {"index": index, "title": f"T{line[-4]}", "post": "Template"}
+                for index, line in enumerate(lines)
+            ]
+        )
+
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+    llm.acall = acall
+    notion_db = NotionDatabase(
+        notion=MagicMock(),
+        llm=llm,
+        result_cache=ResultCache(),
+        templates_per_llm_call=3,
+    )
+    notion_db._store_template_in_notion = AsyncMock()
+    texts = [f"Post {index}" for index in range(7)]
+
+    response = asyncio.run(notion_db.create_templates(_templates_data(texts)))
+
+    assert len(calls) == 3
+    assert calls[0] == "[0] '''Post 0'''\n[1] '''Post 1'''\n[2] '''Post 2'''"
+    assert response["count"] == 7
+    assert [template["title"] for template in response["data"]] == [
+        f"T{index}" for index in range(7)
+    ]
+    assert all(template["stored"] for template in response["data"])
+    assert notion_db._store_template_in_notion.await_count == 7
+
+    asyncio.run(notion_db.create_templates(_templates_data(texts)))
+
+    assert len(calls) == 3
+
+
+def test_create_templates_requests_missing_templates_again():
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+    llm.acall = AsyncMock(
+        side_effect=[
+            '[{"index": 0, "title": "A", "post": "B"}, {"index": 2, "title": "C", '
+            '"post": "D"}]',
+            '{"templates": []}',
+        ]
+    )
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm)
+    notion_db._store_template_in_notion = AsyncMock()
+
+    response = asyncio.run(
+        notion_db.create_templates(_templates_data(["one", "two", "three"]))
+    )
+
+    assert llm.acall.await_args_list[1].args[0] == {"LINKEDIN_POSTS": "[0] '''two'''"}
+    assert response["data"] == [
+        {"index": 0, "title": "A", "post": "B", "stored": True},
+        {"index": 1, "error": "No template was generated"},
+        {"index": 2, "title": "C", "post": "D", "stored": True},
+    ]
+
+
+def test_create_templates_reports_the_posts_of_failed_batches():
+    async def acall(placeholders):
+        if "three" in placeholders["LINKEDIN_POSTS"]:
+            raise RuntimeError("OpenAI is down")
+        return repr(
+            [
+                {"index": index, "title": f"T{index}", "post": "Template"}
+                for index in range(len(placeholders["LINKEDIN_POSTS"].splitlines()))
+            ]
+        )
+
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+    llm.acall = AsyncMock(side_effect=acall)
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm, templates_per_llm_call=2)
+    notion_db._store_template_in_notion = AsyncMock()
+
+    response = asyncio.run(
+        notion_db.create_templates(_templates_data(["one", "two", "three"]))
+    )
+
+    # The failed batch is requested again once, then reported.
+    assert llm.acall.await_count == 3
+    assert response["data"] == [
+        {"index": 0, "title": "T0", "post": "Template", "stored": True},
+        {"index": 1, "title": "T1", "post": "Template", "stored": True},
+        {"index": 2, "error": "No template was generated"},
+    ]
+
+
+def test_create_templates_fails_when_every_batch_failed():
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+    llm.acall = AsyncMock(side_effect=RuntimeError("401 invalid api key"))
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm)
+
+    with pytest.raises(RuntimeError, match="invalid api key"):
+        asyncio.run(notion_db._generate_templates(_templates_data(["one", "two"])))
+
+
+def test_notion_calls_retry_throttled_requests_through_the_rate_limiter():
+    throttled = APIResponseError(
+        httpx.Response(
+            429,
+            headers={"Retry-After": "0"},
+            request=httpx.Request("POST", "https://api.notion.com/v1/pages"),
+        ),
+        "rate limited",
+        APIErrorCode.RateLimited,
+    )
+    notion = MagicMock()
+    notion.pages.create = AsyncMock(side_effect=[throttled, {"id": "page_id"}])
+    limiter = RateLimiter(rate=1000, burst=1000)
+    limiter.penalize = AsyncMock(wraps=limiter.penalize)
+    notion_db = NotionDatabase(
+        notion=notion, rate_limiter=limiter, rate_limit_key="integration"
+    )
+
+    result = asyncio.run(
+        notion_db._store_post(
+            {"title": "Title", "post": "Post"}, "databaseid", asyncio.Semaphore(1)
+        )
+    )
+
+    assert result == {"pageId": "page_id", "error": None}
+    assert notion.pages.create.await_count == 2
+    limiter.penalize.assert_awaited_once_with("integration", 0.0)
+
+
+def test_notion_writes_are_not_retried_after_server_errors():
+    unavailable = APIResponseError(
+        httpx.Response(
+            503, request=httpx.Request("POST", "https://api.notion.com/v1/pages")
+        ),
+        "unavailable",
+        APIErrorCode.ServiceUnavailable,
+    )
+    notion = MagicMock()
+    notion.pages.create = AsyncMock(side_effect=unavailable)
+    notion_db = NotionDatabase(notion=notion)
+
+    result = asyncio.run(
+        notion_db._store_post(
+            {"title": "Title", "post": "Post"}, "databaseid", asyncio.Semaphore(1)
+        )
+    )
+
+    assert result["pageId"] is None
+    assert notion.pages.create.await_count == 1
+
+
+def test_generate_posts_write_behind_returns_before_notion_writes():
+    llm = MagicMock()
+    llm.acall = AsyncMock(return_value='[{"title": "A", "post": "B"}]')
+    queued = []
+
+    async def write_behind(database_id, record, status):
+        queued.append((database_id, record, status))
+        return f"write_{len(queued)}"
+
+    notion_db = NotionDatabase(notion=MagicMock(), llm=llm, write_behind=write_behind)
+    notion_db._store_generated_posts = AsyncMock()
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=1,
+        model="model_name",
+        topics="topics",
+    )
+
+    posts = asyncio.run(notion_db.generate_posts(data))
+
+    assert posts == [{"title": "A", "post": "B", "stored": False, "writeId": "write_1"}]
+    assert queued == [("databaseid", {"title": "A", "post": "B"}, "Working")]
+    notion_db._store_generated_posts.assert_not_called()
+
+
+def test_get_templates_serves_and_incrementally_syncs_the_template_mirror():
+    clock = {"now": 1000.0}
+    queries = []
+    pages = [_template_page("page_0", "A"), _template_page("page_1", "B")]
+
+    async def query(**kwargs):
+        queries.append(kwargs["filter"])
+        return {"results": pages, "has_more": False, "next_cursor": None}
+
+    async def list_children(block_id):
+        return _paragraph_blocks(f"content of {block_id}")
+
+    notion = MagicMock()
+    notion.databases.query = query
+    notion.blocks.children.list = list_children
+    notion.pages.create = AsyncMock(
+        return_value={"id": "page_2", "created_time": "2023-12-09T00:00:00.000Z"}
+    )
+    mirror = TemplateMirror(max_staleness=30, clock=lambda: clock["now"])
+    notion_db = NotionDatabase(
+        notion=notion, template_mirror=mirror, rate_limit_key="integration"
+    )
+    data = GetTemplates(notionKey="notionkey", databaseId="databaseid")
+
+    first = asyncio.run(notion_db.get_templates(data))
+    asyncio.run(notion_db.get_templates(data))
+
+    assert [template["title"] for template in first["data"]] == ["A", "B"]
+    assert queries == [{"property": "Status", "select": {"equals": "Template"}}]
+
+    clock["now"] += 31
+    removed = _template_page("page_1", "B", "2023-12-02T00:00:00.000Z")
+    removed["properties"]["Status"] = {"select": {"name": "Done"}}
+    pages = [removed]
+    asyncio.run(
+        notion_db.create_page({"title": "C", "post": "Post"}, "databaseid", "Template")
+    )
+
+    second = asyncio.run(
+        notion_db.get_templates(
+            GetTemplates(notionKey="notionkey", databaseId="databaseid", pageSize=1)
+        )
+    )
+
+    assert queries[1] == {
+        "timestamp": "last_edited_time",
+        "last_edited_time": {"on_or_after": "2023-12-01T00:00:00.000Z"},
+    }
+    assert second == {
+        "count": 1,
+        "data": [{"id": 0, "title": "A", "content": "content of page_0"}],
+        "nextCursor": "mirror:1",
+    }
+    assert mirror.templates("integration/databaseid")[1]["title"] == "C"
+
+
+def test_get_templates_pages_through_mirror_and_notion_cursors():
+    pages = [
+        [_template_page("page_0", "A"), _template_page("page_1", "B")],
+        [_template_page("page_2", "C")],
+    ]
+    notion, queries = _paginated_notion(pages)
+    notion_db = NotionDatabase(notion=notion, template_mirror=TemplateMirror())
+
+    def get(cursor):
+        return asyncio.run(
+            notion_db.get_templates(
+                GetTemplates(
+                    notionKey="notionkey",
+                    databaseId="databaseid",
+                    pageSize=2,
+                    cursor=cursor,
+                )
+            )
+        )
+
+    async def stream(cursor):
+        data = GetTemplates(
+            notionKey="notionkey", databaseId="databaseid", cursor=cursor
+        )
+        return [template async for template in notion_db.stream_templates(data)]
+
+    first = get(None)
+    synced = len(queries)
+    second = get(first["nextCursor"])
+    streamed = asyncio.run(stream(first["nextCursor"]))
+
+    assert first["nextCursor"] == "mirror:2"
+    assert second["data"] == [{"id": 2, "title": "C", "content": "content of page_2"}]
+    assert second["nextCursor"] is None
+    assert streamed == second["data"]
+    assert len(queries) == synced
+
+    # Notion's own cursors are still sent to Notion.
+    from_notion = get("1")
+
+    assert queries[-1]["start_cursor"] == "1"
+    assert [template["title"] for template in from_notion["data"]] == ["C"]
+
+    for cursor in ("mirror:-1", "mirror:", "mirror:two"):
+        with pytest.raises(InvalidCursor):
+            get(cursor)
+
+
+def test_search_templates_reindexes_only_after_mirror_changes():
+    notion, _ = _paginated_notion(
+        [
+            [
+                _template_page("page_0", "Lessons from failure"),
+                _template_page("page_1", "Hiring"),
+            ]
+        ]
+    )
+    notion.pages.create = AsyncMock(return_value={"id": "page_2"})
+    mirror = TemplateMirror()
+    notion_db = NotionDatabase(notion=notion, template_mirror=mirror)
+    data = SearchTemplates(notionKey="notionkey", databaseId="db", query="failure")
+
+    response = asyncio.run(notion_db.search_templates(data))
+
+    assert response["count"] == 1
+    assert response["data"][0]["pageId"] == "page_0"
+    assert response["data"][0]["title"] == "Lessons from failure"
+
+    asyncio.run(
+        notion_db.create_page(
+            {"title": "Failure again", "post": "content"}, "db", "Template"
+        )
+    )
+    response = asyncio.run(notion_db.search_templates(data))
+
+    assert [match["pageId"] for match in response["data"]] == ["page_2", "page_0"]
+
+
+def test_single_flight_merges_identical_template_reads_and_generations():
+    pages = [[_template_page("page_0", "A")]]
+    notion, queries = _paginated_notion(pages)
+    llm = MagicMock()
+    llm.model_name = "model_name"
+    llm.prompt_version = "prompt_version"
+
+    async def acall(mapping):
+        await asyncio.sleep(0.01)
+        return "{'title': 'Title', 'post': 'Post'}"
+
+    llm.acall = AsyncMock(side_effect=acall)
+    single_flight = SingleFlight()
+
+    def notion_db():
+        return NotionDatabase(notion=notion, llm=llm, single_flight=single_flight)
+
+    async def run():
+        data = GetTemplates(notionKey="notionkey", databaseId="databaseid")
+        text = TemplateCreate(
+            notionKey="notionkey",
+            openaiKey="openaikey",
+            text="A viral post",
+            model="model_name",
+        )
+        return await asyncio.gather(
+            *(notion_db().get_templates(data) for _ in range(3)),
+            *(notion_db()._generate_template(text) for _ in range(3)),
+        )
+
+    results = asyncio.run(run())
+
+    assert results[0] == results[1] == results[2]
+    assert len(queries) == 1
+    assert llm.acall.await_count == 1
+    # Callers add their own ids to the template, the shared one stays intact.
+    results[3]["writeId"] = "write_id"
+    assert results[4] == {"title": "Title", "post": "Post"}
+
+
+def _write_posts_until_cancelled(persist_on_cancel):
+    written = []
+
+    async def create_page(parent, properties, children):
+        await asyncio.sleep(0.05)
+        written.append(properties["title"]["title"][0]["text"]["content"])
+        return {"id": "page_id"}
+
+    notion = MagicMock()
+    notion.pages.create = create_page
+    notion_db = NotionDatabase(
+        notion=notion, max_concurrency=1, persist_on_cancel=persist_on_cancel
+    )
+    data = GeneratePosts(
+        notionKey="notionkey",
+        openaiKey="openaikey",
+        databaseId="databaseid",
+        templateText="template_text",
+        numPosts=3,
+        model="model_name",
+        topics="topics",
+    )
+    posts = [{"title": str(index), "post": "content"} for index in range(3)]
+
+    async def cancel_while_writing():
+        with patch.object(notion_db, "_generate_posts", AsyncMock(return_value=posts)):
+            task = asyncio.ensure_future(notion_db.generate_posts(data))
+            await asyncio.sleep(0.07)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.2)
+
+    asyncio.run(cancel_while_writing())
+    return written
+
+
+def test_cancelled_generate_posts_cancels_or_finishes_the_notion_writes():
+    assert _write_posts_until_cancelled(persist_on_cancel=False) == ["0"]
+    assert _write_posts_until_cancelled(persist_on_cancel=True) == ["0", "1", "2"]
+
+
+def test_single_flight_does_not_share_template_generations_across_tenants():
+    def tenant_llm(result):
+        llm = MagicMock()
+        llm.model_name = "model_name"
+        llm.prompt_version = "prompt_version"
+
+        async def acall(mapping):
+            await asyncio.sleep(0.01)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        llm.acall = AsyncMock(side_effect=acall)
+        return llm
+
+    failing_llm = tenant_llm(RuntimeError("401 invalid api key"))
+    working_llm = tenant_llm("{'title': 'Title', 'post': 'Post'}")
+    single_flight = SingleFlight()
+
+    def generate(llm, notion_key, openai_key):
+        notion_db = NotionDatabase(
+            notion=MagicMock(),
+            llm=llm,
+            rate_limit_key=notion_key,
+            single_flight=single_flight,
+        )
+        return notion_db._generate_template(
+            TemplateCreate(
+                notionKey=notion_key,
+                openaiKey=openai_key,
+                text="A viral post",
+                model="model_name",
+            )
+        )
+
+    async def run():
+        return await asyncio.gather(
+            generate(failing_llm, "notion_a", "openai_a"),
+            generate(working_llm, "notion_b", "openai_b"),
+            return_exceptions=True,
+        )
+
+    failed, template = asyncio.run(run())
+
+    assert isinstance(failed, RuntimeError)
+    assert template == {"title": "Title", "post": "Post"}
+    assert working_llm.acall.await_count == 1
@@ -0,0 +1,103 @@
+from src.output_parsing import (
+    IncrementalObjectParser,
+    parse_object,
+    parse_objects,
+    repair_record,
+)
+
+COMPLETION = (
+    "[{\"title\": '''First''', \"post\": '''Hello {world}\nIt's \"quoted\"'''},"
+    ' {"title": "Second", "post": \'a\\\'b}\'},'
+    "{\"title\": '''Third''', \"post\": '''Last'''}]"
+)
+
+
+def _parse_in_chunks(completion, size):
+    parser = IncrementalObjectParser()
+    objects = []
+    for start in range(0, len(completion), size):
+        objects.extend(parser.feed(completion[start : start + size]))
+    return objects + parser.close()
+
+
+def test_parser_yields_objects_independent_of_chunking():
+    expected = [
+        {"title": "First", "post": 'Hello {world}\nIt\'s "quoted"'},
+        {"title": "Second", "post": "a'b}"},
+        {"title": "Third", "post": "Last"},
+    ]
+
+    for size in (1, 2, 3, 7, len(COMPLETION)):
+        assert _parse_in_chunks(COMPLETION, size) == expected
+
+
+def test_parser_emits_objects_before_the_list_is_closed():
+    parser = IncrementalObjectParser()
+
+    assert parser.feed('[{"title": "First", "post": "One"}, {"title": "Sec') == [
+        {"title": "First", "post": "One"}
+    ]
+    assert parser.feed('ond", "post": "Two"}') == [{"title": "Second", "post": "Two"}]
+
+
+def test_parser_skips_malformed_objects():
+    completion = (
+        '[{"title": "Broken", "post": "a" "b" +}, {"title": "Ok", "post": "c"}]'
+    )
+
+    assert _parse_in_chunks(completion, 5) == [{"title": "Ok", "post": "c"}]
+
+
+def test_parse_objects_accepts_fenced_json_mode_output():
+    output = '```json\n{"posts": [{"title": "A", "post": "B"}]}\n```'
+
+    assert parse_objects(output) == [{"title": "A", "post": "B"}]
+
+
+def test_parse_objects_salvages_well_formed_records():
+    output = (
+        'Here you go: [{"title": "A", "post": "B"}, '
+        '{"title": "C", "post": }, '
+        '{"title": "D", "post": "E"}, {"title": "Trunc'
+    )
+
+    assert parse_objects(output) == [
+        {"title": "A", "post": "B"},
+        {"title": "D", "post": "E"},
+    ]
+
+
+def test_parse_objects_drops_records_without_title_and_post():
+    output = '[{"title": "A", "post": "B"}, {"title": "C"}, {"post": 1, "title": "D"}]'
+
+    assert parse_objects(output) == [{"title": "A", "post": "B"}]
+
+
+def test_parse_object_accepts_raw_newlines():
+    assert parse_object('{"title": "A", "post": "line\nline"}') == {
+        "title": "A",
+        "post": "line\nline",
+    }
+    assert parse_object("not a template") is None
+
+
+def test_parse_objects_repairs_stray_quotes():
+    output = (
+        "[{'title': 'Failure', 'post': 'Failure isn't final.'}, "
+        "{'title': 'Courage', 'post': 'Courage is a muscle.'}, "
+        '{"title": "Boss", "post": "My boss said "ship it"."}]'
+    )
+
+    assert [record["post"] for record in parse_objects(output)] == [
+        "Failure isn't final.",
+        "Courage is a muscle.",
+        'My boss said "ship it".',
+    ]
+
+
+def test_repair_record_unescapes_posts():
+    assert repair_record("{'title': 'A', 'post': 'It\\'s\\nfine'}") == {
+        "title": "A",
+        "post": "It's\nfine",
+    }
+    assert repair_record('{"title": "A"}') is None
@@ -0,0 +1,82 @@
+import asyncio
+
+from src.pool import ResourcePool, hash_secret
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_pool_reuses_resources_per_key():
+    pool = ResourcePool()
+    created = []
+
+    def create():
+        created.append(object())
+        return created[-1]
+
+    async def lease_twice():
+        async with pool.acquire("key", create) as first:
+            pass
+        async with pool.acquire("key", create) as second:
+            pass
+        return first, second
+
+    first, second = asyncio.run(lease_twice())
+
+    assert first is second
+    assert len(created) == 1
+
+
+def test_pool_expires_resources_after_ttl():
+    clock = FakeClock()
+    closed = []
+
+    async def close(resource):
+        closed.append(resource)
+
+    pool = ResourcePool(ttl=10, close=close, clock=clock)
+
+    async def lease():
+        async with pool.acquire("key", object) as resource:
+            return resource
+
+    first = asyncio.run(lease())
+    clock.now = 11
+    second = asyncio.run(lease())
+
+    assert first is not second
+    assert closed == [first]
+
+
+def test_pool_closes_evicted_resource_after_last_lease():
+    closed = []
+
+    async def close(resource):
+        closed.append(resource)
+
+    pool = ResourcePool(maxsize=1, close=close)
+
+    async def evict_while_leased():
+        async with pool.acquire("a", lambda: "client_a"):
+            async with pool.acquire("b", lambda: "client_b"):
+                assert closed == []
+            assert closed == []
+        assert closed == ["client_a"]
+        await pool.aclose()
+
+    asyncio.run(evict_while_leased())
+
+    assert closed == ["client_a", "client_b"]
+    assert len(pool) == 0
+
+
+def test_hash_secret_does_not_leak_secret():
+    digest = hash_secret("secret_notion_key")
+
+    assert "secret" not in digest
+    assert digest == hash_secret("secret_notion_key")
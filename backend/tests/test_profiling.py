@@ -0,0 +1,29 @@
+import time
+
+from src.metrics import PROFILES_CAPTURED
+from src.profiling import SlowRequestProfiler
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiler_writes_folded_stacks_of_slow_requests(tmp_path):
+    profiler = SlowRequestProfiler(threshold=0.05, path=str(tmp_path), interval=0.001)
+    captured = PROFILES_CAPTURED.value()
+
+    with profiler.watch("slow-trace") as slow:
+        busy_wait(0.1)
+    with profiler.watch("fast-trace") as fast:
+        pass
+    profiler.close()
+
+    assert slow["path"] == str(tmp_path / "slow-trace.folded")
+    assert "path" not in fast
+    assert not (tmp_path / "fast-trace.folded").exists()
+    lines = (tmp_path / "slow-trace.folded").read_text().splitlines()
+    assert any("busy_wait (test_profiling.py:" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert PROFILES_CAPTURED.value() == captured + 1
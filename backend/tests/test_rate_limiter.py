@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+
+import httpx
+import pytest
+from notion_client.errors import APIErrorCode, APIResponseError, RequestTimeoutError
+
+from src.rate_limiter import RateLimiter, backoff_delay, is_retryable, retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+
+
+def _api_error(status, headers=None):
+    response = httpx.Response(
+        status,
+        headers=headers,
+        request=httpx.Request("POST", "https://api.notion.com/v1/pages"),
+    )
+    return APIResponseError(response, "failed", APIErrorCode.RateLimited)
+
+
+def test_rate_limiter_spaces_out_bursts_per_key():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+
+    async def acquire_many(key, count):
+        return [await limiter.acquire(key) for _ in range(count)]
+
+    assert asyncio.run(acquire_many("a", 4)) == [0, 0, 0.5, 1.0]
+    assert asyncio.run(acquire_many("b", 1)) == [0]
+
+    clock.now += 3
+    assert asyncio.run(acquire_many("a", 1)) == [0]
+
+
+def test_rate_limiter_shares_buckets_through_sqlite(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "buckets.sqlite3")
+    first = RateLimiter(rate=1, burst=1, path=path, clock=clock, sleep=clock.sleep)
+    second = RateLimiter(rate=1, burst=1, path=path, clock=clock, sleep=clock.sleep)
+
+    assert asyncio.run(first.acquire("integration")) == 0
+    assert asyncio.run(second.acquire("integration")) == 1.0
+
+    asyncio.run(second.penalize("integration", 10))
+    assert asyncio.run(first.acquire("integration")) == 11.0
+
+    first.close()
+    second.close()
+
+
+def test_rate_limiter_waits_for_the_sqlite_lock_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "buckets.sqlite3")
+    limiter = RateLimiter(rate=1, burst=1, path=path)
+    # Another process holding the write lock.
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+
+    async def acquire_while_locked():
+        acquire = asyncio.ensure_future(limiter.acquire("integration"))
+        # The loop keeps running other tasks while the acquire waits for the lock.
+        await asyncio.sleep(0.1)
+        assert not acquire.done()
+        other.execute("COMMIT")
+        return await acquire
+
+    assert asyncio.run(acquire_while_locked()) == 0
+
+    other.close()
+    limiter.close()
+
+
+def test_retry_helpers_honor_retry_after_and_idempotency():
+    throttled = _api_error(429, {"Retry-After": "2"})
+
+    assert retry_after(throttled) == 2.0
+    assert retry_after(_api_error(429)) is None
+    assert 2.0 <= backoff_delay(0, retry_after(throttled)) <= 2.2
+    assert 0 <= backoff_delay(3) <= 4.0
+
+    assert is_retryable(throttled, idempotent=False)
+    assert is_retryable(_api_error(503), idempotent=True)
+    assert not is_retryable(_api_error(503), idempotent=False)
+    assert not is_retryable(_api_error(400), idempotent=True)
+    assert not is_retryable(RequestTimeoutError(), idempotent=False)
+
+
+def test_rate_limiter_validates_its_configuration():
+    with pytest.raises(ValueError):
+        RateLimiter(rate=0)
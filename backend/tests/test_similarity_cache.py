@@ -0,0 +1,44 @@
+import numpy as np
+
+from src.metrics import SIMILARITY_CACHE_LOOKUPS
+from src.similarity_cache import SimilarityCache, hash_vector
+
+
+def test_hash_vector_ignores_word_order_and_joining_words():
+    vector = hash_vector("AI, startups")
+
+    assert np.isclose(np.linalg.norm(vector), 1)
+    assert np.isclose(vector @ hash_vector("startups and AI"), 1)
+    assert vector @ hash_vector("AI startup") < 0.9
+    assert hash_vector("week 1") @ hash_vector("week 2") < 0.9
+    assert not hash_vector("and, or").any()
+
+
+def test_similarity_cache_answers_similar_texts_of_the_same_key():
+    cache = SimilarityCache(threshold=0.9)
+    posts = [{"title": "A", "post": "B"}]
+    hits = SIMILARITY_CACHE_LOOKUPS.value(outcome="hit")
+
+    cache.set("template", "AI, startups", posts)
+    cached = cache.get("template", "Startups and AI")
+    cached[0]["stored"] = True
+
+    assert cached == [{"title": "A", "post": "B", "stored": True}]
+    assert cache.get("template", "startups, AI") == posts
+    assert cache.get("template", "remote work") is None
+    assert cache.get("other template", "AI, startups") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert SIMILARITY_CACHE_LOOKUPS.value(outcome="hit") == hits + 2
+
+
+def test_similarity_cache_evicts_least_recently_used_entries():
+    cache = SimilarityCache(maxsize=2)
+    cache.set("template", "AI", 1)
+    cache.set("template", "remote work", 2)
+    cache.get("template", "AI")
+    cache.set("other template", "hiring", 3)
+
+    assert len(cache) == 2
+    assert cache.get("template", "AI") == 1
+    assert cache.get("template", "remote work") is None
+    assert cache.get("other template", "hiring") == 3
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from src.metrics import SINGLE_FLIGHT_CALLS
+from src.single_flight import SingleFlight
+
+
+def test_single_flight_merges_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"count": 0}
+
+    async def run():
+        results = await asyncio.gather(
+            *(single_flight.do("key", fetch, "merged") for _ in range(5))
+        )
+        return results, len(single_flight)
+
+    results, in_flight = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert in_flight == 0
+    assert SINGLE_FLIGHT_CALLS.value(operation="merged", role="leader") == 1
+    assert SINGLE_FLIGHT_CALLS.value(operation="merged", role="follower") == 4
+
+
+def test_single_flight_runs_different_keys_and_later_calls_separately():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0)
+        return key
+
+    async def run():
+        await asyncio.gather(
+            single_flight.do("a", lambda: fetch("a")),
+            single_flight.do("b", lambda: fetch("b")),
+        )
+        await single_flight.do("a", lambda: fetch("a"))
+
+    asyncio.run(run())
+
+    assert calls == ["a", "b", "a"]
+
+
+def test_single_flight_shares_exceptions():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("failed")
+
+    async def run():
+        return await asyncio.gather(
+            single_flight.do("key", fail),
+            single_flight.do("key", fail),
+            return_exceptions=True,
+        )
+
+    first, second = asyncio.run(run())
+
+    assert isinstance(first, ValueError)
+    assert first is second
+
+
+def test_single_flight_cancelled_waiter_does_not_cancel_the_call():
+    single_flight = SingleFlight()
+    release = None
+
+    async def fetch():
+        await release.wait()
+        return "result"
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        leader = asyncio.ensure_future(single_flight.do("key", fetch))
+        follower = asyncio.ensure_future(single_flight.do("key", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == "result"
+
+
+def test_single_flight_cancels_the_call_once_every_waiter_left():
+    single_flight = SingleFlight()
+    cancelled = []
+
+    async def fetch():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        waiter = asyncio.ensure_future(single_flight.do("key", fetch))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return len(single_flight)
+
+    assert asyncio.run(run()) == 0
+    assert cancelled == [True]
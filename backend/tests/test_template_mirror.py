@@ -0,0 +1,74 @@
+from src.template_mirror import TemplateMirror
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _template(page_id, title, created, edited):
+    return {
+        "pageId": page_id,
+        "title": title,
+        "content": f"content of {title}",
+        "createdTime": created,
+        "lastEditedTime": edited,
+    }
+
+
+def test_template_mirror_tracks_freshness_and_watermark(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "templates.sqlite3")
+    mirror = TemplateMirror(
+        path=path, max_staleness=30, full_sync_interval=600, clock=clock
+    )
+
+    assert not mirror.is_fresh("key")
+    assert mirror.sync_since("key") is None
+
+    mirror.apply(
+        "key",
+        [
+            _template("b", "B", "2023-12-02T00:00Z", "2023-12-03T00:00Z"),
+            _template("a", "A", "2023-12-01T00:00Z", "2023-12-01T00:00Z"),
+        ],
+        [],
+        "2023-12-03T00:00Z",
+        full=True,
+    )
+
+    assert mirror.is_fresh("key")
+    assert mirror.sync_since("key") == "2023-12-03T00:00Z"
+    assert [template["title"] for template in mirror.templates("key")] == ["A", "B"]
+
+    clock.now += 31
+    assert not mirror.is_fresh("key")
+
+    mirror.apply(
+        "key",
+        [_template("a", "A2", "2023-12-01T00:00Z", "2023-12-04T00:00Z")],
+        ["b"],
+        "2023-12-04T00:00Z",
+        full=False,
+    )
+    mirror.add("key", _template("c", "C", "2023-12-05T00:00Z", "2023-12-05T00:00Z"))
+    mirror.add(
+        "unsynced", _template("d", "D", "2023-12-05T00:00Z", "2023-12-05T00:00Z")
+    )
+    mirror.close()
+
+    reopened = TemplateMirror(path=path, full_sync_interval=600, clock=clock)
+
+    assert [
+        (template["pageId"], template["title"])
+        for template in reopened.templates("key")
+    ] == [("a", "A2"), ("c", "C")]
+    assert reopened.revision("key") == 3
+    assert reopened.templates("unsynced") == []
+    assert reopened.sync_since("key") == "2023-12-04T00:00Z"
+
+    clock.now += 600
+    assert reopened.sync_since("key") is None
@@ -0,0 +1,50 @@
+from src.template_search import TemplateIndex, tokenize
+
+
+def test_tokenize_lowercases_and_skips_single_characters():
+    assert tokenize("I shipped AI-powered apps in 2023!") == [
+        "shipped",
+        "ai",
+        "powered",
+        "apps",
+        "in",
+        "2023",
+    ]
+
+
+def test_template_index_ranks_titles_and_rare_terms_first():
+    index = TemplateIndex()
+    index.add("failure", "Lessons from failure", "I failed [number] times.")
+    index.add("hiring", "Hiring", "How we hire [role] at our startup.")
+    index.add("startup", "Startup story", "Our startup failed, then it grew.")
+
+    assert [doc_id for doc_id, _ in index.search("failure lessons")] == ["failure"]
+    assert [doc_id for doc_id, _ in index.search("startup", k=1)] == ["startup"]
+    assert index.search("kubernetes") == []
+
+    duplicate = index.search("How we hire [role] at our startup.")
+    assert duplicate[0][0] == "hiring"
+    assert duplicate[0][1] > 2 * duplicate[1][1]
+
+
+def test_template_index_syncs_incrementally_and_compacts():
+    index = TemplateIndex()
+    templates = [
+        {
+            "pageId": f"page_{number}",
+            "title": f"Template {number}",
+            "content": f"topic{number} story",
+            "lastEditedTime": "v1",
+        }
+        for number in range(200)
+    ]
+    index.sync(templates)
+
+    templates[0] = {**templates[0], "content": "rewritten", "lastEditedTime": "v2"}
+    index.sync(templates[:50])
+
+    assert len(index) == 50
+    assert index.search("topic0") == []
+    assert index.search("rewritten")[0][0] == "page_0"
+    assert index.search("topic120") == []
+    assert [doc_id for doc_id, _ in index.search("topic42")] == ["page_42"]
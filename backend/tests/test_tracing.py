@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from src.tracing import FileSpanExporter, Tracer, TracingMiddleware
+
+
+class ListExporter:
+    def __init__(self):
+        self.payloads = []
+        self.closed = False
+
+    def export(self, payload):
+        self.payloads.append(payload)
+
+    def close(self):
+        self.closed = True
+
+    @property
+    def spans(self):
+        return [
+            span
+            for payload in self.payloads
+            for resource in payload["resourceSpans"]
+            for scope in resource["scopeSpans"]
+            for span in scope["spans"]
+        ]
+
+
+def test_tracer_nests_spans_across_tasks():
+    exporter = ListExporter()
+    tracer = Tracer(exporter, flush_interval=0.01)
+
+    async def call(name):
+        with tracer.span(name, kind="client", attempt=1):
+            await asyncio.sleep(0)
+
+    async def handle():
+        with tracer.span("POST /create_template", kind="server"):
+            await asyncio.gather(call("notion.pages.create"), call("llm.call"))
+
+    asyncio.run(handle())
+    tracer.close()
+
+    root, *children = sorted(exporter.spans, key=lambda span: "parentSpanId" in span)
+    assert "parentSpanId" not in root
+    assert {child["name"] for child in children} == {"notion.pages.create", "llm.call"}
+    for child in children:
+        assert child["traceId"] == root["traceId"]
+        assert child["parentSpanId"] == root["spanId"]
+        assert child["kind"] == 3
+        assert child["attributes"] == [{"key": "attempt", "value": {"intValue": "1"}}]
+    assert exporter.closed
+    assert tracer.current_span() is None
+
+
+def test_tracer_records_errors_and_samples_whole_traces():
+    exporter = ListExporter()
+    tracer = Tracer(exporter, sample_rate=0.0)
+
+    with tracer.span("unsampled"):
+        with tracer.span("child"):
+            pass
+
+    tracer.configure(exporter, sample_rate=1.0)
+    with pytest.raises(ValueError):
+        with tracer.span("failed"):
+            raise ValueError("invalid template")
+    tracer.close()
+
+    assert [span["name"] for span in exporter.spans] == ["failed"]
+    assert exporter.spans[0]["status"] == {
+        "code": 2,
+        "message": "ValueError('invalid template')",
+    }
+
+
+def test_tracing_middleware_names_spans_by_route_and_joins_traceparent(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = Tracer(FileSpanExporter(str(path)))
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        with tracer.span("lookup"):
+            return {"id": job_id}
+
+    parent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+    async def get():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await client.get("/jobs/1", headers={"traceparent": parent})
+
+    response = asyncio.run(get())
+    tracer.close()
+
+    assert response.status_code == 200
+    spans = [
+        span
+        for line in path.read_text().splitlines()
+        for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    ]
+    root = next(span for span in spans if span["name"] == "GET /jobs/{job_id}")
+    lookup = next(span for span in spans if span["name"] == "lookup")
+    assert root["traceId"] == lookup["traceId"] == "0af7651916cd43dd8448eb211c80319c"
+    assert root["parentSpanId"] == "b7ad6b7169203331"
+    assert lookup["parentSpanId"] == root["spanId"]
+    assert {"key": "http.status_code", "value": {"intValue": "200"}} in root[
+        "attributes"
+    ]
@@ -0,0 +1,85 @@
+import asyncio
+
+from src.write_behind import WriteBehindQueue
+
+
+def test_write_behind_flushes_in_order_per_partition_and_retries():
+    written = []
+    failures = {"b1": 2}
+
+    async def writer(entry):
+        await asyncio.sleep(0.01)
+        if failures.get(entry["name"]):
+            failures[entry["name"]] -= 1
+            raise RuntimeError("Notion is down")
+        written.append(entry["name"])
+
+    async def run():
+        queue = WriteBehindQueue(writer, base_delay=0)
+        for name in ("a1", "a2", "a3"):
+            await queue.enqueue("database_a", {"name": name})
+        for name in ("b1", "b2"):
+            await queue.enqueue("database_b", {"name": name})
+        assert queue.pending() == 5
+        await queue.join()
+        return queue
+
+    queue = asyncio.run(run())
+
+    assert [name for name in written if name[0] == "a"] == ["a1", "a2", "a3"]
+    assert [name for name in written if name[0] == "b"] == ["b1", "b2"]
+    # Partitions flush concurrently, so a failing database does not block others.
+    assert written.index("a1") < written.index("b1")
+    assert queue.pending() == 0
+
+
+def test_write_behind_replays_unflushed_entries_after_restart(tmp_path):
+    path = str(tmp_path / "write_behind.sqlite3")
+    written = []
+
+    async def slow_writer(entry):
+        await asyncio.sleep(10)
+
+    async def writer(entry):
+        written.append(entry["name"])
+
+    async def crash():
+        queue = WriteBehindQueue(slow_writer, path=path)
+        await queue.enqueue("database", {"name": "first"})
+        await queue.enqueue("database", {"name": "second"})
+        await queue.stop(timeout=0.01)
+
+    async def restart():
+        queue = WriteBehindQueue(writer, path=path)
+        await queue.start()
+        await queue.join()
+
+    asyncio.run(crash())
+    asyncio.run(restart())
+    asyncio.run(restart())
+
+    assert written == ["first", "second"]
+
+
+def test_write_behind_gives_up_after_max_attempts(tmp_path):
+    path = str(tmp_path / "write_behind.sqlite3")
+    attempts = []
+
+    async def failing_writer(entry):
+        attempts.append(entry["name"])
+        raise RuntimeError("invalid page")
+
+    async def run():
+        queue = WriteBehindQueue(
+            failing_writer, path=path, max_attempts=3, base_delay=0
+        )
+        await queue.enqueue("database", {"name": "broken"})
+        await queue.join()
+
+        replayed = WriteBehindQueue(failing_writer, path=path)
+        await replayed.start()
+        await replayed.join()
+
+    asyncio.run(run())
+
+    assert attempts == ["broken"] * 3